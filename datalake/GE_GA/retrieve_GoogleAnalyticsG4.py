@@ -2,32 +2,54 @@ from google.analytics.data_v1beta import BetaAnalyticsDataClient
 from google.analytics.data_v1beta.types import DateRange
 from google.analytics.data_v1beta.types import Dimension
 from google.analytics.data_v1beta.types import Metric
+from google.analytics.data_v1beta.types import MetricType
 from google.analytics.data_v1beta.types import RunReportRequest
+from google.analytics.data_v1beta.types import RunReportResponse
 from google.analytics.data_v1beta.types import GetMetadataRequest
 
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
 import pandas as pd
+
+sys.path.append("../")
+
+from utils.file_handlers import load_file
+from utils.rate_limiter import get_rate_limiter
 # https://developers.google.com/analytics/devguides/migration/api/reporting-ua-to-ga4
 
+# Maximum rows returned by one RunReportRequest
+PAGE_SIZE = 100000
+
 
-def clean_date(row):
-    d = row['date']
-    return f"{d[0:4]}-{d[4:6]}-{d[6:8]}"
+# Metrics of these types are integers, the others (float, seconds, currency...) are floats
+INTEGER_METRIC_TYPES = {MetricType.TYPE_INTEGER}
+
+# Token quotas of a standard property, Analytics 360 properties have 10 times more
+# (set token_quotas in the configs). consumed is per report so usage is computed from these
+# https://developers.google.com/analytics/devguides/reporting/data/v1/quotas
+TOKEN_QUOTAS = {"tokens_per_day": 200000, "tokens_per_hour": 40000, "tokens_per_project_per_hour": 14000}
+# Reports of the same cost that must still fit in a quota before it counts as used up
+QUOTA_HEADROOM = 3
 
 
 def ga4_response_to_df(response, account_id, account_name, property_id, property_name):
-    dim_len = len(response.dimension_headers)
-    metric_len = len(response.metric_headers)
-    all_data = []
-    for row in response.rows:
-        row_data = {}
-        for i in range(0, dim_len):
-            row_data.update({response.dimension_headers[i].name: row.dimension_values[i].value})
-        for i in range(0, metric_len):
-            row_data.update({response.metric_headers[i].name: row.metric_values[i].value})
-        all_data.append(row_data)
-    df = pd.DataFrame(all_data)
-
-    df["date"] = df.apply(lambda row: clean_date(row), axis=1)
+    # read the raw protobuf rows, the proto-plus wrappers are slow to access per value
+    rows = RunReportResponse.pb(response).rows
+    columns = {}
+    for i, header in enumerate(response.dimension_headers):
+        columns[header.name] = [row.dimension_values[i].value for row in rows]
+    for i, header in enumerate(response.metric_headers):
+        values = pd.to_numeric([row.metric_values[i].value for row in rows])
+        columns[header.name] = values if header.type_ in INTEGER_METRIC_TYPES else values.astype("float64")
+    df = pd.DataFrame(columns)
+
+    if "date" in df:
+        df["date"] = pd.to_datetime(df["date"], format="%Y%m%d")
     df['account_id'] = account_id
     df['account_name'] = account_name
     df['property_id'] = property_id
@@ -35,69 +57,125 @@ def ga4_response_to_df(response, account_id, account_name, property_id, property
     return df
 
 
-# It is not possible to retrieve account id, account name and property name from the property id.
-ga_properties = [
-    {
-        "account_id": "102588170",
-        "account_name": "Springster Analytics Account",
-        "property_id": "345080356",
-        "property_name": "SP South Africa - GA4",
-        "start_date": "2022-12-01",
-        "end_date": "2023-03-01"
-    }, {
-        "account_id": "140154819",
-        "account_name": "ChaaJaa",
-        "property_id": "319324465",
-        "property_name": "Girl Effect - Chajaa Public Site - Live - GA4",
-        "start_date": "2022-06-01",
-        "end_date": "2023-03-01"
-    }
-]
-
-
-def run_report():
-    for property in ga_properties:
-        property_id = property["property_id"]
-        property_name = property["property_name"]
-
-        DIMS = ["date", "country", "sessionDefaultChannelGrouping", "region", "platformDeviceCategory", "deviceModel"]
-        METRICS = ["totalUsers", "newUsers", "sessions", "bounceRate", "engagementRate", "averageSessionDuration", "screenPageViews"]
-        start_date = property["start_date"]
-        end_date = property["end_date"]
-
-        # Using a default constructor instructs the client to use the credentials
-        # specified in GOOGLE_APPLICATION_CREDENTIALS environment variable.
-        import os
-        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "plucky-dryad-381507-62fe588e0fec.json"
-        client = BetaAnalyticsDataClient()
-
-        #NOT WORKING
-        #client = BetaAnalyticsDataClient().from_service_account_json(credentials_json_path)
-
-        dimensions_ga4 = []
-        for dimension in DIMS:
-            dimensions_ga4.append(Dimension(name=dimension))
-
-        metrics_ga4 = []
-        for metric in METRICS:
-            metrics_ga4.append(Metric(name=metric))
-
-        request = RunReportRequest(
-            property=f"properties/{property_id}",
-            dimensions=dimensions_ga4,
-            metrics=metrics_ga4,
-            date_ranges=[DateRange(start_date=start_date, end_date=end_date)],
-            limit=100000
-        )
+def quota_usage(property_quota, token_quotas=TOKEN_QUOTAS):
+    """Returns the highest usage percentage of the token quotas, from the tokens remaining
+    after a report against the quota limits, and the seconds until tokens are available
+    again when the hourly quota is used up. consumed only counts the tokens of the report,
+    a quota with less than QUOTA_HEADROOM reports of the same cost left counts as used up."""
+    usage = 0.0
+    for name, limit in token_quotas.items():
+        status = getattr(property_quota, name)
+        if not status.consumed and not status.remaining:
+            # quota not returned
+            continue
+        usage = max(usage, 100 * (1 - status.remaining / max(limit, status.remaining)))
+        if status.remaining < QUOTA_HEADROOM * status.consumed:
+            usage = 100.0
+    if property_quota.tokens_per_day.consumed and not property_quota.tokens_per_day.remaining:
+        raise RuntimeError("GA4 daily token quota exhausted")
+    regain_seconds = 0
+    for name in ["tokens_per_hour", "tokens_per_project_per_hour"]:
+        status = getattr(property_quota, name)
+        if status.consumed and not status.remaining:
+            now = datetime.now()
+            regain_seconds = 3600 - now.minute * 60 - now.second
+    return usage, regain_seconds
+
+
+def iter_report_pages(client, request, page_size=PAGE_SIZE, limiter=None, token_quotas=TOKEN_QUOTAS):
+    """Yields the report one page (response) at a time, following the offset until
+    row_count rows were read, so big reports are neither truncated nor held in memory.
+    With a limiter the requests are throttled from the property quota returned with each page."""
+    offset, row_count = 0, None
+    request.return_property_quota = limiter is not None
+    while row_count is None or offset < row_count:
+        request.offset = offset
+        request.limit = page_size
+        if limiter:
+            limiter.acquire()
         response = client.run_report(request)
-
-        df = ga4_response_to_df(response, property["account_id"], property["account_name"], property_id, property_name)
-
-        GA4_FILENAME = f"initial-load-{property_id}.csv"
-        df.to_csv(GA4_FILENAME, index=False)
+        if limiter:
+            usage, regain_seconds = quota_usage(response.property_quota, token_quotas)
+            limiter.set_usage(usage, regain_seconds=regain_seconds)
+        row_count = response.row_count
+        if not response.rows:
+            break
+        yield response
+        offset += len(response.rows)
+    if offset != row_count:
+        raise ValueError(f"{request.property}: read {offset} rows but the report has {row_count}")
+
+
+def save_report_csv(filename, dataframes):
+    """Appends each page to the csv file as it arrives, returns the rows saved"""
+    saved = 0
+    temp_filename = f"{filename}.part"
+    for df in dataframes:
+        df.to_csv(temp_filename, mode="w" if saved == 0 else "a", header=saved == 0, index=False, date_format="%Y-%m-%d")
+        saved += len(df)
+    if saved:
+        os.replace(temp_filename, filename)
+    return saved
+
+
+def fetch_property(client, property, configs):
+    """Saves the report of one property, returns the rows saved and the seconds taken"""
+    start = time.perf_counter()
+    property_id = property["property_id"]
+    property_name = property["property_name"]
+    limiter = get_rate_limiter(f"ga4_{property_id}", rate=configs.get("rate_limit", 1))
+    token_quotas = {**TOKEN_QUOTAS, **configs.get("token_quotas", {})}
+
+    request = RunReportRequest(
+        property=f"properties/{property_id}",
+        dimensions=[Dimension(name=dimension) for dimension in configs["dimensions"]],
+        metrics=[Metric(name=metric) for metric in configs["metrics"]],
+        date_ranges=[DateRange(start_date=str(property["start_date"]), end_date=str(property["end_date"]))],
+    )
+    pages = (
+        ga4_response_to_df(response, property["account_id"], property["account_name"], property_id, property_name)
+        for response in iter_report_pages(client, request, limiter=limiter, token_quotas=token_quotas)
+    )
+
+    GA4_FILENAME = f"initial-load-{property_id}.csv"
+    rows = save_report_csv(GA4_FILENAME, pages)
+    print(f"Saved {rows} rows to {GA4_FILENAME}")
+    return rows, time.perf_counter() - start
+
+
+def run_report(config_file="configs/properties.yml"):
+    configs = load_file(config_file)
+
+    # Using a default constructor instructs the client to use the credentials
+    # specified in GOOGLE_APPLICATION_CREDENTIALS environment variable.
+    # One client is shared by every property, it is safe to use from several threads.
+    os.environ.setdefault("GOOGLE_APPLICATION_CREDENTIALS", configs["credentials_file"])
+    client = BetaAnalyticsDataClient()
+
+    start = time.perf_counter()
+    failures = []
+    with ThreadPoolExecutor(max_workers=configs.get("max_workers", 4)) as executor:
+        futures = {
+            executor.submit(fetch_property, client, property, configs): property["property_name"]
+            for property in configs["properties"]
+        }
+        for future in as_completed(futures):
+            property_name = futures[future]
+            try:
+                rows, seconds = future.result()
+                print(f"{property_name}: {rows} rows in {seconds:.1f} seconds")
+            except Exception as e:
+                print(f"Failed {property_name}: {e}")
+                failures.append(property_name)
+    print(f"Fetched {len(futures)} properties in {time.perf_counter() - start:.1f} seconds")
+    if failures:
+        raise RuntimeError(f"GA4 report failed for {failures}")
 
 
 if __name__ == "__main__":
-    run_report()
+    parser = argparse.ArgumentParser(description="GA4 reports")
+    parser.add_argument("--config_file", type=str, default="configs/properties.yml")
+    args, _ = parser.parse_known_args()
+    run_report(args.config_file)
 
 # TODO Add log
\ No newline at end of file
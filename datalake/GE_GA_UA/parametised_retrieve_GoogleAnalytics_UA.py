@@ -1,9 +1,14 @@
 from apiclient.discovery import build
 from oauth2client.service_account import ServiceAccountCredentials
 from datetime import date, timedelta
-import time
 import utils
 import os
+import sys
+
+sys.path.append("../utils")
+
+from watermark import get_watermark_store
+from reporting import PAGE_SIZE, batch_get, is_golden, iter_daily_responses
 
 from typing import Union, Dict, List, Any
 
@@ -27,10 +32,11 @@ def initialize_analyticsreporting():
 
 def build_query(view_id: str, start_date: str, end_date: str, config: dict) -> Dict[Any, Any]:
     query = {
-        "viewID": view_id,
+        "viewId": view_id,
         'dateRanges': [{'startDate': start_date, 'endDate': end_date}],
         'metrics': [],
-        'dimensions': []
+        'dimensions': [],
+        'pageSize': PAGE_SIZE
     }
     for metric in config['metrics']:
         query['metrics'].append({"expression": metric})
@@ -55,11 +61,7 @@ def get_report(analytics, view: str, start_date: str, end_date: str, config: dic
 
     query = build_query(view_id=view,start_date=start_date_str,end_date=end_date_str,config=config)
 
-    return analytics.reports().batchGet(
-        body={
-            'reportRequests': [query]
-        }
-    ).execute()
+    return {'reports': batch_get(analytics, [query])}
 
 
 def print_response(response):
@@ -91,7 +93,7 @@ def main():
 
     config = utils.load_file("configs/users.yml")
     view_ids = config['view_ids']
-    m_start_date = date(2021, 11, 24)  # FIXED
+    watermarks = get_watermark_store("ga_ua", config.get("watermark"))
     m_end_date = date.today()  # TODAY
 
     for view in view_ids:
@@ -99,14 +101,24 @@ def main():
         if not os.path.exists(folder):
             os.makedirs(folder)
 
-        for m_single_date in utils.daterange(m_start_date, m_end_date):
-            print(f'View {view}. Running {m_single_date.strftime("%Y-%m-%d")}')
-            response = get_report(analytics, view, m_single_date)
+        # resume the day after the last saved file, less the days that may still change
+        m_start_date = date.fromisoformat(
+            watermarks.start_date(view, "users", str(config.get("start_date", "2021-11-24")),
+                                  int(config.get("lookback_days", 1)))
+        )
+        responses = iter_daily_responses(analytics, str(view), m_start_date, m_end_date,
+                                         config['metrics'], config['dimensions'],
+                                         days_per_request=config.get("days_per_request", 30))
+        golden = True
+        for m_single_date, response in responses:
             next_day = m_single_date + timedelta(days=1)
             filename_analytics = f"{folder}/{next_day}-{view}"
             utils.save_json_file(filename_analytics + ".json", response)
+            # a day that is not golden yet is requested again by the next run
+            golden = golden and is_golden(response)
+            if golden:
+                watermarks.set(view, "users", m_single_date)
             #print_response(response)
-            time.sleep(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,168 @@
+"""Batched Reporting API v4 requests, split back into one response per day"""
+from datetime import timedelta
+import time
+
+# Reporting API v4 limits: 5 reportRequests per batchGet, and the requests of a batch
+# must share the same viewId and dateRanges
+MAX_REPORT_REQUESTS = 5
+# largest page the api returns, the default is 1000 rows
+PAGE_SIZE = 100000
+DATE_DIMENSION = 'ga:date'
+
+
+def build_request(view, start_date, end_date, metrics, dimensions):
+    """Builds one report request for a view and an inclusive date range"""
+    return {
+        'viewId': str(view),
+        'dateRanges': [{'startDate': start_date.strftime("%Y-%m-%d"), 'endDate': end_date.strftime("%Y-%m-%d")}],
+        'metrics': [{'expression': metric} for metric in metrics],
+        'dimensions': [{'name': dimension} for dimension in dimensions],
+        'pageSize': PAGE_SIZE,
+    }
+
+
+def batch_get(analytics, requests, stop_paging=None):
+    """Runs up to MAX_REPORT_REQUESTS requests in one batchGet, following nextPageToken.
+
+    Args:
+      analytics: An authorized Analytics Reporting API V4 service object.
+      requests: report requests sharing the same viewId and dateRanges.
+      stop_paging: optional check of the first page of a report, the report is not
+        paged further when it returns True e.g is_sampled.
+    Returns:
+      The reports in the order of the requests, each with the rows of all its pages.
+    """
+    if len(requests) > MAX_REPORT_REQUESTS:
+        raise ValueError(f"batchGet accepts at most {MAX_REPORT_REQUESTS} report requests")
+    reports = [None] * len(requests)
+    rows = [[] for _ in requests]
+    pending = list(range(len(requests)))
+    page_tokens = {}
+    while pending:
+        body = [dict(requests[i], pageToken=page_tokens[i]) if i in page_tokens else requests[i] for i in pending]
+        response = analytics.reports().batchGet(body={'reportRequests': body}).execute()
+        next_pending = []
+        for i, report in zip(pending, response.get('reports', [])):
+            reports[i] = reports[i] or report
+            rows[i].extend(report.get('data', {}).get('rows', []))
+            if stop_paging and i not in page_tokens and stop_paging(report):
+                continue
+            if report.get('nextPageToken'):
+                page_tokens[i] = report['nextPageToken']
+                next_pending.append(i)
+        pending = next_pending
+
+    for i, report in enumerate(reports):
+        report = {key: value for key, value in report.items() if key != 'nextPageToken'}
+        report['data'] = dict(report.get('data', {}), rows=rows[i], rowCount=len(rows[i]))
+        reports[i] = report
+    return reports
+
+
+def is_sampled(report):
+    """Checks if the api answered the report from a sample of the sessions"""
+    data = report.get('data', {})
+    return bool(data.get('samplesReadCounts') or data.get('samplingSpaceSizes'))
+
+
+def is_golden(response):
+    """Checks if the api will not change the reports of a response anymore, the api
+    leaves isDataGolden out when it is false"""
+    reports = response.get('reports', [])
+    return bool(reports) and all(report.get('data', {}).get('isDataGolden') for report in reports)
+
+
+def get_unsampled_reports(analytics, view, start_date, end_date, metrics, dimensions):
+    """Requests a date range, splitting it in halves until the reports are unsampled.
+
+    Args:
+      analytics: An authorized Analytics Reporting API V4 service object.
+      view: View ID.
+      start_date: first date.
+      end_date: last date, included.
+      metrics: metric expressions e.g ga:users.
+      dimensions: dimension names.
+    Returns:
+      list of (start_date, end_date, report) covering the range in order. A single
+      day that is still sampled is kept as is.
+    """
+    request = build_request(view, start_date, end_date, metrics, dimensions)
+    # a sampled range is split anyway, so its other pages are not requested
+    stop_paging = is_sampled if start_date != end_date else None
+    report = batch_get(analytics, [request], stop_paging=stop_paging)[0]
+    if not is_sampled(report):
+        return [(start_date, end_date, report)]
+    if start_date == end_date:
+        print(f'View {view}. {start_date.strftime("%Y-%m-%d")} is sampled even for a single day')
+        return [(start_date, end_date, report)]
+
+    middle = start_date + timedelta(days=(end_date - start_date).days // 2)
+    print(f'View {view}. Sampled data, splitting at {middle.strftime("%Y-%m-%d")}')
+    return (get_unsampled_reports(analytics, view, start_date, middle, metrics, dimensions)
+            + get_unsampled_reports(analytics, view, middle + timedelta(days=1), end_date, metrics, dimensions))
+
+
+def split_by_date(report, days, drop_date=False):
+    """Splits a multi-day report into one batchGet-like response per day.
+
+    The totals, minimums and maximums of the range can not be split per day and are
+    left out of the daily responses.
+
+    Args:
+      report: report whose dimensions include ga:date.
+      days: the days of the range, each gets a response even without rows.
+      drop_date: remove the ga:date dimension, when it was only added for splitting.
+    Returns:
+      dict of day -> {'reports': [report of the day]}
+    """
+    column_header = report.get('columnHeader', {})
+    dimension_headers = column_header.get('dimensions', [])
+    index = dimension_headers.index(DATE_DIMENSION)
+    if drop_date:
+        column_header = dict(column_header, dimensions=[d for i, d in enumerate(dimension_headers) if i != index])
+
+    rows_by_day = {day.strftime("%Y%m%d"): [] for day in days}
+    for row in report.get('data', {}).get('rows', []):
+        dimensions = row['dimensions']
+        if drop_date:
+            row = dict(row, dimensions=dimensions[:index] + dimensions[index + 1:])
+        rows_by_day.setdefault(dimensions[index], []).append(row)
+
+    data = {key: value for key, value in report.get('data', {}).items() if key in ['isDataGolden', 'samplesReadCounts', 'samplingSpaceSizes']}
+    responses = {}
+    for day in days:
+        rows = rows_by_day[day.strftime("%Y%m%d")]
+        day_data = dict(data, rows=rows, rowCount=len(rows)) if rows else dict(data)
+        responses[day] = {'reports': [{'columnHeader': column_header, 'data': day_data}]}
+    return responses
+
+
+def iter_daily_responses(analytics, view, start_date, end_date, metrics, dimensions, days_per_request=30, pause=1):
+    """Yields (day, response) for every day from start_date to end_date (excluded), in
+    order, requesting days_per_request days per call instead of one call per day.
+
+    Args:
+      analytics: An authorized Analytics Reporting API V4 service object.
+      view: View ID.
+      start_date: first date.
+      end_date: date after the last one, like utils.daterange.
+      metrics: metric expressions e.g ga:users.
+      dimensions: dimension names, ga:date is added for the split when missing.
+      days_per_request: days covered by one request, halved while the data is sampled.
+      pause: seconds to wait between calls.
+    """
+    drop_date = DATE_DIMENSION not in dimensions
+    dimensions = [DATE_DIMENSION, *dimensions] if drop_date else list(dimensions)
+    chunk_start = start_date
+    while chunk_start < end_date:
+        chunk_end = min(chunk_start + timedelta(days=days_per_request), end_date)
+        days = [chunk_start + timedelta(n) for n in range((chunk_end - chunk_start).days)]
+        print(f'View {view}. Running {days[0].strftime("%Y-%m-%d")} - {days[-1].strftime("%Y-%m-%d")}')
+        for first_day, last_day, report in get_unsampled_reports(analytics, view, days[0], days[-1], metrics, dimensions):
+            report_days = [day for day in days if first_day <= day <= last_day]
+            responses = split_by_date(report, report_days, drop_date=drop_date)
+            for day in report_days:
+                yield day, responses[day]
+        chunk_start = chunk_end
+        if pause and chunk_start < end_date:
+            time.sleep(pause)
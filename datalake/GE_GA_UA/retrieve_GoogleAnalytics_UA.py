@@ -1,12 +1,25 @@
 from apiclient.discovery import build
 from oauth2client.service_account import ServiceAccountCredentials
 from datetime import date, timedelta
-import time
 import utils
 import os
+import sys
+
+sys.path.append("../utils")
+
+from watermark import get_watermark_store
+from reporting import batch_get, build_request, is_golden, iter_daily_responses
 
 SCOPES = ['https://www.googleapis.com/auth/analytics.readonly']
 KEY_FILE_LOCATION = 'plucky-dryad-381507-62fe588e0fec.json'
+# days covered by one request, the rows are split back into one file per day
+DAYS_PER_REQUEST = 30
+# days before the watermark requested again, recent data may still change
+LOOKBACK_DAYS = 1
+
+METRICS = ['ga:users', 'ga:sessions', 'ga:pageViews', 'ga:newusers', 'ga:bounces', 'ga:avgSessionDuration']
+DIMENSIONS = ['ga:date', 'ga:medium', 'ga:source', 'ga:deviceCategory', 'ga:country',
+              'ga:mobileDeviceModel', 'ga:deviceCategory', 'ga:mobileDeviceBranding']
 
 
 def initialize_analyticsreporting():
@@ -35,32 +48,7 @@ def get_report(analytics, view, single_date):
       The Analytics Reporting API V4 response.
     """
 
-    single_date_str = single_date.strftime("%Y-%m-%d")
-
-    return analytics.reports().batchGet(
-        body={
-            'reportRequests': [{
-                'viewId': view,
-                'dateRanges': [{'startDate': single_date_str, 'endDate': single_date_str}],
-                'metrics': [{'expression': 'ga:users'},
-                            {'expression': 'ga:sessions'},
-                            {'expression': 'ga:pageViews'},
-                            {'expression': 'ga:newusers'},
-                            {'expression': 'ga:bounces'},
-                            {'expression': 'ga:avgSessionDuration'}
-                            ],
-                'dimensions': [{'name': 'ga:date'},
-                               {'name': 'ga:medium'},
-                               {'name': 'ga:source'},
-                               {'name': 'ga:deviceCategory'},
-                               {'name': 'ga:country'},
-                               {'name': 'ga:mobileDeviceModel'},
-                               {'name': 'ga:deviceCategory'},
-                               {'name': 'ga:mobileDeviceBranding'}
-                               ]
-            }]
-        }
-    ).execute()
+    return {'reports': batch_get(analytics, [build_request(view, single_date, single_date, METRICS, DIMENSIONS)])}
 
 
 def print_response(response):
@@ -91,7 +79,7 @@ def main():
     analytics = initialize_analyticsreporting()
 
     views = ['198411294']  # FIXED
-    m_start_date = date(2021, 11, 24)  # FIXED
+    watermarks = get_watermark_store("ga_ua")
     m_end_date = date.today()  # TODAY
 
     for view in views:
@@ -99,14 +87,20 @@ def main():
         if not os.path.exists(folder):
             os.makedirs(folder)
 
-        for m_single_date in utils.daterange(m_start_date, m_end_date):
-            print(f'View {view}. Running {m_single_date.strftime("%Y-%m-%d")}')
-            response = get_report(analytics, view, m_single_date)
+        # resume the day after the last saved file
+        m_start_date = date.fromisoformat(watermarks.start_date(view, "report", "2021-11-24", LOOKBACK_DAYS))
+        responses = iter_daily_responses(analytics, view, m_start_date, m_end_date, METRICS, DIMENSIONS,
+                                         days_per_request=DAYS_PER_REQUEST)
+        golden = True
+        for m_single_date, response in responses:
             next_day = m_single_date + timedelta(days=1)
             filename_analytics = f"{folder}/{next_day}-{view}"
             utils.save_json_file(filename_analytics + ".json", response)
+            # a day that is not golden yet is requested again by the next run
+            golden = golden and is_golden(response)
+            if golden:
+                watermarks.set(view, "report", m_single_date)
             #print_response(response)
-            time.sleep(1)
 
 
 if __name__ == '__main__':
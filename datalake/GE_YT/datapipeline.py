@@ -10,6 +10,7 @@ from GE_YT.reader import YouTubeAPIAuthenticator, YouTubeReader
 from GE_YT.writer import YouTubeWriter
 
 from utils.file_handlers import load_file
+from utils.watermark import get_watermark_store
 
 
 def main():
@@ -36,8 +37,19 @@ def main():
         # "source_stats": configs["source_stats"],
     }
 
+    azure_configs = {
+        "storage_account": storage_account,
+        "overwrite": True,
+        "auth_method": "sas_token",
+        "upload_workers": 8,
+    }
+    watermark_configs = configs.get("watermark", {})
+    if watermark_configs.get("backend") == "azure":
+        watermark_configs = {**azure_configs, "container": container, **watermark_configs}
+    watermarks = get_watermark_store("youtube", watermark_configs)
+
     youtube_authenticator = YouTubeAPIAuthenticator(creds_file=secrets_file)
-    reader = YouTubeReader(authenticator=youtube_authenticator)
+    reader = YouTubeReader(authenticator=youtube_authenticator, watermarks=watermarks)
     local_writer = YouTubeWriter(    # noqa F841
         container="./data",
         destination="local_json",
@@ -47,11 +59,7 @@ def main():
     azure_writer = YouTubeWriter(
         container=container,
         destination="azure_json",
-        configs={
-            "storage_account": storage_account,
-            "overwrite": True,
-            "auth_method": "sas_token",
-        },
+        configs=azure_configs,
         clear_destination=False,
     )
 
@@ -71,22 +79,32 @@ def main():
     #     endpoint = result["endpoint"]
     #     # azure_writer.sink(payload=result, folder_name=endpoint, folder_path=folder_path)
 
-    for video in reader.get_videos(
-        configs=configs["video_stats"], endpoint="video_stats"
-    ):
-        azure_writer.sink(
-            payload=video, folder_name="videos", folder_path="channels", indent=None
-        )
-
-    for video in reader.get_videos(
-        configs=configs["traffic_source"], endpoint="traffic_source"
-    ):
-        azure_writer.sink(
-            payload=video,
-            folder_name="insightTrafficSourceType",
-            folder_path="breakdowns",
-            indent=None,
-        )
+    try:
+        for video in reader.get_videos(
+            configs=configs["video_stats"], endpoint="video_stats"
+        ):
+            azure_writer.sink(
+                payload=video, folder_name="videos", folder_path="channels", indent=None
+            )
+        azure_writer.flush()
+        watermarks.commit()
+
+        for video in reader.get_videos(
+            configs=configs["traffic_source"], endpoint="traffic_source"
+        ):
+            azure_writer.sink(
+                payload=video,
+                folder_name="insightTrafficSourceType",
+                folder_path="breakdowns",
+                indent=None,
+            )
+    except Exception:
+        # keep the channels finished before the failure, the next run resumes after them
+        azure_writer.flush()
+        watermarks.commit()
+        raise
+    azure_writer.close()
+    watermarks.commit()
 
 
 if __name__ == "__main__":
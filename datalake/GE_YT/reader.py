@@ -3,19 +3,26 @@
 # pylint: disable=unused-import
 import sys
 import os
-from typing import Generator, Any, Dict
+import threading
+from itertools import chain
+from typing import Generator, Any, Dict, List, Tuple, Union
 
 sys.path.append("../")
 
 
+import httplib2
 from googleapiclient.discovery import build
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.errors import HttpError
 
 from utils.file_handlers import load_file
 from utils.date_handlers import string_to_date, date_iterator
 from utils.quota_handler import retry_handler, api_handler
+from utils.rate_limiter import get_rate_limiter
+from utils.concurrency import ordered_map
+from utils.watermark import WatermarkStore
 
 
 class YouTubeException(Exception):
@@ -35,6 +42,7 @@ class YouTubeAPIAuthenticator:
 
     def __init__(self, creds_file: str):
         self.creds = load_file(creds_file)
+        self.local = threading.local()
         self.youtube = self.get_youtube_service()
         self.youtube_analytics = self.get_youtube_analytics_service()
 
@@ -71,12 +79,27 @@ class YouTubeAPIAuthenticator:
                 print("CREDENTIALS ARE EMPTY")
         return credentials
 
+    def get_http(self) -> AuthorizedHttp:
+        """method to get an authorized http transport for the current thread"""
+        # httplib2 is not thread safe so every worker thread gets its own transport
+        if getattr(self.local, "http", None) is None:
+            self.local.http = AuthorizedHttp(
+                self.refresh_credentials(), http=httplib2.Http()
+            )
+        return self.local.http
+
 
 class YouTubeReader:
     """class to read data from youtube"""
 
-    def __init__(self, authenticator: YouTubeAPIAuthenticator, env="dev"):
+    def __init__(
+        self,
+        authenticator: YouTubeAPIAuthenticator,
+        env="dev",
+        watermarks: Union[WatermarkStore, None] = None,
+    ):
         self.authenticator = authenticator
+        self.watermarks = watermarks
         self.channels: list = []
         self.videos: list = []
         self.channel_videos: dict = {}
@@ -114,7 +137,7 @@ class YouTubeReader:
     @retry_handler(
         exceptions=UncapturedError, initial_wait=3, total_tries=3, backoff_factor=2
     )
-    @api_handler(wait=1, backoff_factor=2)
+    @api_handler(limiter="youtube_analytics")
     def get_stats(
         self, ids: str, endpoint: str, startdate: str, enddate: str, configs: dict
     ) -> dict:
@@ -129,12 +152,15 @@ class YouTubeReader:
             )
             request = self.authenticator.youtube_analytics.reports().query(**params)
 
-            results: dict = request.execute()
+            results: dict = request.execute(http=self.authenticator.get_http())
             # print(f"length of {endpoint } results: {len(results)}")
 
             return results
         except HttpError as err:
             if err.resp.status in [429]:
+                get_rate_limiter("youtube_analytics").penalize(
+                    retry_after=err.resp.get("retry-after")
+                )
                 raise QuotaLimitError(err.reason) from err
         except Exception as err:
             raise UncapturedError(err) from err
@@ -154,7 +180,7 @@ class YouTubeReader:
     def __unpack_video(self, video_obj, config_dict: dict):
         """method to unpack video object"""
         video_id = video_obj["snippet"]["resourceId"]["videoId"]
-        config_dict.update({"filters": video_id})
+        config_dict = dict(config_dict, filters=video_id)
         return {
             "video_id": video_id,
             "video_name": video_obj["snippet"]["title"],
@@ -203,72 +229,317 @@ class YouTubeReader:
         self.channel_videos.setdefault(channel_name, []).extend(channel_videos)
         return channel_videos
 
-    def get_videos(
-        self, configs: dict, endpoint: str
-    ) -> Generator[Dict[Any, Any], None, None]:
-        """method to get video stats"""
-        start_date = configs.pop("start_date", "2_days_ago")
-        end_date = configs.pop("end_date", "1_day_ago")
-        interval = configs.pop("interval", "1_day")
+    @staticmethod
+    def date_windows(
+        start_date: str, end_date: str, interval: str, range_fetch: bool = False
+    ) -> List[Tuple[str, str]]:
+        """method to get the (start, end) date windows to query
 
-        for channel in self.channels:
-            channel_name = channel["channel_name"]
-            videos = self.channel_videos[channel_name]
-            for start_date, end_date in date_iterator(
+        With range_fetch the whole start_date..end_date span is a single window.
+        """
+        windows = list(
+            date_iterator(
                 start_date=start_date,
                 end_date=end_date,
                 interval=interval,
                 end_inclusive=True,
                 time_format="%Y-%m-%d",
-            ):
+            )
+        )
+        if range_fetch and windows:
+            return [(windows[0][0], windows[-1][1])]
+        return windows
+
+    def channel_start_dates(
+        self, endpoint: str, start_date: str, configs: dict
+    ) -> Dict[str, str]:
+        """method to get the start date of each channel
+
+        With `incremental` in the configs and a watermark store, a channel starts the
+        day after its watermark (less `lookback_days`) and start_date is only used for
+        channels without one.
+        """
+        incremental = bool(configs.pop("incremental", False))
+        lookback_days = int(configs.pop("lookback_days", 0))
+        if not (incremental and self.watermarks):
+            return {channel["channel_id"]: start_date for channel in self.channels}
+        return {
+            channel["channel_id"]: self.watermarks.start_date(
+                channel["channel_id"], endpoint, start_date, lookback_days
+            )
+            for channel in self.channels
+        }
+
+    def mark_done(self, channel_id: str, endpoint: str, end_date: str) -> None:
+        """method to stage the watermark of a channel once its payloads were yielded"""
+        if self.watermarks:
+            last_day = string_to_date(end_date).strftime("%Y-%m-%d")
+            self.watermarks.set(channel_id, endpoint, last_day, commit=False)
+
+    def __video_tasks(
+        self,
+        configs: dict,
+        endpoint: str,
+        windows: Dict[str, List[Tuple[str, str]]],
+        batch_size: int = 1,
+    ) -> Generator[tuple, None, None]:
+        """method to generate the (channel, videos, date window) calls to make"""
+        for channel in self.channels:
+            channel_name = channel["channel_name"]
+            videos = self.channel_videos[channel_name]
+            for startdate, enddate in windows[channel["channel_id"]]:
+                if batch_size > 1:
+                    for index in range(0, len(videos), batch_size):
+                        batch = [
+                            self.__unpack_video(video, configs)
+                            for video in videos[index : index + batch_size]
+                        ]
+                        yield channel, batch, endpoint, startdate, enddate, configs
+                    continue
                 for video in videos:
                     video = self.__unpack_video(video, configs)
-                    metadata = {
-                        "channelId": channel["channel_id"],
-                        "videoId": video["video_id"],
-                    }
-                    result = self.get_stats(
-                        endpoint=endpoint,
-                        ids=channel["channel_id"],
-                        startdate=start_date,
-                        enddate=end_date,
-                        configs=video["video_config"],
+                    yield channel, video, endpoint, startdate, enddate
+
+    @staticmethod
+    def split_rows(
+        result: dict,
+        dimension: str,
+        values: Union[List[str], None] = None,
+        drop: bool = True,
+    ) -> Dict[str, Dict[Any, Any]]:
+        """method to split a response into one response per value of a dimension
+
+        Args:
+            result (dict): analytics response having columnHeaders and rows
+            dimension (str): dimension column to split the rows by e.g video, day
+            values (Union[List[str], None], optional): values that always get a part,
+                with empty rows when the response has none for them.
+            drop (bool, optional): remove the dimension column from the parts.
+        Returns:
+            Dict[str, Dict[Any, Any]]: dimension value mapped to its response
+        """
+        headers: list = result.get("columnHeaders", [])
+        index = [header["name"] for header in headers].index(dimension)
+        keep = [pos for pos in range(len(headers)) if not (drop and pos == index)]
+        base = {k: v for k, v in result.items() if k not in ["columnHeaders", "rows"]}
+
+        parts: Dict[str, List[Any]] = {value: [] for value in values or []}
+        for row in result.get("rows") or []:
+            parts.setdefault(row[index], []).append([row[pos] for pos in keep])
+        return {
+            value: dict(base, columnHeaders=[headers[pos] for pos in keep], rows=rows)
+            for value, rows in parts.items()
+        }
+
+    def split_days(
+        self, payload: Dict[Any, Any], days: List[str], drop: bool = True
+    ) -> List[Dict[Any, Any]]:
+        """method to split a multi day payload into one payload per day
+
+        Args:
+            payload (Dict[Any, Any]): payload whose data was queried with the day dimension
+            days (List[str]): days of the queried range, each gets a payload
+            drop (bool, optional): remove the day column, when it was not configured.
+        Returns:
+            List[Dict[Any, Any]]: payloads dated by day, in the order of days
+        """
+        data = payload["data"]
+        metadata = {k: v for k, v in data.items() if k not in ["columnHeaders", "rows"]}
+        parts = self.split_rows(data, dimension="day", values=days, drop=drop)
+        return [
+            dict(payload, data=dict(parts[day], **metadata), date=day) for day in days
+        ]
+
+    def fetch_video_batch(
+        self,
+        channel: dict,
+        videos: List[dict],
+        endpoint: str,
+        startdate: str,
+        enddate: str,
+        configs: dict,
+    ) -> List[Dict[Any, Any]]:
+        """method to fetch the stats of many videos with a single video dimension query
+
+        The combined response is split back into one payload per video shaped like
+        the per video query so YouTubeWriter writes the same files.
+        """
+        video_ids = [video["video_id"] for video in videos]
+        page_size = int(configs.get("maxResults", 200))
+        batch_configs = dict(
+            configs,
+            filters=",".join(video_ids),
+            dimensions=["video", *configs["dimensions"]],
+            maxResults=page_size,
+            startIndex=1,
+        )
+        result: dict = {}
+        rows: List[Any] = []
+        while True:
+            result = self.get_stats(
+                endpoint=endpoint,
+                ids=channel["channel_id"],
+                startdate=startdate,
+                enddate=enddate,
+                configs=batch_configs,
+            )
+            page_rows = result.get("rows") or []
+            rows.extend(page_rows)
+            if len(page_rows) < page_size:
+                break
+            batch_configs["startIndex"] += page_size
+        result["rows"] = rows
+
+        parts = self.split_rows(result, dimension="video", values=video_ids)
+
+        payloads: List[Dict[Any, Any]] = []
+        for video in videos:
+            data = parts[video["video_id"]]
+            data.update({"channelId": channel["channel_id"], "videoId": video["video_id"]})
+            payloads.append(
+                {
+                    "data": data,
+                    "date": startdate,
+                    "channel_data": channel,
+                    "file_suffix": f"-{video['video_id']}",
+                }
+            )
+        return payloads
+
+    def fetch_video_stats(
+        self, channel: dict, video: dict, endpoint: str, startdate: str, enddate: str
+    ) -> Dict[Any, Any]:
+        """method to fetch the stats of a single video"""
+        metadata = {
+            "channelId": channel["channel_id"],
+            "videoId": video["video_id"],
+        }
+        result = self.get_stats(
+            endpoint=endpoint,
+            ids=channel["channel_id"],
+            startdate=startdate,
+            enddate=enddate,
+            configs=video["video_config"],
+        )
+        result.update(metadata)
+        return {
+            "data": result,
+            "date": startdate,
+            "channel_data": channel,
+            "file_suffix": f"-{video['video_id']}",
+        }
+
+    def get_videos(
+        self, configs: dict, endpoint: str
+    ) -> Generator[Dict[Any, Any], None, None]:
+        """method to get video stats
+
+        `workers` in the configs sets how many videos are fetched concurrently and
+        `rate_limit` the maximum number of requests per second shared by the workers.
+        `batch_size` (up to 500) queries that many videos per call using the video
+        dimension instead of one call per video.
+        `range_fetch` queries the whole start_date..end_date span at once with the day
+        dimension and splits the rows back into one payload per day.
+        `incremental` starts each channel after its watermark, see channel_start_dates.
+        Payloads are yielded in the same order as the serial run.
+        """
+        start_date = configs.pop("start_date", "2_days_ago")
+        end_date = configs.pop("end_date", "1_day_ago")
+        interval = configs.pop("interval", "1_day")
+        workers = int(configs.pop("workers", 1))
+        batch_size = min(int(configs.pop("batch_size", 1)), 500)
+        range_fetch = bool(configs.pop("range_fetch", False))
+        if rate_limit := configs.pop("rate_limit", None):
+            get_rate_limiter("youtube_analytics", rate=rate_limit)
+
+        start_dates = self.channel_start_dates(endpoint, start_date, configs)
+        windows = {
+            channel_id: self.date_windows(start, end_date, interval, range_fetch)
+            for channel_id, start in start_dates.items()
+        }
+        drop_day = "day" not in configs["dimensions"]
+        if range_fetch and drop_day:
+            configs = dict(configs, dimensions=[*configs["dimensions"], "day"])
+
+        tasks = self.__video_tasks(configs, endpoint, windows, batch_size=batch_size)
+        if batch_size > 1:
+            batches = ordered_map(self.fetch_video_batch, tasks, workers=workers)
+            payloads = chain.from_iterable(batches)
+        else:
+            payloads = ordered_map(self.fetch_video_stats, tasks, workers=workers)
+
+        done: Union[str, None] = None
+        days: Dict[str, List[str]] = {}
+        for payload in payloads:
+            channel_id = payload["channel_data"]["channel_id"]
+            if done not in [None, channel_id]:
+                self.mark_done(done, endpoint, end_date)
+            done = channel_id
+            if not range_fetch:
+                yield payload
+                continue
+            if channel_id not in days:
+                days[channel_id] = [
+                    day
+                    for day, _ in self.date_windows(
+                        start_dates[channel_id], end_date, "1_day"
                     )
-                    result.update(metadata)
-                    yield {
-                        "data": result,
-                        "date": start_date,
-                        "channel_data": channel,
-                        "file_suffix": f"-{video['video_id']}",
-                    }
+                ]
+            yield from self.split_days(payload, days[channel_id], drop=drop_day)
+        for channel_id, channel_windows in windows.items():
+            if channel_windows:
+                self.mark_done(channel_id, endpoint, end_date)
 
     def get_other_stats(self, configs: dict) -> Generator[Dict[Any, Any], None, None]:
-        """method to get other stats"""
+        """method to get other stats
+
+        Supports the same `range_fetch` and `incremental` configs as get_videos.
+        """
+        endpoints: Dict[str, Tuple[dict, Dict[str, str], str, str, bool, bool]] = {}
+        for endpoint, config in configs.items():
+            start_date = config.pop("start_date", "2_days_ago")
+            end_date = config.pop("end_date", "1_day_ago")
+            interval = config.pop("interval", "1_day")
+            range_fetch = bool(config.pop("range_fetch", False))
+            start_dates = self.channel_start_dates(endpoint, start_date, config)
+            drop_day = "day" not in config["dimensions"]
+            if range_fetch and drop_day:
+                config = dict(config, dimensions=[*config["dimensions"], "day"])
+            endpoints[endpoint] = (
+                config, start_dates, end_date, interval, range_fetch, drop_day
+            )
+
         for channel in self.channels:
-            for endpoint, config in configs.items():
-                start_date = config.pop("start_date", "2_days_ago")
-                end_date = config.pop("end_date", "1_day_ago")
-                interval = config.pop("interval", "1_day")
-                for start_date, end_date in date_iterator(
-                    start_date=start_date,
-                    end_date=end_date,
-                    interval=interval,
-                    end_inclusive=True,
-                    time_format="%Y-%m-%d",
-                ):
+            channel_id = channel["channel_id"]
+            for endpoint, endpoint_configs in endpoints.items():
+                config, start_dates, end_date, interval, range_fetch, drop_day = (
+                    endpoint_configs
+                )
+                start_date = start_dates[channel_id]
+                windows = self.date_windows(start_date, end_date, interval, range_fetch)
+                days = [
+                    day for day, _ in self.date_windows(start_date, end_date, "1_day")
+                ]
+                for startdate, enddate in windows:
                     result = self.get_stats(
                         endpoint=endpoint,
                         ids=channel["channel_id"],
-                        startdate=start_date,
-                        enddate=end_date,
+                        startdate=startdate,
+                        enddate=enddate,
                         configs=config,
                     )
-                    yield {
+                    payload = {
                         "data": result,
-                        "date": start_date,
+                        "date": startdate,
                         "channel_data": channel,
                         "endpoint": endpoint,
                     }
+                    if not range_fetch:
+                        yield payload
+                        continue
+                    yield from self.split_days(payload, days, drop=drop_day)
+                if windows:
+                    self.mark_done(channel_id, endpoint, end_date)
 
     def get_channel_videos(self):
         """method to get back channel videos"""
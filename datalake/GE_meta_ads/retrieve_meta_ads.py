@@ -4,6 +4,11 @@ from configparser import ConfigParser
 from datetime import date, timedelta, datetime
 import utils
 import os
+import sys
+
+sys.path.append("../utils")
+
+from watermark import get_watermark_store
 
 # Obtain credentials #
 parser = ConfigParser()
@@ -32,6 +37,12 @@ for section in sections_account:
     account_id = accounts[section]["account_id"]
     accounts[account_id] = accounts.pop(section)  # rename key
     accounts[account_id]["ad_account"] = AdAccount(account_id)  # Create AdAccount
+
+# Watermarks: last date fully retrieved per account and level
+watermark_configs = dict(parser.items("WATERMARK")) if parser.has_section("WATERMARK") else {}
+# days before the watermark retrieved again, Meta attribution revises recent days
+LOOKBACK_DAYS = int(watermark_configs.pop("lookback_days", 7))
+watermarks = get_watermark_store("meta_ads", watermark_configs)
 #
 ###########################
 
@@ -42,6 +53,8 @@ def run_ad_level(single_date):
     request_date = end_date + timedelta(days=1)
     breakdowns = ['age', 'gender', 'country', 'region', 'publisher_platform', 'impression_device'] #['region', 'device_platform', 'impression_device', 'age', 'gender', 'publisher_platform', 'country']
     for my_account in accounts.values():
+        if watermarks.is_done(my_account["account_id"], "ads", end_date, LOOKBACK_DAYS):
+            continue
         for breakdown in breakdowns:
             insights_data = []
 
@@ -91,6 +104,7 @@ def run_ad_level(single_date):
                 os.makedirs(folder)
             filename = f"{folder}/{request_date}-facebook-{my_account['account_id']}-ads-{breakdown.lower()}.json"
             utils.save_json_file(filename=filename, json_content=insights_data)
+        watermarks.set(my_account["account_id"], "ads", end_date)
 
 
 def run_reach(single_date, level):
@@ -100,6 +114,8 @@ def run_reach(single_date, level):
     breakdowns = ['age', 'gender', 'country', 'region', 'publisher_platform', 'impression_device'] #['region', 'device_platform', 'impression_device', 'age', 'gender', 'publisher_platform', 'country']
 
     for my_account in accounts.values():
+        if watermarks.is_done(my_account["account_id"], f"{level}s", end_date, LOOKBACK_DAYS):
+            continue
         for breakdown in breakdowns:
             insights_data = []
             start_date = my_account["start_date"]
@@ -141,24 +157,38 @@ def run_reach(single_date, level):
                 os.makedirs(folder)
             filename = f"{folder}/{request_date}-facebook-{my_account['account_id']}-{level}s-{breakdown.lower()}.json"
             utils.save_json_file(filename=filename, json_content=insights_data)
+        watermarks.set(my_account["account_id"], f"{level}s", end_date)
 
 
 if __name__ == '__main__':
-    FILENAME_BACKUP = "ultima_fecha.txt"
+    FILENAME_BACKUP = "ultima_fecha.txt"  # replaced by the watermarks
+    LEVELS = ["ads", "adsets", "campaigns"]
 
-    m_start_date = date(2023, 4, 1)  # missing
+    DEFAULT_START_DATE = "2023-04-01"
     TODAY = date.today()
     #m_end_date = date(2023, 3, 1)  # missing
     m_end_date = TODAY
 
     if os.path.isfile(FILENAME_BACKUP):
+        # a failed run of the previous version stopped at this date
         f = open(FILENAME_BACKUP)
-        m_start_date = datetime.strptime(f.read(), '%Y-%m-%d')
-        m_start_date = datetime.date(m_start_date)
-        print(str(m_start_date))
+        m_failed_date = datetime.date(datetime.strptime(f.read(), '%Y-%m-%d'))
         f.close()
+        for account_id in accounts:
+            for level in LEVELS:
+                watermarks.set(account_id, level, m_failed_date - timedelta(days=1), commit=False)
+        watermarks.commit()
         os.remove(FILENAME_BACKUP)
 
+    # start at the earliest date some account and level still misses
+    m_start_date = min(
+        datetime.date(datetime.strptime(
+            watermarks.start_date(account_id, level, DEFAULT_START_DATE, LOOKBACK_DAYS), '%Y-%m-%d'))
+        for account_id in accounts
+        for level in LEVELS
+    ) if accounts else TODAY
+    print(str(m_start_date))
+
     try:
         for m_single_date in utils.daterange(m_start_date, m_end_date):
             print(f'Running Meta ads {m_single_date.strftime("%Y-%m-%d")}')
@@ -166,7 +196,5 @@ if __name__ == '__main__':
             for level in ["adset", "campaign"]:
                 run_reach(m_single_date, level=level)
     except Exception as e:
+        # the watermarks keep what was retrieved, the next run resumes from there
         print(e)
-        f = open(FILENAME_BACKUP, "w")
-        f.write(str(m_single_date))
-        f.close
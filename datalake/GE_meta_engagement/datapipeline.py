@@ -11,6 +11,7 @@ sys.path.append("../")
 from GE_meta_engagement.reader import MetaReader, FacebookAPIAuthenticator
 from GE_meta_engagement.writer import MetaWriter
 from utils.file_handlers import load_file
+from utils.watermark import get_watermark_store
 
 
 def main():
@@ -33,8 +34,22 @@ def main():
     folder_name = args.folder_name
 
     configs = load_file(config_file)
+    azure_configs = {
+        "storage_account": storage_account,
+        "overwrite": True,
+        "auth_method": "sas_token",
+        "upload_workers": 8,
+    }
+    # last snapshot date of every post/media, read by the refresh schedule
+    watermark_configs = configs.get("watermark", {})
+    if watermark_configs.get("backend") == "azure":
+        watermark_configs = {**azure_configs, "container": container, **watermark_configs}
+    watermarks = get_watermark_store("meta_engagement", watermark_configs)
+
     authenticator = FacebookAPIAuthenticator(creds_file=secrets_file)
-    reader: MetaReader = MetaReader(authenticator=authenticator, configs=configs)
+    reader: MetaReader = MetaReader(
+        authenticator=authenticator, configs=configs, watermarks=watermarks
+    )
     local_writer: MetaWriter = MetaWriter(     # noqa F841
         container=container,
         destination="local_json",
@@ -44,19 +59,23 @@ def main():
     azure_writer: MetaWriter = MetaWriter(
         container=container,
         destination="azure_json",
-        configs={
-            "storage_account": storage_account,
-            "overwrite": True,
-            "auth_method": "sas_token",
-        },
+        configs=azure_configs,
         clear_destination=False,
     )
 
-    for res in reader.query():
-        # local_writer.sink(payload=res, folder_path=folder_path, folder_name=folder_name, indent=None)
-        azure_writer.sink(
-            payload=res, folder_path=folder_path, folder_name=folder_name, indent=None
-        )
+    try:
+        for res in reader.query():
+            # local_writer.sink(payload=res, folder_path=folder_path, folder_name=folder_name, indent=None)
+            azure_writer.sink(
+                payload=res, folder_path=folder_path, folder_name=folder_name, indent=None
+            )
+    except Exception:
+        # keep the snapshots written before the failure
+        azure_writer.flush()
+        watermarks.commit()
+        raise
+    azure_writer.close()
+    watermarks.commit()
 
 
 if __name__ == "__main__":
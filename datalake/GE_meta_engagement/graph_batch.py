@@ -0,0 +1,134 @@
+#!/usr/bin/python
+"""GRAPH API BATCH REQUESTS"""
+import sys
+import time
+import logging
+from typing import Any, Dict, Hashable, List, Tuple, Union
+
+from requests.exceptions import RequestException
+from facebook_business.api import FacebookAdsApi, FacebookResponse
+from facebook_business.exceptions import FacebookRequestError
+
+sys.path.append("../")
+
+from utils.rate_limiter import get_rate_limiter
+
+logger = logging.getLogger(__name__)
+
+# sub-requests accepted by one batch call
+MAX_BATCH_SIZE: int = 50
+# graph error codes worth retrying: unknown/service errors and rate limits
+TRANSIENT_ERROR_CODES = {1, 2, 4, 17, 32, 341, 613}
+RATE_LIMIT_ERROR_CODES = {4, 17, 32, 613}
+
+
+def _error(response) -> Dict[str, Any]:
+    """get the error of a failed sub-request"""
+    body = response.json()
+    if isinstance(body, dict) and isinstance(body.get("error"), dict):
+        return body["error"]
+    return {"message": str(body), "code": response.status()}
+
+
+def _is_transient(error: Dict[str, Any], status: Union[int, None]) -> bool:
+    """check if a failed sub-request may succeed when sent again"""
+    code = error.get("code")
+    return (
+        code in TRANSIENT_ERROR_CODES
+        or 80000 <= int(code or 0) < 80100
+        or bool(error.get("is_transient"))
+        or int(status or 0) >= 500
+    )
+
+
+def batch_get(
+    requests: List[Tuple[Hashable, str, Dict[str, Any]]],
+    api: Union[FacebookAdsApi, None] = None,
+    batch_size: int = MAX_BATCH_SIZE,
+    retries: int = 3,
+    initial_wait: float = 3,
+    limiter: str = "meta_graph",
+) -> Tuple[Dict[Hashable, Any], Dict[Hashable, Dict[str, Any]]]:
+    """Send GET requests through Graph API batch calls
+
+    Only the sub-requests that failed with a transient error or got no response
+    are sent again, up to `retries` times with an exponential wait. A batch call
+    that fails as a whole (connection error, top level graph error) is retried the
+    same way.
+
+    Args:
+        requests (List[Tuple[Hashable, str, Dict[str, Any]]]): (key, relative path,
+            params) of each request e.g (post_id, f"{post_id}/insights", {"metric": [...]})
+        api (Union[FacebookAdsApi, None], optional): api to call. Defaults to the
+            default api of FacebookAdsApi.init.
+        batch_size (int, optional): sub-requests per call, at most 50. Defaults to 50.
+        retries (int, optional): rounds of retries of the failed sub-requests.
+        initial_wait (float, optional): seconds before the first retry round.
+        limiter (str, optional): shared rate limiter, takes a token per sub-request
+            and reads the usage headers of each batch call.
+    Returns:
+        Tuple[Dict[Hashable, Any], Dict[Hashable, Dict[str, Any]]]: json bodies of the
+            successful requests and errors of the failed ones, by key
+    """
+    api = api or FacebookAdsApi.get_default_api()
+    batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+    results: Dict[Hashable, Any] = {}
+    errors: Dict[Hashable, Dict[str, Any]] = {}
+    pending = list(requests)
+    wait = initial_wait
+
+    for attempt in range(retries + 1):
+        failed: List[Tuple[Hashable, str, Dict[str, Any]]] = []
+        for index in range(0, len(pending), batch_size):
+            chunk = pending[index : index + batch_size]
+            # add encodes the params into the relative url of each call
+            batch = api.new_batch()
+            calls = [batch.add("GET", request[1], params=request[2]) for request in chunk]
+            # one token per sub-request, acquire clamps a single call to the capacity
+            for _ in chunk:
+                get_rate_limiter(limiter).acquire()
+            answers: List[Any] = []
+            message = "no response in batch"
+            try:
+                response = api.call("POST", (), params={"batch": calls})
+                # the usage of the app and page is reported on the batch call
+                get_rate_limiter(limiter).update_from_headers(response.headers())
+                answers = response.json()
+            except (ConnectionError, RequestException) as err:
+                message = f"batch call failed: {err}"
+            except FacebookRequestError as err:
+                message = f"batch call failed: {err.api_error_message()}"
+                if err.api_error_code() in RATE_LIMIT_ERROR_CODES:
+                    get_rate_limiter(limiter).penalize()
+
+            for position, request in enumerate(chunk):
+                answer = answers[position] if position < len(answers or []) else None
+                if not answer:
+                    errors[request[0]] = {"message": message}
+                    failed.append(request)
+                    continue
+                sub_response = FacebookResponse(
+                    body=answer.get("body"),
+                    headers=answer.get("headers"),
+                    http_status=answer.get("code"),
+                    call=calls[position],
+                )
+                if sub_response.is_success():
+                    results[request[0]] = sub_response.json()
+                    errors.pop(request[0], None)
+                    continue
+                error = _error(sub_response)
+                errors[request[0]] = error
+                if _is_transient(error, sub_response.status()):
+                    failed.append(request)
+                if error.get("code") in RATE_LIMIT_ERROR_CODES:
+                    get_rate_limiter(limiter).penalize()
+
+        if not failed or attempt == retries:
+            break
+        logger.info(f"retrying {len(failed)} failed batch requests in {wait} seconds")
+        time.sleep(wait)
+        wait *= 2
+        pending = failed
+
+    return results, errors
@@ -2,13 +2,21 @@
 """FACEBOOK API READER"""
 # import os
 import sys
+import json
+import time
+import queue
 import warnings
 import logging
+import threading
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 
 # import copy
 from typing import Generator, Any, Dict, List
 from datetime import datetime
 
+from facebook_business.api import FacebookAdsApi
+from facebook_business.session import FacebookSession
 from facebook_business.adobjects.page import Page
 from facebook_business.adobjects.iguser import IGUser
 from facebook_business.adobjects.user import User
@@ -17,6 +25,10 @@ from facebook_business.adobjects.igmedia import IGMedia
 sys.path.append("../")
 
 from utils.quota_handler import retry_handler, api_handler
+from utils.rate_limiter import get_rate_limiter
+from utils.concurrency import ordered_map
+from GE_meta_engagement.graph_batch import batch_get, MAX_BATCH_SIZE
+from GE_meta_engagement.refresh_policy import get_refresh_policy
 
 warnings.filterwarnings("ignore", category=UserWarning)
 logger = logging.getLogger(__name__)
@@ -36,14 +48,15 @@ class FacebookException(Exception):
 class MediaEngagements:
     """Instagram Media Insights Reader"""
 
-    def __init__(self, authenticator, configs: dict):
+    def __init__(self, authenticator, configs: dict, watermarks=None):
         self.authenticator = authenticator
         self.configs = configs
         self.error_handler = ErrorHanlder()
+        self.refresh = get_refresh_policy(watermarks, "media", configs)
 
     @staticmethod
-    def _get_account_id(page) -> str:
-        ig_business_account = Page(page.get_id()).api_get(
+    def _get_account_id(page, api=None) -> str:
+        ig_business_account = Page(page.get_id(), api=api).api_get(
             fields=["instagram_business_account"]
         )
         if "instagram_business_account" not in ig_business_account:
@@ -52,8 +65,8 @@ class MediaEngagements:
         return ig_business_account["instagram_business_account"]["id"]
 
     @staticmethod
-    def _get_username(ig_business_account_id) -> str:
-        ig_user = IGUser(ig_business_account_id).api_get(fields=["username"])
+    def _get_username(ig_business_account_id, api=None) -> str:
+        ig_user = IGUser(ig_business_account_id, api=api).api_get(fields=["username"])
         ig_account_username: str = ig_user["username"]
         return ig_account_username
 
@@ -98,21 +111,20 @@ class MediaEngagements:
     @retry_handler(
         exceptions=ConnectionError, initial_wait=3, total_tries=3, backoff_factor=2
     )
-    @api_handler(wait=1, backoff_factor=2)
-    def _fetch_media_insights(self, media: dict, extra_params: bool) -> List[Any]:
+    @api_handler(limiter="meta_graph")
+    def _fetch_media_insights(
+        self, media: dict, extra_params: bool, api=None, limiter: str = "meta_graph"
+    ) -> List[Any]:
         """method to call IGMedia Endpoint"""
         try:
             params = self.get_params(media, extra_params=extra_params)
             insights_data: List[Any] = []
             fields: List[str] = []
-            ig_media_insights = IGMedia(media["id"]).get_insights(
+            ig_media_insights = IGMedia(media["id"], api=api).get_insights(
                 fields=fields, params=params
             )
-            if not ig_media_insights:
-                return insights_data
-            _ = [insights_data.append(item._json) for item in ig_media_insights]
-            return insights_data
-
+            if ig_media_insights:
+                _ = [insights_data.append(item._json) for item in ig_media_insights]
         except ConnectionError as err:
             raise ConnectionError(err) from err
         except Exception as err:
@@ -121,15 +133,15 @@ class MediaEngagements:
             self.error_handler.error_list.append(error_msg)
             return []
 
-    def _process_media(
-        self, ig_business_account_id, ig_account_username, media
-    ) -> Dict[str, Any]:
-        insights_data = self._fetch_media_insights(media, extra_params=False)
-        extra_params_data = self._fetch_media_insights(media, extra_params=True)
-        insights_data += extra_params_data
-        if not insights_data:
-            return {}
+        # outside the try, the handler above expects graph errors only
+        get_rate_limiter(limiter).update_from_headers(ig_media_insights.headers())
+        return insights_data
 
+    @staticmethod
+    def _build_payload(
+        ig_business_account_id, ig_account_username, media, insights_data: List[Any]
+    ) -> Dict[str, Any]:
+        """method to build the writer payload of a media"""
         file_content = media._json
         file_content["insights"] = insights_data
         pull_date = datetime.today()
@@ -148,26 +160,221 @@ class MediaEngagements:
             "file_name": file_name,
         }
 
+    def _process_media(
+        self,
+        ig_business_account_id,
+        ig_account_username,
+        media,
+        api=None,
+        limiter: str = "meta_graph",
+    ) -> Dict[str, Any]:
+        insights_data = self._fetch_media_insights(
+            media, extra_params=False, api=api, limiter=limiter
+        )
+        extra_params_data = self._fetch_media_insights(
+            media, extra_params=True, api=api, limiter=limiter
+        )
+        insights_data += extra_params_data
+        if not insights_data:
+            return {}
+        return self._build_payload(
+            ig_business_account_id, ig_account_username, media, insights_data
+        )
+
+    def _batch_media_insights(
+        self, medias: list, api=None, limiter: str = "meta_graph"
+    ) -> Dict[str, List[Any]]:
+        """Fetch the normal and profile_activity insights of medias with batch calls
+
+        The medias are grouped by the metric set get_params chooses so each batch
+        asks for the same metrics, and the batches run on `insights_workers` threads.
+        A media whose extra params fall back to its normal metric set reuses the
+        normal result instead of requesting it twice.
+
+        Returns:
+            Dict[str, List[Any]]: insights of each media id, normal then extra metrics
+        """
+        media_keys: Dict[str, List[Any]] = {}
+        requests: Dict[Any, Any] = {}
+        for media in medias:
+            media_keys[media["id"]] = []
+            for extra_params in [False, True]:
+                params = self.get_params(media, extra_params=extra_params)
+                if not params:
+                    continue
+                key = (media["id"], json.dumps(params, sort_keys=True))
+                media_keys[media["id"]].append(key)
+                requests[key] = (key, f"{media['id']}/insights", params)
+
+        grouped = sorted(requests.values(), key=lambda request: request[0][1])
+        batch_size = int(self.configs.get("batch_size", MAX_BATCH_SIZE))
+        batches = [
+            (grouped[index : index + batch_size],)
+            for index in range(0, len(grouped), batch_size)
+        ]
+        workers = int(self.configs.get("insights_workers", 4))
+        results: Dict[Any, Any] = {}
+        for batch_results, batch_errors in ordered_map(
+            lambda batch: batch_get(
+                batch, api=api, batch_size=batch_size, limiter=limiter
+            ),
+            batches,
+            workers,
+        ):
+            results.update(batch_results)
+            for (media_id, params), error in batch_errors.items():
+                logger.info(f"ERROR: {error.get('message')}")
+                self.error_handler.error_list.append(
+                    f"media_id: {media_id} params: {params} \n {error}"
+                )
+
+        return {
+            media_id: [
+                item for key in keys for item in (results.get(key) or {}).get("data", [])
+            ]
+            for media_id, keys in media_keys.items()
+        }
+
     def _get_ig_insights(
-        self, page, fields: list
+        self, page, fields: list, api=None, limiter: str = "meta_graph"
     ) -> Generator[Dict[str, Any], None, None]:
-        ig_business_account_id = self._get_account_id(page)
+        ig_business_account_id = self._get_account_id(page, api=api)
         if not ig_business_account_id:
             return
-        ig_account_username = self._get_username(ig_business_account_id)
-        for media in IGUser(ig_business_account_id).get_media(fields=fields):
+        ig_account_username = self._get_username(ig_business_account_id, api=api)
+        medias = IGUser(ig_business_account_id, api=api).get_media(fields=fields)
+        if self.refresh:
+            medias = (
+                media
+                for media in medias
+                if self.refresh.is_due(media["id"], media.get("timestamp"))
+            )
+
+        if self.configs.get("insights_mode", "single") == "batch":
+            medias = iter(medias)
+            chunk_size = int(self.configs.get("media_chunk_size", 1000))
+            while chunk := list(islice(medias, chunk_size)):
+                insights = self._batch_media_insights(chunk, api=api, limiter=limiter)
+                for media in chunk:
+                    if insights[media["id"]]:
+                        yield self._build_payload(
+                            ig_business_account_id,
+                            ig_account_username,
+                            media,
+                            insights[media["id"]],
+                        )
+            return
+
+        for media in medias:
             insights_data = self._process_media(
-                ig_business_account_id, ig_account_username, media
+                ig_business_account_id,
+                ig_account_username,
+                media,
+                api=api,
+                limiter=limiter,
             )
             if insights_data:
                 yield insights_data
 
+    def _account_insights(
+        self, page, fields: list, api=None, limiter: str = "meta_graph"
+    ) -> Generator[Dict[str, Any], None, None]:
+        """Traverse one account, logging its run time and keeping its errors from
+        stopping the other accounts"""
+        start_time = time.perf_counter()
+        count: int = 0
+        try:
+            for payload in self._get_ig_insights(page, fields, api=api, limiter=limiter):
+                count += 1
+                yield payload
+        except Exception as err:  # noqa: BLE001  # pylint: disable=broad-except
+            logger.info(f"ERROR: page {page.get_id()} stopped after {count} media: {err}")
+            self.error_handler.error_list.append(f"page_id: {page.get_id()} \n {err}")
+        logger.info(
+            f"Page {page.get_id()}: {count} media in "
+            f"{time.perf_counter() - start_time:.1f} seconds"
+        )
+
+    def _parallel_insights(
+        self, pages: list, fields: list, workers: int
+    ) -> Generator[Dict[str, Any], None, None]:
+        """Traverse the accounts on `workers` threads, each with the access token and
+        rate limiter of its page, and yield the payloads of all accounts as they come"""
+        payloads: queue.Queue = queue.Queue(maxsize=workers * 100)
+        stop = threading.Event()
+        done = object()
+
+        def put(item) -> None:
+            while not stop.is_set():
+                try:
+                    payloads.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    continue
+
+        def traverse(page) -> None:
+            try:
+                if stop.is_set():
+                    return
+                api = FacebookAdsApi(FacebookSession(access_token=page["access_token"]))
+                # the quota of a page token does not slow down the other pages
+                limiter = f"meta_graph:{page.get_id()}"
+                for payload in self._account_insights(
+                    page, fields, api=api, limiter=limiter
+                ):
+                    put(payload)
+                    if stop.is_set():
+                        return
+            except Exception as err:  # noqa: BLE001  # pylint: disable=broad-except
+                logger.info(f"ERROR: page {page.get_id()}: {err}")
+                self.error_handler.error_list.append(f"page_id: {page.get_id()} \n {err}")
+            finally:
+                put(done)
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+        _ = [executor.submit(traverse, page) for page in pages]
+        remaining = len(pages)
+        try:
+            while remaining:
+                item = payloads.get()
+                if item is done:
+                    remaining -= 1
+                    continue
+                yield item
+        finally:
+            # the consumer stopped or raised: drop the accounts not started yet
+            stop.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+
     def get_data(self) -> Generator[Dict[str, Any], None, None]:
-        """main exit function"""
+        """main exit function
+
+        `account_workers` above 1 traverses that many accounts at a time, each
+        with its own page access token.
+        """
         fields: List[str] = self.configs["fields"]
         user_id: int = self.authenticator.creds.get("user_id")
-        for page in User(user_id).get_accounts(params={"limit": 10}):
-            yield from self._get_ig_insights(page, fields)
+        workers = int(self.configs.get("account_workers", 1))
+        if workers > 1:
+            pages = list(
+                User(user_id).get_accounts(
+                    fields=["id", "name", "access_token"], params={"limit": 10}
+                )
+            )
+            workers = min(workers, len(pages) or 1)
+            results = self._parallel_insights(pages, fields, workers)
+        else:
+            results = (
+                payload
+                for page in User(user_id).get_accounts(params={"limit": 10})
+                for payload in self._get_ig_insights(page, fields)
+            )
+        for payload in results:
+            yield payload
+            if self.refresh:
+                self.refresh.mark(payload["media_id"])
+        if self.refresh:
+            logger.info(f"Media not due for a refresh: {self.refresh.skipped}")
         if self.error_handler.error_list:
             logger.info("ERRORS")
             logger.info("\n".join([e for e in self.error_handler.error_list]))
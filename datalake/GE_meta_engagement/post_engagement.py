@@ -5,6 +5,7 @@ import sys
 import copy
 import warnings
 import logging
+from itertools import islice
 from typing import Generator, Any, Dict, List
 from datetime import datetime
 
@@ -17,6 +18,9 @@ sys.path.append("../")
 
 from utils.date_handlers import string_to_date
 from utils.quota_handler import retry_handler, api_handler
+from utils.rate_limiter import get_rate_limiter
+from GE_meta_engagement.graph_batch import batch_get, MAX_BATCH_SIZE
+from GE_meta_engagement.refresh_policy import get_refresh_policy
 
 warnings.filterwarnings('ignore', category=UserWarning) 
 logger = logging.getLogger(__name__)
@@ -28,9 +32,10 @@ class FacebookException(Exception):
 class PostEngagements:
     """Class to read data from Facebook"""
 
-    def __init__(self, authenticator, configs: dict):
+    def __init__(self, authenticator, configs: dict, watermarks=None):
         self.authenticator = authenticator
         self.configs = configs
+        self.refresh = get_refresh_policy(watermarks, "post", configs)
 
     def build_query(self, configs: dict) -> Dict[str, Any]:
         """method to build a query"""
@@ -54,45 +59,135 @@ class PostEngagements:
     @retry_handler(
         exceptions=ConnectionError, initial_wait=3, total_tries=3, backoff_factor=2
     )
-    @api_handler(wait=1, backoff_factor=2)
+    @api_handler(limiter="meta_graph")
     def post_insights(self, post: dict, insights_params: dict):
         """make api call"""
         try:
-            return PagePost(post["id"]).get_insights(fields=[], params=insights_params)
+            post_insights = PagePost(post["id"]).get_insights(
+                fields=[], params=insights_params
+            )
+            get_rate_limiter("meta_graph").update_from_headers(post_insights.headers())
+            return post_insights
         except ConnectionError as err:
             raise ConnectionError(f"Connection Error: {err}") from err
 
+    @staticmethod
+    def _build_payload(page: Page, post, insights: List[Any]) -> Dict[str, Any]:
+        """method to build the writer payload of a post"""
+        json_data = copy.copy(post)._json
+        json_data["insights"] = insights
+        pull_date = datetime.today()
+        date_partition: str = pull_date.strftime("%Y/%m")
+        date_string: str = pull_date.strftime("%Y-%m-%d")
+
+        file_name: str = (
+            f"{page['id']}/{post['id']}/{date_partition}/{date_string}-{post['id']}"
+        )
+        return {
+            "page_id": page["id"],
+            "page_name": page["name"],
+            "post_id": post["id"],
+            "data": json_data,
+            "date": datetime.now().strftime("%Y-%m-d%"),
+            "file_name": file_name,
+        }
+
+    def batch_insights(
+        self, posts: list, insights_params: dict
+    ) -> Dict[str, List[Any]]:
+        """method to fetch the insights of up to 50 posts per Graph API batch call,
+        the posts whose insights failed are left out"""
+        requests = [
+            (post["id"], f"{post['id']}/insights", insights_params) for post in posts
+        ]
+        results, errors = batch_get(
+            requests, batch_size=int(self.configs.get("batch_size", MAX_BATCH_SIZE))
+        )
+        for post_id, error in errors.items():
+            logger.info(f"Post insights failed: {post_id} {error.get('message')}")
+        return {
+            post["id"]: (results[post["id"]] or {}).get("data", [])
+            for post in posts
+            if post["id"] in results
+        }
+
+    def inline_insights_field(self, configs: dict) -> str:
+        """method to build the insights field expansion of the posts listing
+        e.g insights.metric(post_impressions,post_clicks).since(2024-01-01)
+        """
+        insights_params: Dict[str, Any] = self.build_query(configs)
+        field = f"insights.metric({','.join(insights_params.get('metric', []))})"
+        for param in ["since", "until"]:
+            if value := insights_params.get(param):
+                field += f".{param}({value})"
+        return field
+
+    @staticmethod
+    def _inline_insights(post, metrics: List[str]) -> Any:
+        """get the inline insights of a post, None when they came back incomplete"""
+        insights = (post._json.get("insights") or {}).get("data")
+        if not insights or not set(metrics).issubset(item["name"] for item in insights):
+            return None
+        return insights
+
     def get_insights(
         self, page: Page, configs: dict
     ) -> Generator[Dict[str, Any], None, None]:
-        """Fetch insights for all posts of a page"""
+        """Fetch insights for all posts of a page
+
+        `insights_mode: batch` fetches the insights of `batch_size` posts (up to 50)
+        per Graph API batch call instead of one call per post.
+        `insights_mode: inline` requests the insights as a nested field of the posts
+        listing, `inline_limit` posts per page, and only the posts with incomplete
+        inline insights are fetched again with batch calls.
+        In both modes the posts whose insights failed are skipped.
+        """
 
         fields: List[str] = configs["fields"]
         params: Dict[str, Any] = {}
         FacebookAdsApi.init(access_token=page["access_token"], debug=False)
+        insights_mode: str = configs.get("insights_mode", "single")
+        if insights_mode == "inline":
+            fields = fields + [self.inline_insights_field(configs)]
+            params = {"limit": int(configs.get("inline_limit", 100))}
+        posts = Page(page.get_id()).get_posts(fields=fields, params=params)
+        if self.refresh:
+            posts = (
+                post
+                for post in posts
+                if self.refresh.is_due(post["id"], post.get("created_time"))
+            )
 
-        for post in Page(page.get_id()).get_posts(fields=fields, params=params):
-            json_data = copy.copy(post)._json
+        if insights_mode in ["batch", "inline"]:
             insights_params: Dict[str, Any] = self.build_query(configs)
-
+            metrics: List[str] = insights_params.get("metric", [])
+            batch_size = int(configs.get("batch_size", MAX_BATCH_SIZE))
+            posts = iter(posts)
+            while chunk := list(islice(posts, batch_size)):
+                insights: Dict[str, Any] = {}
+                if insights_mode == "inline":
+                    insights = {
+                        post["id"]: data
+                        for post in chunk
+                        if (data := self._inline_insights(post, metrics)) is not None
+                    }
+                missing = [post for post in chunk if post["id"] not in insights]
+                if missing:
+                    insights.update(self.batch_insights(missing, insights_params))
+                for post in chunk:
+                    if post["id"] not in insights:
+                        # not written nor marked, so it stays due for the next run
+                        logger.info(f"Post skipped, insights failed: {post['id']}")
+                        continue
+                    yield self._build_payload(page, post, insights[post["id"]])
+                    logger.info(f"Post insights fetched: {post['id']}")
+            return
+
+        for post in posts:
+            insights_params = self.build_query(configs)
             post_insights = self.post_insights(post, insights_params)
             data = self._process_insights_data(post_insights)
-            json_data["insights"] = data
-            pull_date = datetime.today()
-            date_partition: str = pull_date.strftime("%Y/%m")
-            date_string: str = pull_date.strftime("%Y-%m-%d")
-
-            file_name: str = (
-                f"{page['id']}/{post['id']}/{date_partition}/{date_string}-{post['id']}"
-            )
-            yield {
-                "page_id": page["id"],
-                "page_name": page["name"],
-                "post_id": post["id"],
-                "data": json_data,
-                "date": datetime.now().strftime("%Y-%m-d%"),
-                "file_name": file_name,
-            }
+            yield self._build_payload(page, post, data)
             logger.info(f"Post insights fetched: {post['id']}")
 
     def get_data(self) -> Generator[Dict[str, Any], None, None]:
@@ -100,4 +195,10 @@ class PostEngagements:
         # Retrieve insights for each page associated with the user
         user_id: int = self.authenticator.creds.get("user_id")
         for page in User(user_id).get_accounts(fields=[], params={}):
-            yield from self.get_insights(page, configs=self.configs)
+            for payload in self.get_insights(page, configs=self.configs):
+                yield payload
+                # posts whose insights failed stay due for the next run
+                if self.refresh and payload["data"]["insights"]:
+                    self.refresh.mark(payload["post_id"])
+        if self.refresh:
+            logger.info(f"Posts not due for a refresh: {self.refresh.skipped}")
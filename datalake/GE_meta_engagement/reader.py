@@ -2,7 +2,7 @@
 
 # import os
 import sys
-from typing import Generator, Any, Dict
+from typing import Generator, Any, Dict, Union
 from facebook_business.api import FacebookAdsApi
 
 sys.path.append("../")
@@ -12,6 +12,7 @@ from GE_meta_engagement.post_engagement import PostEngagements
 from GE_meta_engagement.media_engagement import MediaEngagements
 
 from utils.file_handlers import load_file
+from utils.watermark import WatermarkStore
 
 
 class FacebookAPIAuthenticator:
@@ -28,10 +29,16 @@ class FacebookAPIAuthenticator:
 class MetaReader:
     """READER CLASS FOR META ENGAGEMENTS"""
 
-    def __init__(self, authenticator: FacebookAPIAuthenticator, configs: dict):
+    def __init__(
+        self,
+        authenticator: FacebookAPIAuthenticator,
+        configs: dict,
+        watermarks: Union[WatermarkStore, None] = None,
+    ):
         self.authenticator = authenticator
         self.authenticator.initialize()
         self.configs = configs
+        self.watermarks = watermarks
         self.endpoint = self.get_endpoint(self.configs["endpoint"])
 
     def get_endpoint(self, endpoint: str):
@@ -41,7 +48,9 @@ class MetaReader:
             "media_engagement": MediaEngagements,
         }
         return endpoints[endpoint](
-            authenticator=self.authenticator, configs=self.configs
+            authenticator=self.authenticator,
+            configs=self.configs,
+            watermarks=self.watermarks,
         )
 
     def query(self) -> Generator[Dict[str, Any], None, None]:
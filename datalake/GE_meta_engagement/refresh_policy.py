@@ -0,0 +1,98 @@
+#!/usr/bin/python
+"""AGE AWARE REFRESH OF POSTS AND MEDIA"""
+import sys
+import threading
+from datetime import date, datetime
+from typing import Any, Dict, List, Union
+
+sys.path.append("../")
+
+from utils.watermark import WatermarkStore
+
+# daily for content younger than a week, weekly until 90 days, monthly after
+DEFAULT_SCHEDULE: List[Dict[str, int]] = [
+    {"max_age_days": 7, "every_days": 1},
+    {"max_age_days": 90, "every_days": 7},
+    {"every_days": 30},
+]
+
+
+class RefreshPolicy:
+    """Decides which posts or media get their insights fetched again on this run
+
+    The date of the last snapshot of every item is kept in the watermark store
+    (scope: item id, endpoint: e.g post or media), and the age of the item picks how
+    many days must pass before the next snapshot. Safe to share between the
+    threads traversing accounts.
+
+    Args:
+        watermarks (WatermarkStore): store of the last snapshot dates
+        endpoint (str): kind of item e.g post, media
+        schedule (Union[List[Dict[str, int]], None], optional): rules sorted by
+            `max_age_days`, the first rule the age fits in gives `every_days`, the
+            last rule may leave out max_age_days. Defaults to DEFAULT_SCHEDULE.
+        today (Union[date, None], optional): date of the run. Defaults to today.
+    """
+
+    def __init__(
+        self,
+        watermarks: WatermarkStore,
+        endpoint: str,
+        schedule: Union[List[Dict[str, int]], None] = None,
+        today: Union[date, None] = None,
+    ):
+        self.watermarks = watermarks
+        self.endpoint = endpoint
+        self.schedule = schedule or DEFAULT_SCHEDULE
+        self.today = today or date.today()
+        self.skipped: int = 0
+        self.lock = threading.Lock()
+
+    def interval(self, created_time: Union[str, None]) -> int:
+        """method to get the days between two snapshots of an item of the given age"""
+        if not created_time:
+            return 1
+        created = datetime.strptime(created_time[:10], "%Y-%m-%d").date()
+        age = (self.today - created).days
+        for rule in self.schedule:
+            if "max_age_days" not in rule or age < int(rule["max_age_days"]):
+                return int(rule["every_days"])
+        return int(self.schedule[-1]["every_days"])
+
+    def is_due(self, item_id: str, created_time: Union[str, None]) -> bool:
+        """method to check if the insights of an item should be fetched on this run"""
+        last_snapshot = self.watermarks.get(item_id, self.endpoint)
+        if not last_snapshot:
+            return True
+        days = (self.today - date.fromisoformat(last_snapshot[:10])).days
+        if days >= self.interval(created_time):
+            return True
+        with self.lock:
+            self.skipped += 1
+        return False
+
+    def mark(self, item_id: str) -> None:
+        """method to stage the snapshot of an item, saved with the watermarks commit"""
+        self.watermarks.set(item_id, self.endpoint, self.today, commit=False)
+
+
+def get_refresh_policy(
+    watermarks: Union[WatermarkStore, None], endpoint: str, configs: Dict[str, Any]
+) -> Union[RefreshPolicy, None]:
+    """Get the refresh policy of an endpoint, None when every item is fetched each run
+
+    Args:
+        watermarks (Union[WatermarkStore, None]): store of the last snapshot dates
+        endpoint (str): kind of item e.g post, media
+        configs (Dict[str, Any]): endpoint configs, `refresh: {schedule: [...]}`
+            enables the policy
+    Returns:
+        Union[RefreshPolicy, None]: the policy
+    """
+    refresh_configs = configs.get("refresh")
+    if not (watermarks and refresh_configs):
+        return None
+    schedule = None
+    if isinstance(refresh_configs, dict):
+        schedule = refresh_configs.get("schedule")
+    return RefreshPolicy(watermarks, endpoint, schedule=schedule)
@@ -1,84 +1,192 @@
 from temba_client.v2 import TembaClient
+import numpy as np
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import date, timedelta
+import argparse
 import json
+import os
+import sys
+import threading
+import time
 
-ISO_8601_DateTime_format = '%Y-%m-%dT%H:%M:%SZ'
+sys.path.append("../")
 
+from utils.date_handlers import date_iterator
 
-def get_platform(urn):
-    if urn.startswith("ext:"):
-        return "website"
-    elif urn.startswith("facebook:"):
-        return "messenger"
-    elif urn.startswith("whatsapp:"):
-        return "whatsapp"
-    elif urn.startswith("telegram:"):
-        return "telegram"
-    elif urn.startswith("tel:"):
-        return "moya"
-    else:
-        return None
+ISO_8601_DateTime_format = '%Y-%m-%dT%H:%M:%SZ'
+RAPIDPRO_HOST = 'rapidpro.ilhasoft.mobi'
+MAX_WORKERS = 8
+# RapidPro rate limits each token, so only a few calls run at once per token
+# (override per chatbot with "max_concurrency" in auth.json)
+TOKEN_CONCURRENCY = 2
+
+
+# urn scheme -> platform, a chatbot can add or override schemes with "urn_platforms" in auth.json
+URN_PLATFORMS = {
+    "ext": "website",
+    "facebook": "messenger",
+    "whatsapp": "whatsapp",
+    "telegram": "telegram",
+    "tel": "moya",
+}
+
+
+def get_platform(urn, platforms=URN_PLATFORMS):
+    scheme, separator, _ = urn.partition(":")
+    return platforms.get(scheme) if separator else None
+
+
+def get_platforms(urns, platforms=URN_PLATFORMS):
+    """Vectorized get_platform for a Series of urns, returned as a categorical"""
+    categories = sorted(set(platforms.values()))
+    codes = np.full(len(urns), -1, dtype=np.int16)
+    try:
+        # arrow strings make the startswith passes run in C instead of per python object
+        urns = urns.astype("string[pyarrow]")
+    except ImportError:
+        pass
+    # one vectorized pass per scheme, much faster than splitting every urn
+    for scheme, platform in platforms.items():
+        codes[urns.str.startswith(f"{scheme}:", na=False).to_numpy(dtype=bool)] = categories.index(platform)
+    return pd.Series(pd.Categorical.from_codes(codes, categories=categories), index=urns.index)
+
+
+def fetch_batches(query):
+    """Yields the pages of a RapidPro query"""
+    return query.iterfetches(retry_on_rate_exceed=True)
+
+
+def iter_rows(batches, to_row):
+    """Yields one list of rows per page fetched from RapidPro"""
+    for batch in batches:
+        yield [to_row(o) for o in batch]
+
+
+def configured_flows(chatbot):
+    return {chatbot.get("start_flow"), chatbot.get("lookup_flow"), *chatbot.get("quiz_flows", [])} - {None}
+
+
+class RunsCache:
+    """Fetches the runs of a chatbot once per time window and hands them out by flow
+
+    The runs endpoint only filters by one flow, so instead of paginating it again for
+    every configured flow all the runs of the window are read in a single pass and
+    the ones of the configured flows are kept for the rest of the run. Extractors of
+    the same chatbot running at the same time wait for the first fetch. Only the
+    last max_entries windows are kept so a backfill does not hold every day.
+    """
+
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, client, chatbot, before, after):
+        """Returns the runs of the configured flows of the chatbot, by flow uuid"""
+        # chatbots sharing a token may configure different flows
+        flows = frozenset(configured_flows(chatbot))
+        key = (chatbot["token"], flows, str(before), str(after))
+        with self.lock:
+            entry = self.entries.setdefault(key, {"lock": threading.Lock(), "runs": None})
+            while len(self.entries) > self.max_entries:
+                self.entries.pop(next(iter(self.entries)))
+        with entry["lock"]:
+            if entry["runs"] is None:
+                runs = {flow: [] for flow in flows}
+                print(f"(runs) fetching all runs ({after} - {before}) for chatbot {chatbot['name']}")
+                for run_batch in fetch_batches(client.get_runs(before=before, after=after)):
+                    for run in run_batch:
+                        if run.flow.uuid in flows:
+                            runs[run.flow.uuid].append(run)
+                entry["runs"] = runs
+        return entry["runs"]
+
+
+RUNS_CACHE = RunsCache()
+
+
+def run_batches(client, chatbot, flow, before, after):
+    """Yields the runs of a flow, from the runs cache unless the chatbot sets "runs_fetch": "per_flow"
+    (better when the configured flows are a small share of the runs of the day)"""
+    if chatbot.get("runs_fetch") == "per_flow":
+        yield from fetch_batches(client.get_runs(flow=flow, before=before, after=after))
+        return
+    yield RUNS_CACHE.get(client, chatbot, before, after).get(flow, [])
+
+
+def save_csv_batches(filename, batches):
+    """Appends each batch of rows to the csv file as soon as it is fetched, so only one
+    page is held in memory. Returns the number of rows saved, the file is not created
+    when there are none."""
+    saved = 0
+    temp_filename = f"{filename}.part"
+    for rows in batches:
+        if len(rows) == 0:
+            continue
+        df = rows if isinstance(rows, pd.DataFrame) else pd.DataFrame(rows)
+        df.to_csv(temp_filename, mode="w" if saved == 0 else "a", header=saved == 0, index=False, date_format=ISO_8601_DateTime_format)
+        saved += len(rows)
+    if saved:
+        os.replace(temp_filename, filename)
+    return saved
+
+
+def contact_row(o):
+    return {"uuid": o.uuid, "created_on": o.created_on, "modified_on": o.modified_on, "last_seen_on": o.last_seen_on, "urn": o.urns[0]}
+
+
+def with_platform(rows, platforms=URN_PLATFORMS):
+    df = pd.DataFrame(rows)
+    if not df.empty:
+        # Create a platform column generated from the first urn of the contact
+        df["platform"] = get_platforms(df["urn"], platforms)
+    return df
 
 
 # No. Conversations Initiated
 # No. Returning Users
-def num_conversations_initiated_and_returning_users(client, chatbot):
+def num_conversations_initiated_and_returning_users(client, chatbot, after=None, before=None):
     chatbot_name = chatbot["name"]
-    today = date.today()
-    yesterday = today - timedelta(days=1)
+    # the day retrieved, yesterday unless a backfill window is given
+    yesterday = after or date.today() - timedelta(days=1)
+    today = before or yesterday + timedelta(days=1)
 
     print(f"(contacts) num_conversations_initiated_and_returning_users yesterday ({yesterday}) for chatbot {chatbot_name}")
 
-    df = pd.DataFrame()
     # https://rapidpro.ilhasoft.mobi/api/v2/contacts.json?before=2023-04-17&after=2023-04-16
-    # for contact_batch in client.get_contacts(before=2023-04-17, after="2023-04-16").iterfetches(retry_on_rate_exceed=True):
-    for contact_batch in client.get_contacts(before=today, after=yesterday).iterfetches(retry_on_rate_exceed=True):
-        # df = df.append(pd.DataFrame([o.__dict__ for o in contact_batch]))  # https://stackoverflow.com/questions/34997174/how-to-convert-list-of-model-objects-to-pandas-dataframe
-        df = df.append(pd.DataFrame([{"uuid": o.uuid, "created_on": o.created_on, "modified_on": o.modified_on, "last_seen_on": o.last_seen_on, "urn": o.urns[0]} for o in contact_batch]))
-        # source code of rapidpro-python (for python 3.7) was updated in order to access last_seen_on
-
-    if df.empty:
-        print(f"Exiting because ZERO num_conversations_initiated_and_returning_users yesterday ({yesterday}) for chatbot {chatbot_name}.")
-        return None
-    else:
-        # Create a platform column generated from the first urn of the contact
-        df['platform'] = df['urn'].apply(get_platform)
+    # source code of rapidpro-python (for python 3.7) was updated in order to access last_seen_on
+    batches = iter_rows(fetch_batches(client.get_contacts(before=today, after=yesterday)), contact_row)
 
     # # keep only the columns expected
     # columns_expected = ["uuid", "created_on", "last_seen_on", "modified_on", "platform", "urn"]
-    # df = df.loc[:, columns_expected]
 
     # Save to csv file
     filename_csv = f"{yesterday}-{chatbot_name}-contacts.csv"
-    df.to_csv(filename_csv, index=False, date_format=ISO_8601_DateTime_format)
+    platforms = {**URN_PLATFORMS, **chatbot.get("urn_platforms", {})}
+    if not save_csv_batches(filename_csv, (with_platform(rows, platforms) for rows in batches)):
+        print(f"Exiting because ZERO num_conversations_initiated_and_returning_users yesterday ({yesterday}) for chatbot {chatbot_name}.")
+        return None
     print(f"Saved file {filename_csv}")
 
-    # for contact in contact_batch:
-    #     print(contact.created_on)
-    #     print(contact.__dict__)
-    #     print(pd.DataFrame.from_dict(contact))
 
-
-def num_onboarding_started(client, chatbot):
+def num_onboarding_started(client, chatbot, after=None, before=None):
     chatbot_name = chatbot["name"]
     chatbot_start_flow = chatbot["start_flow"]
-    today = date.today()
-    yesterday = today - timedelta(days=1)
+    # the day retrieved, yesterday unless a backfill window is given
+    yesterday = after or date.today() - timedelta(days=1)
+    today = before or yesterday + timedelta(days=1)
 
     print(f"(runs) num_onboarding_started yesterday ({yesterday}) for chatbot {chatbot_name}")
 
-    df = pd.DataFrame()
-    for run_batch in client.get_runs(flow=chatbot_start_flow, before=today, after=yesterday).iterfetches(retry_on_rate_exceed=True):
-        df = df.append(pd.DataFrame([{"id": o.uuid, "contact": o.contact.uuid, "created_on": o.created_on, "modified_on": o.modified_on} for o in run_batch]))  # https://stackoverflow.com/questions/34997174/how-to-convert-list-of-model-objects-to-pandas-dataframe
-
-    if df.empty:
-        print(f"Exiting because ZERO num_onboarding_started yesterday ({yesterday}) for chatbot {chatbot_name}.")
-        return None
+    query = run_batches(client, chatbot, chatbot_start_flow, before=today, after=yesterday)
+    batches = iter_rows(query, lambda o: {"id": o.uuid, "contact": o.contact.uuid, "created_on": o.created_on, "modified_on": o.modified_on})
 
     # Save to csv file
     filename_csv = f"{yesterday}-{chatbot_name}-runs-onboarding.csv"
-    df.to_csv(filename_csv, index=False, date_format=ISO_8601_DateTime_format)
+    if not save_csv_batches(filename_csv, batches):
+        print(f"Exiting because ZERO num_onboarding_started yesterday ({yesterday}) for chatbot {chatbot_name}.")
+        return None
     print(f"Saved file {filename_csv}")
 
 
@@ -87,9 +195,11 @@ def most_popular_flows(client, chatbot):
     today = date.today()
     print(f"(flows) get list of flows (for most popular flows) for chatbot {chatbot_name}")
 
-    df = pd.DataFrame()
-    for run_batch in client.get_flows().iterfetches(retry_on_rate_exceed=True):
-        df = df.append(pd.DataFrame([{"date": today, "uuid": flow.uuid, "name": flow.name, "archived": flow.archived, "active": flow.runs.active, "completed": flow.runs.completed, "interrupted": flow.runs.interrupted, "expired": flow.runs.expired, "total_runs": flow.runs.active + flow.runs.completed + flow.runs.interrupted + flow.runs.expired} for flow in run_batch]))  # https://stackoverflow.com/questions/34997174/how-to-convert-list-of-model-objects-to-pandas-dataframe
+    # flows are sorted before saving so the rows are kept, one DataFrame is built at the end
+    rows = []
+    for batch in iter_rows(fetch_batches(client.get_flows()), lambda flow: {"date": today, "uuid": flow.uuid, "name": flow.name, "archived": flow.archived, "active": flow.runs.active, "completed": flow.runs.completed, "interrupted": flow.runs.interrupted, "expired": flow.runs.expired, "total_runs": flow.runs.active + flow.runs.completed + flow.runs.interrupted + flow.runs.expired}):
+        rows.extend(batch)
+    df = pd.DataFrame(rows)
 
     if df.empty:
         print(f"Exiting because ZERO list of flows (for most popular flows) for chatbot {chatbot_name}.")
@@ -104,26 +214,23 @@ def most_popular_flows(client, chatbot):
     print(f"Saved file {filename_csv}")
 
 
-def get_uncaught_messages(client, chatbot):
+def get_uncaught_messages(client, chatbot, after=None, before=None):
     chatbot_name = chatbot["name"]
     chatbot_lookup_flow = chatbot["lookup_flow"]
-    today = date.today()
-    yesterday = today - timedelta(days=1)
+    # the day retrieved, yesterday unless a backfill window is given
+    yesterday = after or date.today() - timedelta(days=1)
+    today = before or yesterday + timedelta(days=1)
 
     print(f"(runs) uncaught_messages in lookup flow yesterday ({yesterday}) for chatbot {chatbot_name}")
 
-    df = pd.DataFrame()
-    for run_batch in client.get_runs(flow=chatbot_lookup_flow, before=today, after=yesterday).iterfetches(retry_on_rate_exceed=True):
-        # https://stackoverflow.com/questions/34997174/how-to-convert-list-of-model-objects-to-pandas-dataframe
-        df = df.append(pd.DataFrame([{"flow": o.flow.uuid, "flow name": o.flow.name, "run": o.uuid, "contact": o.contact.uuid, "created_on": o.created_on, "modified_on": o.modified_on, "uncaught_message": o.values["uncaught_message"].value} for o in run_batch]))
-
-    if df.empty:
-        print(f"Exiting because ZERO runs (lookup run) yesterday ({yesterday}) for chatbot {chatbot_name}.")
-        return None
+    query = run_batches(client, chatbot, chatbot_lookup_flow, before=today, after=yesterday)
+    batches = iter_rows(query, lambda o: {"flow": o.flow.uuid, "flow name": o.flow.name, "run": o.uuid, "contact": o.contact.uuid, "created_on": o.created_on, "modified_on": o.modified_on, "uncaught_message": o.values["uncaught_message"].value})
 
     # Save to csv file
     filename_csv = f"{yesterday}-{chatbot_name}-runs-uncaught_messages.csv"
-    df.to_csv(filename_csv, index=False, date_format=ISO_8601_DateTime_format)
+    if not save_csv_batches(filename_csv, batches):
+        print(f"Exiting because ZERO runs (lookup run) yesterday ({yesterday}) for chatbot {chatbot_name}.")
+        return None
     print(f"Saved file {filename_csv}")
 
 
@@ -131,19 +238,21 @@ def get_values_quiz(quiz_values):
     return {k: v.value for (k, v) in quiz_values.items()}
 
 
-def get_quizzes(client, chatbot):
+def get_quizzes(client, chatbot, after=None, before=None):
     chatbot_name = chatbot["name"]
     chatbot_quiz_flows = chatbot["quiz_flows"]
-    today = date.today()
-    yesterday = today - timedelta(days=1)
+    # the day retrieved, yesterday unless a backfill window is given
+    yesterday = after or date.today() - timedelta(days=1)
+    today = before or yesterday + timedelta(days=1)
 
-    df = pd.DataFrame()
+    rows = []
     for chatbot_quiz_flow in chatbot_quiz_flows:
         print(f"(runs) get quizzes yesterday ({yesterday}) for flow {chatbot_quiz_flow} and for chatbot {chatbot_name}")
 
-        for run_batch in client.get_runs(flow=chatbot_quiz_flow, before=today, after=yesterday).iterfetches(retry_on_rate_exceed=True):
-            # https://stackoverflow.com/questions/34997174/how-to-convert-list-of-model-objects-to-pandas-dataframe
-            df = df.append(pd.DataFrame([{"flow": o.flow.uuid, "flow name": o.flow.name, "run": o.uuid, "contact": o.contact.uuid, "created_on": o.created_on, "modified_on": o.modified_on, "values": get_values_quiz(o.values), "exit_type": o.exit_type} for o in run_batch]))
+        query = run_batches(client, chatbot, chatbot_quiz_flow, before=today, after=yesterday)
+        for batch in iter_rows(query, lambda o: {"flow": o.flow.uuid, "flow name": o.flow.name, "run": o.uuid, "contact": o.contact.uuid, "created_on": o.created_on, "modified_on": o.modified_on, "values": get_values_quiz(o.values), "exit_type": o.exit_type}):
+            rows.extend(batch)
+    df = pd.DataFrame(rows)
 
     if df.empty:
         print(f"Exiting because ZERO runs (quizzes) yesterday ({yesterday}) for chatbot {chatbot_name}")
@@ -160,29 +269,82 @@ def get_quizzes(client, chatbot):
     print(f"Saved file {filename_json}")
 
 
-def main():
+def run_task(extractor, chatbot, token_slots, window):
+    """Runs one extractor for one chatbot with its own client, returns the seconds taken"""
+    with token_slots:
+        start = time.perf_counter()
+        rapidpro_client = TembaClient(RAPIDPRO_HOST, chatbot['token'])
+        extractor(rapidpro_client, chatbot, *window)
+        return time.perf_counter() - start
+
+
+def get_windows(start_date, end_date):
+    """One (after, before) window per day from start_date to end_date included"""
+    return [
+        (date.fromisoformat(after), date.fromisoformat(before))
+        for after, before in date_iterator(start_date=start_date, end_date=end_date, interval="1_day")
+    ]
+
+
+def main(max_workers=MAX_WORKERS, start_date=None, end_date=None):
     with open('auth.json', 'r') as f:
         chatbots = json.load(f)
 
-    for chatbot_details in chatbots.values():
-        rapidpro_client = TembaClient('rapidpro.ilhasoft.mobi', chatbot_details['token'])
-
+    daily_extractors = [
         # No. Conversations Initiated
         # No. Returning Users
-        num_conversations_initiated_and_returning_users(rapidpro_client, chatbot_details)
-
+        num_conversations_initiated_and_returning_users,
         # No. Onboarding Started flow
-        num_onboarding_started(rapidpro_client, chatbot_details)
-
-        # Most popular flows
-        most_popular_flows(rapidpro_client, chatbot_details)
-
+        num_onboarding_started,
         # Uncaught messages
-        get_uncaught_messages(rapidpro_client, chatbot_details)
-
+        get_uncaught_messages,
         # Quizzes
-        get_quizzes(rapidpro_client, chatbot_details)
+        get_quizzes,
+    ]
+
+    # Backfill: one window per day of the range, saved with the same file names
+    windows = get_windows(start_date, end_date or start_date) if start_date else [()]
+    tasks = [(extractor, window) for window in windows for extractor in daily_extractors]
+    if start_date:
+        print(f"Backfilling {len(windows)} days from {start_date}, most popular flows is a snapshot of today and is skipped")
+    else:
+        # Most popular flows
+        tasks.append((most_popular_flows, ()))
+
+    token_slots = {}
+    for chatbot_details in chatbots.values():
+        token = chatbot_details['token']
+        if token not in token_slots:
+            token_slots[token] = threading.BoundedSemaphore(chatbot_details.get("max_concurrency", TOKEN_CONCURRENCY))
+
+    start = time.perf_counter()
+    timings, failures = [], []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # interleave the chatbots so the workers are not all waiting on the same token
+        futures = {
+            executor.submit(run_task, extractor, chatbot_details, token_slots[chatbot_details['token']], window): (chatbot_details["name"], f"{extractor.__name__} {window[0]}" if window else extractor.__name__)
+            for extractor, window in tasks
+            for chatbot_details in chatbots.values()
+        }
+        for future in as_completed(futures):
+            chatbot_name, task = futures[future]
+            try:
+                timings.append((chatbot_name, task, future.result()))
+            except Exception as e:
+                print(f"Failed {task} for chatbot {chatbot_name}: {e}")
+                failures.append((chatbot_name, task, e))
+
+    for chatbot_name, task, seconds in sorted(timings):
+        print(f"{chatbot_name} - {task}: {seconds:.1f} seconds")
+    print(f"Ran {len(timings) + len(failures)} tasks in {time.perf_counter() - start:.1f} seconds")
+    if failures:
+        raise RuntimeError(f"{len(failures)} RapidPro tasks failed: {[task[:2] for task in failures]}")
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="RapidPro extraction, yesterday unless a backfill range is given")
+    parser.add_argument("--start_date", type=str, default=None, help="first day to backfill e.g 2023-04-01")
+    parser.add_argument("--end_date", type=str, default=None, help="last day to backfill, defaults to start_date")
+    parser.add_argument("--max_workers", type=int, default=MAX_WORKERS)
+    args, _ = parser.parse_known_args()
+    main(max_workers=args.max_workers, start_date=args.start_date, end_date=args.end_date)
@@ -2,14 +2,32 @@
 """MODULE FOR BASE RESOURCE WRITERS"""
 # pylint: disable=broad-except, unused-import, maybe-no-member
 import os
+import io
+import re
 import json
 import csv
+import gzip
+import time
+import queue
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from pathlib import Path
 from abc import ABC, abstractmethod
 
-from typing import Union, Any, Dict, List, Tuple
+from typing import Union, Any, Callable, Dict, List, Tuple
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
 from azure.identity import DefaultAzureCredential
-from azure.storage.blob import BlobClient, BlobServiceClient
+from azure.storage.blob import BlobPrefix, BlobServiceClient, ContainerClient
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:  # only needed by the parquet destinations
+    pa = pc = pq = None
 
 
 class AzureDefaultAuthenticator:
@@ -97,6 +115,121 @@ class LocalAuthenticator:
         return True
 
 
+class UploadError(Exception):
+    """Exception raised when queued uploads failed"""
+
+
+class UploadPool:
+    """Pool of upload workers fed through a bounded queue
+
+    Args:
+        upload (Callable[[str, bytes], None]): function doing the actual upload
+        workers (int, optional): number of upload threads. Defaults to 8.
+        max_queue (Union[int, None], optional): maximum queued uploads. Defaults to workers * 4.
+        max_inflight_bytes (int, optional): maximum bytes queued or uploading at once.
+    """
+
+    def __init__(
+        self,
+        upload: Callable[[str, bytes], None],
+        workers: int = 8,
+        max_queue: Union[int, None] = None,
+        max_inflight_bytes: int = 64 * 1024 * 1024,
+    ):
+        self.upload = upload
+        self.max_inflight_bytes = max_inflight_bytes
+        self.inflight_bytes = 0
+        self.condition = threading.Condition()
+        self.errors: List[Tuple[str, Exception]] = []
+        self.queue: queue.Queue = queue.Queue(maxsize=max_queue or workers * 4)
+        self.threads = [
+            threading.Thread(target=self._worker, daemon=True) for _ in range(workers)
+        ]
+        _ = [thread.start() for thread in self.threads]
+
+    def _worker(self) -> None:
+        """method run by every upload thread"""
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            name, body = item
+            try:
+                self.upload(name, body)
+            except Exception as err:
+                with self.condition:
+                    self.errors.append((name, err))
+            finally:
+                with self.condition:
+                    self.inflight_bytes -= len(body)
+                    self.condition.notify_all()
+                self.queue.task_done()
+
+    def submit(self, name: str, body: bytes) -> None:
+        """method to queue an upload, blocks while the queue or byte budget is full"""
+        with self.condition:
+            while (
+                self.inflight_bytes
+                and self.inflight_bytes + len(body) > self.max_inflight_bytes
+            ):
+                self.condition.wait()
+            self.inflight_bytes += len(body)
+        self.queue.put((name, body))
+
+    def flush(self) -> None:
+        """method to wait for queued uploads and raise if any of them failed"""
+        self.queue.join()
+        with self.condition:
+            errors, self.errors = self.errors, []
+        if errors:
+            details = "\n".join([f"{name}: {err}" for name, err in errors])
+            raise UploadError(f"{len(errors)} uploads failed\n{details}") from errors[0][1]
+
+    def close(self) -> None:
+        """method to flush the queue and stop the upload threads"""
+        try:
+            self.flush()
+        finally:
+            _ = [self.queue.put(None) for _ in self.threads]
+            _ = [thread.join() for thread in self.threads]
+
+
+class ContainerRegistry:
+    """Registry of the containers already known to exist
+
+    Keeps the existence check to one listing call per container instead of one per
+    blob write, and counts the listing calls saved.
+    """
+
+    def __init__(self):
+        self.containers: set = set()
+        self.lock = threading.Lock()
+        self.checks = 0
+        self.saved = 0
+
+    def ensure(self, key: str, check: Callable[[], bool]) -> bool:
+        """method to run the check only when the container is not registered yet"""
+        with self.lock:
+            if key in self.containers:
+                self.saved += 1
+                return True
+        exists = check()
+        with self.lock:
+            self.checks += 1
+            if exists:
+                self.containers.add(key)
+        return exists
+
+    def invalidate(self, key: str) -> None:
+        """method to forget a container, e.g after an upload got a 404"""
+        with self.lock:
+            self.containers.discard(key)
+
+
+CONTAINER_REGISTRY = ContainerRegistry()
+
+
 class DataWriter(ABC):
     """Interface class for resource writers"""
 
@@ -105,6 +238,398 @@ class DataWriter(ABC):
         """Method to write data to final destination resource"""
         raise NotImplementedError
 
+    def flush(self) -> None:
+        """Method to wait for pending writes, writers are synchronous by default"""
+
+    def close(self) -> None:
+        """Method to release the writer resources"""
+        self.flush()
+
+
+class PartitionBuffer:
+    """Buffers records per partition folder until they fill a part file
+
+    Args:
+        max_records (int, optional): records (or rows) per part file. Defaults to 50000.
+        max_bytes (int, optional): bytes per part file. Defaults to 64MB.
+        max_partitions (int, optional): partitions buffered at once, the oldest one is
+            handed back early when exceeded. Defaults to 128.
+    """
+
+    def __init__(
+        self,
+        max_records: int = 50000,
+        max_bytes: int = 64 * 1024 * 1024,
+        max_partitions: int = 128,
+    ):
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.max_partitions = max_partitions
+        self.partitions: "OrderedDict[str, List[Any]]" = OrderedDict()
+        self.sizes: Dict[str, int] = {}
+        self.counts: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def _pop(self, partition: str) -> Tuple[str, List[Any]]:
+        self.sizes.pop(partition, None)
+        self.counts.pop(partition, None)
+        return partition, self.partitions.pop(partition)
+
+    def add(
+        self, partition: str, record: Any, size: int, count: int = 1
+    ) -> List[Tuple[str, List[Any]]]:
+        """method to buffer a record, returns the partitions that are ready to write"""
+        ready: List[Tuple[str, List[Any]]] = []
+        with self.lock:
+            self.partitions.setdefault(partition, []).append(record)
+            self.sizes[partition] = self.sizes.get(partition, 0) + size
+            self.counts[partition] = self.counts.get(partition, 0) + count
+            if (
+                self.counts[partition] >= self.max_records
+                or self.sizes[partition] >= self.max_bytes
+            ):
+                ready.append(self._pop(partition))
+            while len(self.partitions) > self.max_partitions:
+                ready.append(self._pop(next(iter(self.partitions))))
+        return ready
+
+    def drain(self) -> List[Tuple[str, List[Any]]]:
+        """method to hand back every buffered partition"""
+        with self.lock:
+            return [self._pop(partition) for partition in list(self.partitions)]
+
+
+class PartFileWriter:
+    """Mixin compacting payloads into part files, one folder per partition
+
+    The partition is the folder of the write path computed by verify_data, so the
+    folder hierarchy stays the same and each folder gets `part-<run>-<n>` files
+    instead of one file per payload. The payload file name is kept in the
+    `source_field` of each record (default `_source`, empty to disable). On flush,
+    the records of earlier runs whose source this run wrote again are removed from
+    their parts, so fetching a day again replaces it while the other payloads of
+    the partition (e.g the earlier days of a month) are kept. Without a source
+    field earlier parts are left untouched.
+    Subclasses provide `extension`, `encode_record`, `encode_part` and
+    `drop_sources`, and may override `write_part` and `reconcile_parts`. The
+    storage writer provides `write_bytes`, `read_bytes`, `list_parts` and
+    `delete_paths`.
+    """
+
+    extension: str = ""
+    max_records: int = 50000
+
+    def __init__(self, container: str, configs: dict, **kwargs):
+        super().__init__(container, configs, **kwargs)
+        self.source_field: Union[str, None] = configs.get("source_field", "_source")
+        self.buffer = PartitionBuffer(
+            max_records=int(configs.get("part_max_records", self.max_records)),
+            max_bytes=int(configs.get("part_max_bytes", 64 * 1024 * 1024)),
+            max_partitions=int(configs.get("max_open_partitions", 128)),
+        )
+        self.part_numbers: Dict[str, int] = {}
+        # e.g 20240602T101500-3f9a1c, tells the parts of this run from earlier ones
+        self.run_id: str = configs.get("run_id") or (
+            f"{datetime.now():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:6]}"
+        )
+        self.sources: Dict[str, set] = {}
+        self.sources_lock = threading.Lock()
+
+    def encode_record(self, data: Any, source: str) -> Tuple[Any, int, int]:
+        """method to convert a payload to a buffered record, its size in bytes and
+        the number of rows it holds"""
+        raise NotImplementedError
+
+    def encode_part(self, partition: str, records: List[Any]) -> bytes:
+        """method to convert buffered records to the part file content"""
+        raise NotImplementedError
+
+    def drop_sources(self, body: bytes, sources: set) -> Tuple[Union[bytes, None], int]:
+        """method to remove the records of the given sources from a part file
+
+        Returns:
+            Tuple[Union[bytes, None], int]: the part content, None when no record is
+                left, and the number of records removed
+        """
+        raise NotImplementedError
+
+    def write_data(self, write_path: str, data: Any, indent=None) -> None:
+        """method to buffer data in the folder of write_path"""
+        partition, _, source = write_path.rpartition("/")
+        record, size, count = self.encode_record(data, source)
+        with self.sources_lock:
+            self.sources.setdefault(partition, set()).add(source)
+        self._write_parts(self.buffer.add(partition, record, size, count))
+
+    def _write_parts(self, parts: List[Tuple[str, List[Any]]]) -> None:
+        for partition, records in parts:
+            number = self.part_numbers.get(partition, 0)
+            self.part_numbers[partition] = number + 1
+            file_name = f"part-{self.run_id}-{number:05d}{self.extension}"
+            part_path = f"{partition}/{file_name}" if partition else file_name
+            self.write_part(part_path, partition, records)
+
+    def write_part(self, part_path: str, partition: str, records: List[Any]) -> None:
+        """method to encode and write a part file"""
+        self.write_bytes(part_path, self.encode_part(partition, records))
+
+    def reconcile_parts(self) -> None:
+        """method to fix the parts of this run once every record was written"""
+
+    def replace_sources(self) -> None:
+        """method to remove the records this run wrote again from earlier parts"""
+        with self.sources_lock:
+            written, self.sources = self.sources, {}
+        if not self.source_field:
+            return
+        for partition, sources in written.items():
+            for path in self.list_parts(partition, prefix="part-"):
+                name = path.rsplit("/", maxsplit=1)[-1]
+                if name.startswith(f"part-{self.run_id}-") or not name.endswith(
+                    self.extension
+                ):
+                    continue
+                body, dropped = self.drop_sources(self.read_bytes(path), sources)
+                if not dropped:
+                    continue
+                print(f"replacing {dropped} records of {path}")
+                if body is None:
+                    self.delete_paths([path])
+                else:
+                    self.write_bytes(path, body)
+
+    def flush(self) -> None:
+        """method to write out every buffered partition
+
+        Earlier parts are only rewritten once the parts of this run are written, a
+        failure in between leaves duplicates rather than losing records.
+        """
+        self._write_parts(self.buffer.drain())
+        super().flush()
+        self.reconcile_parts()
+        self.replace_sources()
+        super().flush()
+
+    def close(self) -> None:
+        """method to write out every buffered partition and release the writer"""
+        self._write_parts(self.buffer.drain())
+        super().flush()
+        self.reconcile_parts()
+        self.replace_sources()
+        super().close()
+
+
+class NDJSONPartWriter(PartFileWriter):
+    """Part file writer for newline delimited json, gzip when compression: gzip"""
+
+    def __init__(self, container: str, configs: dict, **kwargs):
+        super().__init__(container, configs, **kwargs)
+        self.compression = configs.get("compression")
+        self.extension = ".ndjson.gz" if self.compression == "gzip" else ".ndjson"
+
+    def encode_record(self, data: Any, source: str) -> Tuple[bytes, int, int]:
+        if self.source_field and isinstance(data, dict):
+            data = {**data, self.source_field: source}
+        line = json.dumps(data, sort_keys=True, ensure_ascii=False) + "\n"
+        record = line.encode("utf8")
+        return record, len(record), 1
+
+    def encode_part(self, partition: str, records: List[bytes]) -> bytes:
+        body = b"".join(records)
+        if self.compression == "gzip":
+            return gzip.compress(body)
+        return body
+
+    def drop_sources(self, body: bytes, sources: set) -> Tuple[Union[bytes, None], int]:
+        content = gzip.decompress(body) if self.compression == "gzip" else body
+        lines = content.splitlines(keepends=True)
+        kept: List[bytes] = []
+        for line in lines:
+            record = json.loads(line)
+            if not (isinstance(record, dict) and record.get(self.source_field) in sources):
+                kept.append(line)
+        dropped = len(lines) - len(kept)
+        if not dropped:
+            return body, 0
+        return (self.encode_part("", kept) if kept else None), dropped
+
+
+class ParquetPartWriter(PartFileWriter):
+    """Part file writer converting tabular payloads to parquet
+
+    Accepts YouTube Analytics style `columnHeaders` + `rows` responses, pandas
+    DataFrames, lists of dicts and single dicts. Nested values are stored as json
+    strings. The column types of `columnHeaders` responses come from their
+    `dataType`, and their other scalar fields (e.g channelId, videoId) are added
+    to every row. Each endpoint (the partition path without its numeric date
+    folders) keeps one schema for the run: new columns are appended, integer
+    columns are promoted to float64 when floats show up and missing columns are
+    filled with nulls. The parts written before the schema changed are rewritten
+    with the final schema on flush, so every part file of the run has the same
+    schema.
+    """
+
+    extension: str = ".parquet"
+    max_records: int = 1000000
+    # arrow types of the `columnHeaders[].dataType` of YouTube Analytics responses
+    column_types: Dict[str, Any] = {
+        "STRING": "string",
+        "INTEGER": "int64",
+        "FLOAT": "float64",
+    }
+
+    def __init__(self, container: str, configs: dict, **kwargs):
+        if pa is None:
+            raise ImportError("the parquet destinations need pyarrow: pip install pyarrow")
+        super().__init__(container, configs, **kwargs)
+        self.row_group_size = int(configs.get("row_group_size", 100000))
+        self.compression = configs.get("compression", "snappy")
+        self.schemas: Dict[str, "pa.Schema"] = {}
+        self.schemas_lock = threading.Lock()
+        # schema key and schema each part of the run was written with
+        self.part_schemas: Dict[str, Tuple[str, "pa.Schema"]] = {}
+
+    @staticmethod
+    def schema_key(partition: str) -> str:
+        """method to get the endpoint a partition belongs to"""
+        return "/".join(
+            folder
+            for folder in partition.split("/")
+            if not re.fullmatch(r"[\d\-_]+", folder)
+        )
+
+    @staticmethod
+    def _flatten(value: Any) -> Any:
+        if isinstance(value, (dict, list)):
+            return json.dumps(value, sort_keys=True, ensure_ascii=False)
+        return value
+
+    def to_table(self, data: Any) -> "pa.Table":
+        """method to convert a tabular payload to an arrow table"""
+        if isinstance(data, pa.Table):
+            return data
+        if hasattr(data, "to_dict") and hasattr(data, "columns"):
+            return pa.Table.from_pandas(data, preserve_index=False)
+        if isinstance(data, dict) and "columnHeaders" in data:
+            rows = data.get("rows") or []
+            columns = {
+                header["name"]: pa.array(
+                    [self._flatten(row[index]) for row in rows],
+                    type=self.column_types.get(header.get("dataType", "")),
+                )
+                for index, header in enumerate(data["columnHeaders"])
+            }
+            # ids of the response e.g channelId, videoId
+            for key, value in data.items():
+                if key not in ["columnHeaders", "rows", *columns] and isinstance(
+                    value, (str, int, float, bool)
+                ):
+                    columns[key] = pa.array([value] * len(rows))
+            return pa.table(columns)
+        records = data if isinstance(data, list) else [data]
+        return pa.Table.from_pylist(
+            [
+                {key: self._flatten(value) for key, value in record.items()}
+                if isinstance(record, dict)
+                else {"value": self._flatten(record)}
+                for record in records
+            ]
+        )
+
+    def widen(self, key: str, tables: List["pa.Table"]) -> "pa.Schema":
+        """method to add the columns not seen yet to the schema of an endpoint"""
+        with self.schemas_lock:
+            schema = self.schemas.get(key, pa.schema([]))
+            for field in (field for table in tables for field in table.schema):
+                index = schema.get_field_index(field.name)
+                if index == -1:
+                    schema = schema.append(field)
+                elif pa.types.is_null(schema.field(index).type):
+                    schema = schema.set(index, field)
+                elif pa.types.is_integer(schema.field(index).type) and (
+                    pa.types.is_floating(field.type)
+                ):
+                    # a float column whose first values were whole numbers
+                    schema = schema.set(index, pa.field(field.name, pa.float64()))
+            self.schemas[key] = schema
+        return schema
+
+    @staticmethod
+    def conform(table: "pa.Table", schema: "pa.Schema") -> "pa.Table":
+        """method to cast a table to the endpoint schema, missing columns are nulls"""
+        return pa.Table.from_arrays(
+            [
+                table.column(field.name).cast(field.type)
+                if field.name in table.column_names
+                else pa.nulls(table.num_rows, field.type)
+                for field in schema
+            ],
+            schema=schema,
+        )
+
+    def encode_record(self, data: Any, source: str) -> Tuple["pa.Table", int, int]:
+        table = self.to_table(data)
+        if self.source_field:
+            table = table.append_column(
+                self.source_field, pa.array([source] * table.num_rows, pa.string())
+            )
+        return table, table.nbytes, table.num_rows
+
+    def part_table(self, partition: str, records: List["pa.Table"]) -> "pa.Table":
+        """method to combine buffered tables with the current schema of the endpoint"""
+        schema = self.widen(self.schema_key(partition), records)
+        return pa.concat_tables([self.conform(record, schema) for record in records])
+
+    def encode_part(self, partition: str, records: List["pa.Table"]) -> bytes:
+        return self._write_table(self.part_table(partition, records))
+
+    def write_part(self, part_path: str, partition: str, records: List[Any]) -> None:
+        table = self.part_table(partition, records)
+        with self.schemas_lock:
+            self.part_schemas[part_path] = (self.schema_key(partition), table.schema)
+        self.write_bytes(part_path, self._write_table(table))
+
+    def reconcile_parts(self) -> None:
+        """method to rewrite the parts whose schema was widened after they were written"""
+        with self.schemas_lock:
+            stale = [
+                (path, key)
+                for path, (key, schema) in self.part_schemas.items()
+                if not schema.equals(self.schemas[key])
+            ]
+        for path, key in stale:
+            schema = self.schemas[key]
+            table = pq.read_table(io.BytesIO(self.read_bytes(path)))
+            self.write_bytes(path, self._write_table(self.conform(table, schema)))
+            with self.schemas_lock:
+                self.part_schemas[path] = (key, schema)
+        if stale:
+            print(f"rewrote {len(stale)} parts with the final schema of their endpoint")
+
+    def _write_table(self, table: "pa.Table") -> bytes:
+        body = io.BytesIO()
+        pq.write_table(
+            table,
+            body,
+            row_group_size=self.row_group_size,
+            compression=self.compression,
+        )
+        return body.getvalue()
+
+    def drop_sources(self, body: bytes, sources: set) -> Tuple[Union[bytes, None], int]:
+        table = pq.read_table(io.BytesIO(body))
+        if self.source_field not in table.column_names:
+            return body, 0
+        mask = pc.is_in(
+            table.column(self.source_field),
+            value_set=pa.array(sorted(sources), pa.string()),
+        )
+        dropped = pc.sum(mask).as_py() or 0
+        if not dropped:
+            return body, 0
+        kept = table.filter(pc.invert(mask))
+        return (self._write_table(kept) if kept.num_rows else None), dropped
+
 
 class LocalWriter(DataWriter):
     """Class for Writting Data to Azure"""
@@ -137,6 +662,30 @@ class LocalWriter(DataWriter):
             print(f"error checking path \n{err}")
             return False
 
+    def list_parts(self, folder: str, prefix: str) -> List[str]:
+        """method to list the files of a folder whose name starts with prefix"""
+        files = Path(f"{self.container}/{folder}").glob(f"{prefix}*")
+        return sorted(
+            f"{folder}/{file.name}" if folder else file.name
+            for file in files
+            if file.is_file()
+        )
+
+    def read_bytes(self, read_path: str) -> bytes:
+        """method to read a file of the container"""
+        return Path(f"{self.container}/{read_path}").read_bytes()
+
+    def delete_paths(self, paths: List[str]) -> None:
+        """method to delete files of the container"""
+        _ = [Path(f"{self.container}/{path}").unlink(missing_ok=True) for path in paths]
+
+    def write_bytes(self, write_path: str, body: bytes) -> None:
+        """method to write already encoded data to a file"""
+        self.check_exists(write_path=write_path)
+        with open(f"{self.container}/{write_path}", mode="wb") as dest_file:
+            dest_file.write(body)
+            print(f"done writting data to {self.container}/{write_path}")
+
 
 class LocalJSONWriter(LocalWriter):
     """class for wrtting to json on local directory"""
@@ -174,6 +723,14 @@ class LocalCSVWriter(LocalWriter):
             print(f"done writting data to {self.container}/{write_path}")
 
 
+class LocalNDJSONWriter(NDJSONPartWriter, LocalWriter):
+    """class for writting compacted ndjson part files on local directory"""
+
+
+class LocalParquetWriter(ParquetPartWriter, LocalWriter):
+    """class for writting parquet part files on local directory"""
+
+
 class AzureWriter(DataWriter):
     """Class for Writting Data to Azure"""
 
@@ -187,25 +744,144 @@ class AzureWriter(DataWriter):
         self.container = container
         self.overwrite = configs.get("overwrite", True)
         self.configs = configs
+        self.container_client: ContainerClient = self.service.get_container_client(
+            container=container
+        )
+        self.containers = (
+            CONTAINER_REGISTRY
+            if configs.get("share_container_cache")
+            else ContainerRegistry()
+        )
+        self.uploader: Union[UploadPool, None] = None
+        if workers := configs.get("upload_workers"):
+            self.uploader = UploadPool(
+                self.upload,
+                workers=int(workers),
+                max_queue=configs.get("upload_queue_size"),
+                max_inflight_bytes=configs.get("max_inflight_bytes", 64 * 1024 * 1024),
+            )
 
-    def check_exists(self, container_name: str):
-        """method to check if container name exists"""
-        containers = list(self.service.list_containers())
+    def _container_key(self, container_name: str) -> str:
+        """method to get the registry key of a container"""
+        return f"{self.service.account_name}/{container_name}"
+
+    def _list_or_create(self, container_name: str) -> bool:
+        """method to list the container and create it when missing"""
+        containers = list(self.service.list_containers(name_starts_with=container_name))
         exists = any([True for cont in containers if cont.name == container_name])
         if not exists:
-            exists = self.service.create_container(name=container_name).exists()
+            try:
+                exists = self.service.create_container(name=container_name).exists()
+            except ResourceExistsError:
+                exists = True
         return exists
 
-    def clear_destination(self, full_path: str):
-        """method to clear destination"""
-        container = self.service.get_container_client(container=self.container)
-        # blobs = [pth for pth in container.walk_blobs() if pth == full_path]
-        _ = [
-            container.delete_blob(blob)
-            for blob in container.walk_blobs()
-            if blob.name.rsplit("/", maxsplit=1)[0] == full_path
+    def check_exists(self, container_name: str):
+        """method to check if container name exists, listing it once per registry"""
+        return self.containers.ensure(
+            self._container_key(container_name),
+            lambda: self._list_or_create(container_name),
+        )
+
+    def upload(self, write_path: str, body: bytes) -> None:
+        """method to upload a blob through the shared container client"""
+        try:
+            self.container_client.upload_blob(
+                name=write_path, data=body, overwrite=self.overwrite
+            )
+        except ResourceNotFoundError as err:
+            if err.error_code != "ContainerNotFound" or (
+                self.configs.get("auth_method") == "sas_token"
+            ):
+                raise
+            self.containers.invalidate(self._container_key(self.container))
+            self.check_exists(container_name=self.container)
+            self.container_client.upload_blob(
+                name=write_path, data=body, overwrite=self.overwrite
+            )
+        print(f"done writting data to {self.container}/{write_path}")
+
+    def write_bytes(self, write_path: str, body: bytes) -> None:
+        """method to upload already encoded data, queued when upload_workers is set"""
+        if self.configs["auth_method"] != "sas_token":
+            _ = self.check_exists(container_name=self.container)
+        if self.uploader:
+            self.uploader.submit(write_path, body)
+            return
+        self.upload(write_path, body)
+
+    def flush(self) -> None:
+        """method to wait for the queued uploads, raises UploadError on failures"""
+        if self.uploader:
+            self.uploader.flush()
+
+    def close(self) -> None:
+        """method to flush and stop the upload workers"""
+        if self.uploader:
+            self.uploader.close()
+            self.uploader = None
+        if self.containers.checks:
+            print(
+                f"container listing calls: {self.containers.checks}, "
+                f"saved: {self.containers.saved}"
+            )
+
+    def _delete_batch(self, names: List[str]) -> None:
+        """method to delete up to 256 blobs in a single batch request"""
+        _ = list(self.container_client.delete_blobs(*names))
+
+    def clear_destination(self, full_path: str) -> int:
+        """method to clear the blobs sitting directly in the full_path folder
+
+        Only lists the blobs under the folder prefix and deletes them through the
+        batch api, 256 blobs per request with `delete_workers` requests in parallel.
+        Returns:
+            int: number of blobs deleted
+        """
+        start_time = time.perf_counter()
+        prefix = f"{full_path.strip('/')}/"
+        names: List[str] = [
+            blob.name
+            for blob in self.container_client.walk_blobs(
+                name_starts_with=prefix, delimiter="/"
+            )
+            if not isinstance(blob, BlobPrefix)
+        ]
+        batches = [names[pos : pos + 256] for pos in range(0, len(names), 256)]
+        if batches:
+            workers = min(int(self.configs.get("delete_workers", 4)), len(batches))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                _ = list(executor.map(self._delete_batch, batches))
+        print(
+            f"deleted {len(names)} blobs in {self.container}/{prefix} "
+            f"in {time.perf_counter() - start_time:.2f} seconds"
+        )
+        return len(names)
+
+    def delete_destination(self, delete_path: str) -> None:
+        """method to clear destination before writting data into it"""
+        self.clear_destination(full_path=delete_path)
+
+    def list_parts(self, folder: str, prefix: str) -> List[str]:
+        """method to list the blobs of a folder whose name starts with prefix"""
+        folder = f"{folder.strip('/')}/" if folder.strip("/") else ""
+        return [
+            blob.name
+            for blob in self.container_client.list_blobs(
+                name_starts_with=f"{folder}{prefix}"
+            )
+            if "/" not in blob.name[len(folder) :]
         ]
 
+    def read_bytes(self, read_path: str) -> bytes:
+        """method to download a blob"""
+        return self.container_client.download_blob(read_path).readall()
+
+    def delete_paths(self, paths: List[str]) -> None:
+        """method to delete blobs, 256 per batch request"""
+        for pos in range(0, len(paths), 256):
+            self._delete_batch(paths[pos : pos + 256])
+
 
 class AzureJSONWriter(AzureWriter):
     """class to write JSON Objects to Azure"""
@@ -214,19 +890,17 @@ class AzureJSONWriter(AzureWriter):
         self, write_path: str, data: Union[Dict[Any, Any], List[Any]], indent=None
     ):
         """method to write data"""
+        write_path = f"{write_path}.json"
+        body = json.dumps(data, indent=indent, sort_keys=True, ensure_ascii=False)
+        self.write_bytes(write_path, body.encode("utf8"))
 
-        if self.configs["auth_method"] != "sas_token":
-            _ = self.check_exists(container_name=self.container)
 
-        write_path = f"{write_path}.json"
-        blob_client: BlobClient = self.service.get_blob_client(
-            container=self.container, blob=write_path
-        )
-        blob_client.upload_blob(
-            json.dumps(data, indent=indent, sort_keys=True, ensure_ascii=False),
-            overwrite=self.overwrite,
-        )
-        print(f"done writting data to {self.container}/{write_path}")
+class AzureNDJSONWriter(NDJSONPartWriter, AzureWriter):
+    """class to write compacted ndjson part files to Azure"""
+
+
+class AzureParquetWriter(ParquetPartWriter, AzureWriter):
+    """class to write parquet part files to Azure"""
 
 
 class BaseWriter(ABC):
@@ -249,8 +923,12 @@ class BaseWriter(ABC):
     def __get_service(self):
         services = {
             "azure_json": AzureJSONWriter,
+            "azure_ndjson": AzureNDJSONWriter,
+            "azure_parquet": AzureParquetWriter,
             "local_json": LocalJSONWriter,
             "local_csv": LocalCSVWriter,
+            "local_ndjson": LocalNDJSONWriter,
+            "local_parquet": LocalParquetWriter,
         }
 
         service = services[self.destination](self.container, self.configs)
@@ -283,3 +961,17 @@ class BaseWriter(ABC):
             self.service.delete_destination(delete_path=delete_path)
             self.curr_path = delete_path
         self.service.write_data(write_path, data, indent)
+
+    def flush(self) -> None:
+        """method to wait until every payload sunk so far is written"""
+        self.service.flush()
+
+    def close(self) -> None:
+        """method to flush pending writes and release the writer"""
+        self.service.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,5 @@
+"""make the datalake modules importable the way the pipelines import them"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
@@ -0,0 +1,529 @@
+"""TESTS FOR THE BASE WRITERS"""
+import gzip
+import json
+import os
+import threading
+import time
+import uuid
+
+import pytest
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from azure.storage.blob import BlobPrefix
+
+from base_writers import (
+    AzureJSONWriter,
+    ContainerRegistry,
+    LocalJSONWriter,
+    UploadError,
+    UploadPool,
+)
+
+AZURITE = os.getenv("AZURITE_CONNECTION_STRING")
+
+
+class FakeBlob:
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeDownload:
+    def __init__(self, body):
+        self.body = body
+
+    def readall(self):
+        return self.body
+
+
+class FakeContainerClient:
+    """in memory blob container, uploads answer after `latency` seconds"""
+
+    def __init__(self, latency: float = 0.0, fail=()):
+        self.latency = latency
+        self.fail = set(fail)
+        self.blobs = {}
+        self.lock = threading.Lock()
+        self.missing = False
+        self.batches = []
+
+    def upload_blob(self, name, data, overwrite=True):
+        time.sleep(self.latency)
+        if self.missing:
+            self.missing = False
+            err = ResourceNotFoundError("the container does not exist")
+            err.error_code = "ContainerNotFound"
+            raise err
+        if name in self.fail:
+            raise ConnectionError(f"upload of {name} failed")
+        with self.lock:
+            self.blobs[name] = data
+
+    def walk_blobs(self, name_starts_with="", delimiter="/"):
+        folders = set()
+        for name in sorted(self.blobs):
+            if not name.startswith(name_starts_with):
+                continue
+            rest = name[len(name_starts_with) :]
+            if delimiter in rest:
+                folders.add(name_starts_with + rest.split(delimiter)[0] + delimiter)
+                continue
+            yield FakeBlob(name)
+        for folder in sorted(folders):
+            yield BlobPrefix(prefix=folder)
+
+    def download_blob(self, name):
+        return FakeDownload(self.blobs[name])
+
+    def list_blobs(self, name_starts_with=""):
+        return [FakeBlob(name) for name in sorted(self.blobs) if name.startswith(name_starts_with)]
+
+    def delete_blobs(self, *names):
+        assert len(names) <= 256, "the batch api deletes at most 256 blobs per request"
+        with self.lock:
+            self.batches.append(len(names))
+            for name in names:
+                del self.blobs[name]
+        return [None] * len(names)
+
+
+class FakeContainer:
+    def __init__(self, name):
+        self.name = name
+
+    def exists(self):
+        return True
+
+
+class FakeService:
+    """blob service client with a single container"""
+
+    account_name = "account"
+
+    def __init__(self, container_client):
+        self.container_client = container_client
+        self.containers = ["container"]
+        self.list_calls = 0
+
+    def get_container_client(self, container):
+        return self.container_client
+
+    def list_containers(self, name_starts_with=""):
+        self.list_calls += 1
+        return [FakeContainer(name) for name in self.containers if name.startswith(name_starts_with)]
+
+    def create_container(self, name):
+        if name in self.containers:
+            raise ResourceExistsError("the container already exists")
+        self.containers.append(name)
+        return FakeContainer(name)
+
+
+def fake_authenticator(service):
+    class Authenticator:
+        def authenticate(self, configs):
+            return service
+
+    return Authenticator
+
+
+def azure_writer(writer_class, container_client, service=None, **configs):
+    service = service or FakeService(container_client)
+    configs = {"auth_method": "connection_string", **configs}
+    return writer_class("container", configs, authenticator=fake_authenticator(service))
+
+
+def test_upload_pool_flush_waits_for_every_upload():
+    uploaded = []
+    lock = threading.Lock()
+
+    def upload(name, body):
+        time.sleep(0.001)
+        with lock:
+            uploaded.append(name)
+
+    pool = UploadPool(upload, workers=4, max_queue=2)
+    _ = [pool.submit(f"blob-{number}", b"x") for number in range(50)]
+    pool.flush()
+    assert sorted(uploaded) == sorted(f"blob-{number}" for number in range(50))
+    assert pool.inflight_bytes == 0
+    pool.close()
+    assert not any(thread.is_alive() for thread in pool.threads)
+
+
+def test_upload_pool_raises_the_failed_uploads_once():
+    def upload(name, body):
+        if name == "bad":
+            raise ConnectionError("reset")
+
+    pool = UploadPool(upload, workers=2)
+    pool.submit("good", b"x")
+    pool.submit("bad", b"x")
+    with pytest.raises(UploadError, match="1 uploads failed\nbad: reset"):
+        pool.flush()
+    pool.flush()
+    pool.close()
+
+
+def test_upload_pool_close_stops_the_workers_even_on_errors():
+    pool = UploadPool(lambda name, body: 1 / 0, workers=3)
+    pool.submit("blob", b"x")
+    with pytest.raises(UploadError):
+        pool.close()
+    assert not any(thread.is_alive() for thread in pool.threads)
+
+
+def test_upload_pool_bounds_the_bytes_in_flight():
+    peak = []
+    lock = threading.Lock()
+    pool = None
+
+    def upload(name, body):
+        with lock:
+            peak.append(pool.inflight_bytes)
+        time.sleep(0.002)
+
+    pool = UploadPool(upload, workers=8, max_inflight_bytes=30)
+    _ = [pool.submit(f"blob-{number}", b"0123456789") for number in range(20)]
+    pool.close()
+    assert max(peak) <= 30
+
+
+def test_azure_json_writer_queues_uploads_until_flush():
+    container_client = FakeContainerClient(latency=0.001)
+    writer = azure_writer(AzureJSONWriter, container_client, upload_workers=4)
+    _ = [writer.write_data(f"folder/{number}", {"n": number}) for number in range(20)]
+    writer.flush()
+    assert len(container_client.blobs) == 20
+    assert container_client.blobs["folder/3.json"] == b'{"n": 3}'
+    writer.close()
+    assert writer.uploader is None
+
+
+def test_azure_json_writer_flush_raises_failed_uploads():
+    container_client = FakeContainerClient(fail={"folder/1.json"})
+    writer = azure_writer(AzureJSONWriter, container_client, upload_workers=2)
+    _ = [writer.write_data(f"folder/{number}", {"n": number}) for number in range(3)]
+    with pytest.raises(UploadError, match="folder/1.json"):
+        writer.close()
+
+
+def test_container_registry_checks_each_container_once():
+    registry = ContainerRegistry()
+    calls = []
+    check = lambda: calls.append(1) or True  # noqa: E731
+    assert all(registry.ensure("account/container", check) for _ in range(5))
+    assert len(calls) == 1
+    assert (registry.checks, registry.saved) == (1, 4)
+
+
+def test_container_registry_does_not_keep_missing_containers():
+    registry = ContainerRegistry()
+    assert not registry.ensure("account/container", lambda: False)
+    assert registry.ensure("account/container", lambda: True)
+    registry.invalidate("account/container")
+    assert registry.checks == 2 and not registry.containers
+
+
+def test_concurrent_writers_racing_to_create_a_container():
+    service = FakeService(FakeContainerClient())
+    service.containers = []
+    barrier = threading.Barrier(8)
+    list_containers = service.list_containers
+
+    def racing_list(name_starts_with=""):
+        # every thread lists before anyone creates the container
+        containers = list_containers(name_starts_with)
+        barrier.wait()
+        return containers
+
+    service.list_containers = racing_list
+    writer = azure_writer(AzureJSONWriter, service.container_client, service=service)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(writer.check_exists("container")))
+        for _ in range(8)
+    ]
+    _ = [thread.start() for thread in threads]
+    _ = [thread.join() for thread in threads]
+    assert results == [True] * 8
+    assert service.containers == ["container"]
+    # once registered the container is not listed again
+    writer.write_data("folder/blob", {})
+    assert service.list_calls == 8
+
+
+def test_upload_recreates_a_container_deleted_during_the_run():
+    container_client = FakeContainerClient()
+    service = FakeService(container_client)
+    writer = azure_writer(AzureJSONWriter, container_client, service=service)
+    writer.write_data("folder/first", {})
+    container_client.missing = True
+    writer.write_data("folder/second", {})
+    assert set(container_client.blobs) == {"folder/first.json", "folder/second.json"}
+    assert service.list_calls == 2
+
+
+def test_clear_destination_only_deletes_the_folder_blobs():
+    container_client = FakeContainerClient()
+    container_client.blobs = {f"channel/2024/01/{number}.json": b"" for number in range(600)}
+    container_client.blobs.update(
+        {
+            "channel/2024/01/nested/keep.json": b"",
+            "channel/2024/010/keep.json": b"",
+            "channel/2024/keep.json": b"",
+        }
+    )
+    writer = azure_writer(AzureJSONWriter, container_client, delete_workers=2)
+    assert writer.clear_destination("/channel/2024/01/") == 600
+    assert sorted(container_client.batches) == [88, 256, 256]
+    assert sorted(container_client.blobs) == [
+        "channel/2024/01/nested/keep.json",
+        "channel/2024/010/keep.json",
+        "channel/2024/keep.json",
+    ]
+
+
+def test_delete_destination_of_an_empty_folder():
+    container_client = FakeContainerClient()
+    writer = azure_writer(AzureJSONWriter, container_client)
+    writer.delete_destination("channel/2024/01")
+    assert not container_client.batches
+
+
+def test_local_delete_destination_keeps_sub_folders(tmp_path):
+    writer = LocalJSONWriter(str(tmp_path), {})
+    writer.write_data("channel/2024/01/first", {})
+    writer.write_data("channel/2024/01/nested/second", {})
+    writer.delete_destination("channel/2024/01")
+    assert [path.name for path in tmp_path.rglob("*.json")] == ["second.json"]
+
+
+def upload_time(container_client, blobs: int, **configs) -> float:
+    writer = azure_writer(AzureJSONWriter, container_client, **configs)
+    start = time.perf_counter()
+    _ = [writer.write_data(f"bench/{number}", {"n": number}) for number in range(blobs)]
+    writer.close()
+    return time.perf_counter() - start
+
+
+@pytest.mark.benchmark
+def test_benchmark_pooled_uploads_on_a_slow_store():
+    # 200 blobs on a store answering in 5ms: ~1s one by one
+    serial = upload_time(FakeContainerClient(latency=0.005), 200)
+    pooled = upload_time(FakeContainerClient(latency=0.005), 200, upload_workers=8)
+    print(f"200 blobs: serial {serial:.2f}s, 8 upload workers {pooled:.2f}s")
+    assert pooled < serial / 3
+
+
+@pytest.mark.benchmark
+@pytest.mark.skipif(not AZURITE, reason="set AZURITE_CONNECTION_STRING to run against Azurite")
+def test_benchmark_pooled_uploads_on_azurite():
+    # e.g docker run -p 10000:10000 mcr.microsoft.com/azure-storage/azurite azurite-blob
+    blobs = int(os.getenv("AZURITE_BLOBS", "10000"))
+    timings = {}
+    for workers in [0, 16]:
+        container = f"bench-{uuid.uuid4().hex[:12]}"
+        configs = {
+            "auth_method": "connection_string",
+            "AZURE_STORAGE_CONNECTION_STRING": AZURITE,
+            "upload_workers": workers,
+        }
+        writer = AzureJSONWriter(container, configs)
+        start = time.perf_counter()
+        _ = [writer.write_data(f"bench/{number}", {"n": number}) for number in range(blobs)]
+        writer.close()
+        timings[workers] = time.perf_counter() - start
+        writer.service.delete_container(container)
+    print(f"{blobs} blobs on azurite: serial {timings[0]:.1f}s, 16 workers {timings[16]:.1f}s")
+    assert timings[16] < timings[0]
+
+
+def meta_payload(post: str, day: str, value: int) -> dict:
+    year, month, _ = day.split("-")
+    return {
+        "data": {"id": post, "value": value},
+        "date": day,
+        "file_name": f"page/{post}/{year}/{month}/{day}-{post}",
+    }
+
+
+def run_meta_writer(tmp_path, destination, payloads, **configs):
+    from GE_meta_engagement.writer import MetaWriter
+
+    with MetaWriter(str(tmp_path), destination, configs) as writer:
+        for payload in payloads:
+            writer.sink(payload, folder_name="meta", folder_path="posts")
+
+
+def read_ndjson(folder) -> list:
+    return sorted(
+        (json.loads(line) for part in folder.glob("part-*") for line in part.read_text().splitlines()),
+        key=lambda record: record["_source"],
+    )
+
+
+def test_part_files_keep_the_earlier_days_of_a_partition(tmp_path):
+    # the meta partitions are months, every daily run adds its snapshot
+    run_meta_writer(tmp_path, "local_ndjson", [meta_payload("p1", "2024-06-01", 1)])
+    run_meta_writer(tmp_path, "local_ndjson", [meta_payload("p1", "2024-06-02", 2)])
+    records = read_ndjson(tmp_path / "meta/posts/page/p1/2024/06")
+    assert [(record["_source"], record["value"]) for record in records] == [
+        ("2024-06-01-p1", 1),
+        ("2024-06-02-p1", 2),
+    ]
+
+
+def test_part_files_replace_a_payload_written_again(tmp_path):
+    run_meta_writer(
+        tmp_path,
+        "local_ndjson",
+        [meta_payload("p1", "2024-06-01", 1), meta_payload("p2", "2024-06-01", 1)],
+        part_max_records=1,
+    )
+    run_meta_writer(tmp_path, "local_ndjson", [meta_payload("p1", "2024-06-01", 5)])
+    folder = tmp_path / "meta/posts/page/p1/2024/06"
+    assert [record["value"] for record in read_ndjson(folder)] == [5]
+    # the emptied part of the first run is removed
+    assert len(list(folder.glob("part-*"))) == 1
+    assert len(read_ndjson(tmp_path / "meta/posts/page/p2/2024/06")) == 1
+
+
+def test_gzip_part_files_replace_only_the_sources_written_again(tmp_path):
+    payloads = [meta_payload("p1", "2024-06-01", 1), meta_payload("p1", "2024-06-02", 1)]
+    run_meta_writer(tmp_path, "local_ndjson", payloads, compression="gzip")
+    run_meta_writer(
+        tmp_path, "local_ndjson", [meta_payload("p1", "2024-06-02", 7)], compression="gzip"
+    )
+    folder = tmp_path / "meta/posts/page/p1/2024/06"
+    records = [
+        json.loads(line)
+        for part in folder.glob("part-*.ndjson.gz")
+        for line in gzip.decompress(part.read_bytes()).splitlines()
+    ]
+    assert sorted((record["_source"], record["value"]) for record in records) == [
+        ("2024-06-01-p1", 1),
+        ("2024-06-02-p1", 7),
+    ]
+
+
+def test_parquet_part_files_replace_only_the_sources_written_again(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    payloads = [meta_payload("p1", "2024-06-01", 1), meta_payload("p1", "2024-06-02", 1)]
+    run_meta_writer(tmp_path, "local_parquet", payloads)
+    run_meta_writer(tmp_path, "local_parquet", [meta_payload("p1", "2024-06-02", 7)])
+    table = pq.read_table(tmp_path / "meta/posts/page/p1/2024/06")
+    assert sorted(zip(table["_source"].to_pylist(), table["value"].to_pylist())) == [
+        ("2024-06-01-p1", 1),
+        ("2024-06-02-p1", 7),
+    ]
+
+
+def test_azure_part_files_replace_the_sources_written_again():
+    from base_writers import AzureNDJSONWriter
+
+    container_client = FakeContainerClient()
+    for value in [1, 2]:
+        writer = azure_writer(AzureNDJSONWriter, container_client, upload_workers=2)
+        writer.write_data("posts/2024/06/2024-06-01-p1", {"value": value})
+        writer.write_data(f"posts/2024/06/2024-06-0{value + 1}-p1", {"value": value})
+        writer.close()
+    records = sorted(
+        (json.loads(line)["_source"], json.loads(line)["value"])
+        for body in container_client.blobs.values()
+        for line in body.splitlines()
+    )
+    assert records == [("2024-06-01-p1", 2), ("2024-06-02-p1", 1), ("2024-06-03-p1", 2)]
+
+
+@pytest.mark.benchmark
+def test_benchmark_part_files_against_one_file_per_payload(tmp_path):
+    payloads = [
+        {
+            "data": {"id": f"v{number}", "rows": [[day, number] for day in range(30)]},
+            "date": "2024-06-01",
+            "file_name": f"channel/2024/06/2024-06-01-v{number}",
+        }
+        for number in range(3000)
+    ]
+    timings = {}
+    for destination in ["local_json", "local_ndjson"]:
+        start = time.perf_counter()
+        run_meta_writer(tmp_path / destination, destination, payloads)
+        written = time.perf_counter() - start
+        start = time.perf_counter()
+        files = [path for path in (tmp_path / destination).rglob("*") if path.is_file()]
+        records = sum(len(path.read_text().splitlines()) for path in files)
+        timings[destination] = (written, time.perf_counter() - start, len(files))
+        assert records
+    print(
+        "3000 payloads (write, read, files): "
+        + ", ".join(f"{name} {write:.2f}s {read:.3f}s {files}" for name, (write, read, files) in timings.items())
+    )
+    assert timings["local_ndjson"][2] == 1
+    assert timings["local_ndjson"][1] < timings["local_json"][1]
+
+
+def video_stats(video: str, views: list, **extra) -> dict:
+    return {
+        "kind": "youtubeAnalytics#resultTable",
+        "columnHeaders": [
+            {"name": "day", "dataType": "STRING"},
+            {"name": "views", "dataType": "INTEGER"},
+            {"name": "averageViewDuration", "dataType": "FLOAT"},
+        ],
+        "rows": [[f"2024-06-0{day + 1}", value, 1] for day, value in enumerate(views)],
+        "channelId": "UC1",
+        "videoId": video,
+        **extra,
+    }
+
+
+def test_parquet_columns_follow_the_column_headers(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    from base_writers import LocalParquetWriter
+
+    writer = LocalParquetWriter(str(tmp_path), {})
+    writer.write_data("video_stats/2024/06/2024-06-01-v1", video_stats("v1", [3, 4]))
+    writer.close()
+    table = pq.read_table(next((tmp_path / "video_stats/2024/06").glob("part-*")))
+    assert table.schema.names == [
+        "day", "views", "averageViewDuration", "kind", "channelId", "videoId", "_source",
+    ]
+    assert str(table.schema.field("views").type) == "int64"
+    # 1 is a FLOAT column, not an integer one
+    assert str(table.schema.field("averageViewDuration").type) == "double"
+    assert table["videoId"].to_pylist() == ["v1", "v1"]
+    assert table["channelId"].to_pylist() == ["UC1", "UC1"]
+
+
+def test_parquet_parts_of_a_run_share_the_final_schema(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    from base_writers import LocalParquetWriter
+
+    writer = LocalParquetWriter(str(tmp_path), {"part_max_records": 1})
+    writer.write_data("posts/2024/06/p1", {"id": "p1", "likes": 1})
+    writer.write_data("posts/2024/06/p2", {"id": "p2", "likes": 2.5, "shares": 1})
+    writer.write_data("posts/2024/07/p3", {"id": "p3", "comments": [{"text": "hi"}]})
+    writer.close()
+    parts = sorted(tmp_path.rglob("part-*.parquet"))
+    schemas = [pq.read_schema(part) for part in parts]
+    assert len(parts) == 3
+    assert all(schema.equals(schemas[0]) for schema in schemas)
+    assert schemas[0].names == ["id", "likes", "_source", "shares", "comments"]
+    assert str(schemas[0].field("likes").type) == "double"
+    table = pq.read_table(parts[0])
+    assert table["likes"].to_pylist() == [1.0]
+    assert table["shares"].to_pylist() == [None]
+    assert pq.read_table(parts[2])["comments"].to_pylist() == ['[{"text": "hi"}]']
+
+
+def test_parquet_reads_dataframes(tmp_path):
+    pd = pytest.importorskip("pandas")
+    pq = pytest.importorskip("pyarrow.parquet")
+    from base_writers import LocalParquetWriter
+
+    frame = pd.DataFrame({"contact": ["a", "b"], "runs": [1, 2]})
+    writer = LocalParquetWriter(str(tmp_path), {"source_field": ""})
+    writer.write_data("contacts/2024-06-01", frame)
+    writer.close()
+    table = pq.read_table(next(tmp_path.glob("contacts/part-*")))
+    assert table.to_pydict() == {"contact": ["a", "b"], "runs": [1, 2]}
@@ -0,0 +1,39 @@
+"""TESTS FOR THE CONCURRENCY HELPERS"""
+import threading
+import time
+
+from utils.concurrency import ordered_map
+
+
+def test_ordered_map_keeps_the_task_order():
+    def slow_square(value):
+        time.sleep(0.01 * (5 - value))
+        return value * value
+
+    tasks = [(value,) for value in range(5)]
+    assert list(ordered_map(slow_square, tasks, workers=4)) == [0, 1, 4, 9, 16]
+
+
+def test_ordered_map_runs_serially_with_one_worker():
+    threads = set()
+
+    def record(value):
+        threads.add(threading.get_ident())
+        return value
+
+    assert list(ordered_map(record, [(1,), (2,)], workers=1)) == [1, 2]
+    assert threads == {threading.get_ident()}
+
+
+def test_ordered_map_consumes_tasks_lazily():
+    consumed = []
+
+    def tasks():
+        for value in range(100):
+            consumed.append(value)
+            yield (value,)
+
+    results = ordered_map(lambda value: value, tasks(), workers=2, prefetch=2)
+    assert next(results) == 0
+    assert len(consumed) <= 5
+    results.close()
@@ -0,0 +1,257 @@
+"""TESTS FOR THE GA4 REPORTS AGAINST A FAKE DATA API CLIENT"""
+import os
+import time
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("google.analytics.data_v1beta")
+
+from google.analytics.data_v1beta.types import (
+    DimensionHeader,
+    DimensionValue,
+    MetricHeader,
+    MetricType,
+    MetricValue,
+    PropertyQuota,
+    QuotaStatus,
+    Row,
+    RunReportRequest,
+    RunReportResponse,
+)
+
+from GE_GA import retrieve_GoogleAnalyticsG4 as ga4
+from utils.rate_limiter import AdaptiveRateLimiter
+
+PROPERTY = {
+    "account_id": "1",
+    "account_name": "account",
+    "property_id": "2",
+    "property_name": "property",
+    "start_date": "2024-01-01",
+    "end_date": "2024-01-31",
+}
+CONFIGS = {"dimensions": ["date", "country"], "metrics": ["sessions", "bounceRate"]}
+
+
+def report_row(number):
+    return Row(
+        dimension_values=[
+            DimensionValue(value=f"202401{number % 31 + 1:02d}"),
+            DimensionValue(value=f"country {number}"),
+        ],
+        metric_values=[MetricValue(value=str(number)), MetricValue(value="0.5")],
+    )
+
+
+class FakeDataClient:
+    """BetaAnalyticsDataClient.run_report over `rows` report rows, `lost` of them
+    counted in row_count but never returned"""
+
+    def __init__(self, rows, lost=0, quota=None):
+        self.rows = [report_row(number) for number in range(rows)]
+        self.lost = lost
+        self.quota = quota
+        self.requests = []
+
+    def run_report(self, request):
+        self.requests.append((request.offset, request.limit, request.return_property_quota))
+        rows = self.rows[: len(self.rows) - self.lost]
+        return RunReportResponse(
+            dimension_headers=[DimensionHeader(name="date"), DimensionHeader(name="country")],
+            metric_headers=[
+                MetricHeader(name="sessions", type_=MetricType.TYPE_INTEGER),
+                MetricHeader(name="bounceRate", type_=MetricType.TYPE_FLOAT),
+            ],
+            rows=rows[request.offset : request.offset + request.limit],
+            row_count=len(self.rows),
+            property_quota=self.quota,
+        )
+
+
+def report_request():
+    return RunReportRequest(property="properties/2")
+
+
+def test_iter_report_pages_follows_the_offset():
+    client = FakeDataClient(250)
+    pages = list(ga4.iter_report_pages(client, report_request(), page_size=100))
+    assert [len(page.rows) for page in pages] == [100, 100, 50]
+    assert client.requests == [(0, 100, False), (100, 100, False), (200, 100, False)]
+
+
+def test_iter_report_pages_reads_an_exact_multiple_once():
+    client = FakeDataClient(200)
+    assert len(list(ga4.iter_report_pages(client, report_request(), page_size=100))) == 2
+    assert len(client.requests) == 2
+
+
+def test_iter_report_pages_yields_nothing_for_an_empty_report():
+    client = FakeDataClient(0)
+    assert list(ga4.iter_report_pages(client, report_request(), page_size=100)) == []
+    assert len(client.requests) == 1
+
+
+def test_iter_report_pages_fails_on_a_truncated_report():
+    client = FakeDataClient(250, lost=60)
+    with pytest.raises(ValueError, match="read 190 rows but the report has 250"):
+        list(ga4.iter_report_pages(client, report_request(), page_size=100))
+
+
+def test_save_report_csv_appends_every_page(tmp_path):
+    filename = tmp_path / "report.csv"
+    pages = (pd.DataFrame({"a": [number, number + 1]}) for number in [0, 2])
+    assert ga4.save_report_csv(str(filename), pages) == 4
+    assert pd.read_csv(filename)["a"].tolist() == [0, 1, 2, 3]
+    assert not (tmp_path / "report.csv.part").exists()
+
+
+def test_fetch_property_saves_the_report_csv(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rows, _ = ga4.fetch_property(FakeDataClient(250), PROPERTY, dict(CONFIGS, rate_limit=1000))
+    assert rows == 250
+    df = pd.read_csv(tmp_path / "initial-load-2.csv")
+    assert len(df) == 250
+    assert df["country"].tolist()[-1] == "country 249"
+    assert df["property_name"].unique().tolist() == ["property"]
+
+
+def test_ga4_response_to_df_types_the_columns():
+    response = FakeDataClient(3).run_report(RunReportRequest(offset=0, limit=10))
+    df = ga4.ga4_response_to_df(response, "1", "account", "2", "property")
+    assert df.columns.tolist() == [
+        "date",
+        "country",
+        "sessions",
+        "bounceRate",
+        "account_id",
+        "account_name",
+        "property_id",
+        "property_name",
+    ]
+    assert df["date"].dt.strftime("%Y-%m-%d").tolist() == ["2024-01-01", "2024-01-02", "2024-01-03"]
+    assert df["sessions"].dtype == "int64"
+    assert df["bounceRate"].dtype == "float64"
+    assert df["sessions"].tolist() == [0, 1, 2]
+    assert df["property_id"].unique().tolist() == ["2"]
+
+
+def test_ga4_response_to_df_keeps_the_headers_of_an_empty_page():
+    response = FakeDataClient(0).run_report(RunReportRequest(offset=0, limit=10))
+    df = ga4.ga4_response_to_df(response, "1", "account", "2", "property")
+    assert df.empty
+    assert "sessions" in df and "property_name" in df
+
+
+def large_response(rows):
+    """a 3 dimensions and 2 metrics response built on the raw protobuf, proto-plus is too slow for 1M rows"""
+    response = RunReportResponse()
+    raw = RunReportResponse.pb(response)
+    for name in ["date", "country", "deviceModel"]:
+        raw.dimension_headers.add(name=name)
+    raw.metric_headers.add(name="sessions", type_=MetricType.TYPE_INTEGER)
+    raw.metric_headers.add(name="bounceRate", type_=MetricType.TYPE_FLOAT)
+    for number in range(rows):
+        row = raw.rows.add()
+        row.dimension_values.add(value=f"202401{number % 31 + 1:02d}")
+        row.dimension_values.add(value=f"country {number % 200}")
+        row.dimension_values.add(value=f"device {number % 50}")
+        row.metric_values.add(value=str(number))
+        row.metric_values.add(value="0.25")
+    return response
+
+
+def row_wise_response_to_df(response):
+    """ga4_response_to_df before it read the columns, one dict per proto-plus row"""
+    all_data = []
+    for row in response.rows:
+        row_data = {}
+        for i in range(len(response.dimension_headers)):
+            row_data.update({response.dimension_headers[i].name: row.dimension_values[i].value})
+        for i in range(len(response.metric_headers)):
+            row_data.update({response.metric_headers[i].name: row.metric_values[i].value})
+        all_data.append(row_data)
+    df = pd.DataFrame(all_data)
+    df["date"] = df.apply(lambda row: f"{row['date'][0:4]}-{row['date'][4:6]}-{row['date'][6:8]}", axis=1)
+    return df
+
+
+@pytest.mark.benchmark
+def test_benchmark_response_to_df():
+    size = int(os.getenv("GA4_BENCHMARK_ROWS", 1_000_000))
+    response = large_response(size)
+    start = time.perf_counter()
+    df = ga4.ga4_response_to_df(response, "1", "account", "2", "property")
+    columns_seconds = time.perf_counter() - start
+
+    # the row-wise conversion takes minutes for 1M rows, time it on a 50th of them
+    sample = RunReportResponse(
+        dimension_headers=response.dimension_headers,
+        metric_headers=response.metric_headers,
+        rows=response.rows[: size // 50],
+    )
+    start = time.perf_counter()
+    row_wise = row_wise_response_to_df(sample)
+    row_wise_seconds = (time.perf_counter() - start) * 50
+    print(f"{size} rows: by column {columns_seconds:.1f}s, row wise ~{row_wise_seconds:.1f}s (from {size // 50} rows)")
+    assert len(df) == size
+    assert df["date"].dt.strftime("%Y-%m-%d")[: size // 50].tolist() == row_wise["date"].tolist()
+    assert df["sessions"][: size // 50].astype(str).tolist() == row_wise["sessions"].tolist()
+    assert columns_seconds < row_wise_seconds / 3
+
+
+def property_quota(day=(10, 199000), hour=(10, 39000), project=(10, 13000)):
+    return PropertyQuota(
+        tokens_per_day=QuotaStatus(consumed=day[0], remaining=day[1]),
+        tokens_per_hour=QuotaStatus(consumed=hour[0], remaining=hour[1]),
+        tokens_per_project_per_hour=QuotaStatus(consumed=project[0], remaining=project[1]),
+    )
+
+
+def test_quota_usage_is_the_share_of_the_limits_spent():
+    usage, regain_seconds = ga4.quota_usage(property_quota(hour=(10, 10000)))
+    # 30000 of the 40000 hourly tokens spent, the request itself only consumed 10
+    assert usage == pytest.approx(75)
+    assert regain_seconds == 0
+
+
+def test_quota_usage_is_low_for_a_fresh_quota():
+    usage, _ = ga4.quota_usage(property_quota(day=(50, 199950), hour=(50, 39950), project=(50, 13950)))
+    assert usage < 1
+
+
+def test_quota_usage_uses_the_configured_limits():
+    quotas = {"tokens_per_day": 2000000, "tokens_per_hour": 400000, "tokens_per_project_per_hour": 140000}
+    quota = property_quota(day=(10, 1990000), hour=(10, 200000), project=(10, 139000))
+    assert ga4.quota_usage(quota, quotas)[0] == pytest.approx(50)
+    # the standard limits are below what is left, nothing counts as spent
+    assert ga4.quota_usage(quota)[0] == 0
+
+
+def test_quota_usage_is_full_without_room_for_the_next_requests():
+    usage, _ = ga4.quota_usage(property_quota(project=(500, 1200)))
+    assert usage == 100
+
+
+def test_quota_usage_waits_for_the_next_hour():
+    usage, regain_seconds = ga4.quota_usage(property_quota(hour=(10, 0)))
+    assert usage == 100
+    assert 0 < regain_seconds <= 3600
+
+
+def test_quota_usage_stops_on_the_daily_quota():
+    with pytest.raises(RuntimeError, match="daily token quota"):
+        ga4.quota_usage(property_quota(day=(10, 0)))
+
+
+def test_quota_usage_ignores_a_missing_quota():
+    assert ga4.quota_usage(PropertyQuota()) == (0.0, 0)
+
+
+def test_report_pages_slow_down_as_the_quota_runs_low():
+    limiter = AdaptiveRateLimiter(rate=100, threshold=60)
+    client = FakeDataClient(250, quota=property_quota(hour=(10, 8000)))
+    list(ga4.iter_report_pages(client, report_request(), page_size=100, limiter=limiter))
+    assert client.requests[0] == (0, 100, True)
+    # 80% of the hourly tokens spent: half way from the threshold to the limit
+    assert limiter.rate == pytest.approx(50)
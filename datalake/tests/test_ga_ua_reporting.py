@@ -0,0 +1,123 @@
+"""TESTS FOR THE BATCHED GOOGLE ANALYTICS UA REPORTS"""
+from datetime import date
+
+from GE_GA_UA.reporting import (
+    batch_get,
+    get_unsampled_reports,
+    is_golden,
+    iter_daily_responses,
+    split_by_date,
+)
+
+DAYS = [date(2024, 1, 1), date(2024, 1, 2), date(2024, 1, 3)]
+
+
+def report(rows, **data):
+    return {
+        "columnHeader": {"dimensions": ["ga:date", "ga:country"]},
+        "data": dict(data, rows=rows, rowCount=len(rows), totals=[{"values": ["9"]}]),
+    }
+
+
+def row(day, country, users):
+    return {"dimensions": [day, country], "metrics": [{"values": [users]}]}
+
+
+class FakeAnalytics:
+    """reporting service answering batchGet with the given pages, in order"""
+
+    def __init__(self, pages):
+        self.pages = list(pages)
+        self.bodies = []
+
+    def reports(self):
+        return self
+
+    def batchGet(self, body):  # noqa: N802  # pylint: disable=invalid-name
+        self.bodies.append(body)
+        return self
+
+    def execute(self):
+        return self.pages.pop(0)
+
+
+def test_is_golden_needs_every_report_golden():
+    golden = {"data": {"isDataGolden": True}}
+    # the api leaves isDataGolden out when it is false
+    assert is_golden({"reports": [golden, golden]})
+    assert not is_golden({"reports": [golden, {"data": {"rows": []}}]})
+    assert not is_golden({"reports": []})
+
+
+def test_split_by_date_gives_every_day_a_response():
+    responses = split_by_date(
+        report([row("20240101", "KE", "3"), row("20240103", "NG", "5")], isDataGolden=True), DAYS
+    )
+    assert list(responses) == DAYS
+    first = responses[DAYS[0]]["reports"][0]
+    assert first["data"] == {"isDataGolden": True, "rows": [row("20240101", "KE", "3")], "rowCount": 1}
+    assert responses[DAYS[1]]["reports"][0]["data"] == {"isDataGolden": True}
+
+
+def test_split_by_date_can_drop_the_date_dimension():
+    responses = split_by_date(report([row("20240102", "KE", "3")]), DAYS, drop_date=True)
+    day = responses[DAYS[1]]["reports"][0]
+    assert day["columnHeader"]["dimensions"] == ["ga:country"]
+    assert day["data"]["rows"][0]["dimensions"] == ["KE"]
+
+
+def test_iter_daily_responses_requests_ranges_of_days():
+    analytics = FakeAnalytics([
+        {"reports": [report([row("20240101", "KE", "3"), row("20240102", "KE", "1")])]},
+        {"reports": [report([row("20240103", "KE", "2")])]},
+    ])
+    responses = list(
+        iter_daily_responses(analytics, "1", DAYS[0], date(2024, 1, 4), ["ga:users"], ["ga:country"], days_per_request=2, pause=0)
+    )
+    assert [day for day, _ in responses] == DAYS
+    assert [body["reportRequests"][0]["dateRanges"] for body in analytics.bodies] == [
+        [{"startDate": "2024-01-01", "endDate": "2024-01-02"}],
+        [{"startDate": "2024-01-03", "endDate": "2024-01-03"}],
+    ]
+    # ga:date is only added for the split
+    assert analytics.bodies[0]["reportRequests"][0]["dimensions"][0] == {"name": "ga:date"}
+    assert responses[1][1]["reports"][0]["data"]["rows"] == [{"dimensions": ["KE"], "metrics": [{"values": ["1"]}]}]
+
+
+def test_batch_get_follows_the_page_tokens():
+    first = dict(report([row("20240101", "KE", "3")]), nextPageToken="2")
+    analytics = FakeAnalytics([{"reports": [first]}, {"reports": [report([row("20240102", "KE", "1")])]}])
+    reports = batch_get(analytics, [{"viewId": "1"}])
+    assert reports[0]["data"]["rowCount"] == 2
+    assert "nextPageToken" not in reports[0]
+    assert analytics.bodies[1]["reportRequests"][0]["pageToken"] == "2"
+
+
+def test_batch_get_only_pages_the_reports_with_a_token():
+    analytics = FakeAnalytics([
+        {"reports": [report([row("20240101", "KE", "3")]), dict(report([row("20240101", "NG", "1")]), nextPageToken="2")]},
+        {"reports": [report([row("20240101", "UG", "4")])]},
+    ])
+    reports = batch_get(analytics, [{"viewId": "1", "metrics": "a"}, {"viewId": "1", "metrics": "b"}])
+    assert analytics.bodies[1]["reportRequests"] == [{"viewId": "1", "metrics": "b", "pageToken": "2"}]
+    assert [len(report["data"]["rows"]) for report in reports] == [1, 2]
+
+
+def test_sampled_ranges_are_split_without_paging():
+    sampled = dict(report([], samplesReadCounts=["10"]), nextPageToken="2")
+    analytics = FakeAnalytics([
+        {"reports": [sampled]},
+        {"reports": [report([row("20240101", "KE", "3")])]},
+        {"reports": [report([row("20240102", "KE", "1")])]},
+    ])
+    reports = get_unsampled_reports(analytics, "1", DAYS[0], DAYS[1], ["ga:users"], ["ga:date"])
+    assert [(start, end) for start, end, _ in reports] == [(DAYS[0], DAYS[0]), (DAYS[1], DAYS[1])]
+    assert len(analytics.bodies) == 3
+
+
+def test_a_sampled_day_is_kept():
+    analytics = FakeAnalytics([{"reports": [report([row("20240101", "KE", "3")], samplesReadCounts=["10"])]}])
+    reports = get_unsampled_reports(analytics, "1", DAYS[0], DAYS[0], ["ga:users"], ["ga:date"])
+    assert len(reports) == 1
+    responses = split_by_date(reports[0][2], [DAYS[0]])
+    assert responses[DAYS[0]]["reports"][0]["data"]["samplesReadCounts"] == ["10"]
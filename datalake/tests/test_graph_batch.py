@@ -0,0 +1,129 @@
+"""TESTS FOR THE GRAPH API BATCH REQUESTS"""
+import json
+import time
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+pytest.importorskip("facebook_business")
+
+from facebook_business.api import FacebookAdsApiBatch, FacebookResponse
+
+from utils.rate_limiter import get_rate_limiter
+from GE_meta_engagement.graph_batch import batch_get
+
+USAGE = {"x-app-usage": json.dumps({"call_count": 90})}
+
+
+class FakeApi:
+    """graph api answering every sub-request of a batch call with its path"""
+
+    def __init__(self, connection_errors=0, failing=(), unanswered=(), headers=None):
+        self.connection_errors = connection_errors
+        self.failing = set(failing)
+        self.unanswered = set(unanswered)
+        self.headers = headers or {}
+        self.executed = []
+
+    def new_batch(self):
+        return FacebookAdsApiBatch(api=self)
+
+    def call(self, method, path, params=None):
+        assert (method, path) == ("POST", ())
+        paths = [urlparse(call["relative_url"]).path for call in params["batch"]]
+        self.executed.append(paths)
+        if self.connection_errors:
+            self.connection_errors -= 1
+            raise ConnectionError("connection reset")
+        answers = []
+        for call, path in zip(params["batch"], paths):
+            if path in self.unanswered:
+                self.unanswered.remove(path)
+                answers.append(None)
+            elif path in self.failing:
+                self.failing.remove(path)
+                answers.append({"code": 500, "body": json.dumps({"error": {"code": 2, "message": "service"}})})
+            else:
+                query = parse_qs(urlparse(call["relative_url"]).query)
+                answers.append(
+                    {
+                        "code": 200,
+                        # a sub-response reporting a usage the batch call does not
+                        "headers": [{"name": "x-app-usage", "value": json.dumps({"call_count": 100})}],
+                        "body": json.dumps({"data": [path], "metric": query.get("metric")}),
+                    }
+                )
+        return FacebookResponse(body=json.dumps(answers), http_status=200, headers=self.headers)
+
+
+def requests(count):
+    return [(number, f"{number}/insights", {"metric": ["reach"]}) for number in range(count)]
+
+
+def test_batch_get_returns_the_bodies_by_key():
+    get_rate_limiter("tests_batch_bodies", rate=1000)
+    results, errors = batch_get(requests(3), api=FakeApi(), limiter="tests_batch_bodies")
+    assert not errors
+    assert results[2] == {"data": ["2/insights"], "metric": ['["reach"]']}
+
+
+def test_batch_get_takes_a_token_per_sub_request():
+    # a single acquire is clamped to the capacity, 50 sub-requests must still wait
+    # for 40 tokens beyond the burst of 10
+    get_rate_limiter("tests_batch_tokens", rate=100, capacity=10)
+    start = time.monotonic()
+    results, errors = batch_get(requests(50), api=FakeApi(), limiter="tests_batch_tokens")
+    assert time.monotonic() - start >= 0.35
+    assert len(results) == 50 and not errors
+
+
+def test_batch_get_reads_the_usage_of_the_batch_call():
+    limiter = get_rate_limiter("tests_batch_usage", rate=100)
+    batch_get(requests(2), api=FakeApi(), limiter="tests_batch_usage")
+    # the usage of the sub-responses is ignored
+    assert limiter.rate == 100
+
+    batch_get(requests(2), api=FakeApi(headers=USAGE), limiter="tests_batch_usage")
+    assert limiter.rate < 100
+
+
+def test_batch_get_retries_failed_calls_and_sub_requests():
+    get_rate_limiter("tests_batch_retries", rate=1000)
+    api = FakeApi(connection_errors=1, failing={"3/insights"}, unanswered={"1/insights"})
+    results, errors = batch_get(
+        requests(5), api=api, batch_size=2, initial_wait=0, limiter="tests_batch_retries"
+    )
+    assert results[3]["data"] == ["3/insights"]
+    assert len(results) == 5 and not errors
+    # the failed call is sent again as a whole, the failed sub-requests alone
+    assert api.executed == [
+        ["0/insights", "1/insights"],
+        ["2/insights", "3/insights"],
+        ["4/insights"],
+        ["0/insights", "1/insights"],
+        ["3/insights"],
+        ["1/insights"],
+    ]
+
+
+def test_batch_get_reports_requests_failing_every_retry():
+    get_rate_limiter("tests_batch_errors", rate=1000)
+    api = FakeApi(connection_errors=10)
+    results, errors = batch_get(
+        requests(2), api=api, retries=1, initial_wait=0, limiter="tests_batch_errors"
+    )
+    assert not results
+    assert errors[0]["message"] == "batch call failed: connection reset"
+    assert len(api.executed) == 2
+
+
+def test_batch_get_does_not_retry_permanent_errors():
+    get_rate_limiter("tests_batch_permanent", rate=1000)
+    api = FakeApi()
+    api.call = lambda method, path, params=None: FacebookResponse(
+        body=json.dumps([{"code": 400, "body": json.dumps({"error": {"code": 100, "message": "invalid metric"}})}]),
+        http_status=200,
+    )
+    results, errors = batch_get(requests(1), api=api, initial_wait=0, limiter="tests_batch_permanent")
+    assert not results
+    assert errors[0]["message"] == "invalid metric"
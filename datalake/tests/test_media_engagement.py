@@ -0,0 +1,189 @@
+"""TESTS FOR THE INSTAGRAM MEDIA INSIGHTS READER"""
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("facebook_business")
+
+from utils import quota_handler
+from GE_meta_engagement import media_engagement
+from GE_meta_engagement.media_engagement import MediaEngagements
+
+
+class FakeMedia(dict):
+    """an IGMedia of the media listing"""
+
+    def __init__(self, media_id, media_type="IMAGE", product="FEED", permalink="https://instagram.com/p/1"):
+        super().__init__(id=media_id, media_type=media_type, media_product_type=product, permalink=permalink)
+        self._json = dict(self)
+
+
+def insight(name):
+    return {"name": name, "values": [{"value": 1}]}
+
+
+class FakeBatches:
+    """patches batch_get, answering every request with one insight per metric"""
+
+    def __init__(self, monkeypatch, failing=()):
+        self.failing = set(failing)
+        self.batches = []
+        self.lock = threading.Lock()
+        monkeypatch.setattr(media_engagement, "batch_get", self.batch_get)
+
+    def batch_get(self, requests, api=None, batch_size=50, limiter="meta_graph"):
+        with self.lock:
+            self.batches.append(requests)
+        results, errors = {}, {}
+        for key, path, params in requests:
+            if key[0] in self.failing:
+                errors[key] = {"message": "service"}
+            else:
+                results[key] = {"data": [insight(metric) for metric in params["metric"]]}
+        return results, errors
+
+
+def reader(**configs):
+    return MediaEngagements(SimpleNamespace(creds={"user_id": "user"}), dict({"fields": ["id"]}, **configs))
+
+
+def test_batch_media_insights_merges_the_normal_and_extra_metrics(monkeypatch):
+    batches = FakeBatches(monkeypatch)
+    insights = reader()._batch_media_insights([FakeMedia("m0")])
+    assert [item["name"] for item in insights["m0"]] == [
+        "impressions",
+        "reach",
+        "likes",
+        "comments",
+        "shares",
+        "saved",
+        "profile_activity",
+    ]
+    assert len(batches.batches) == 1
+    extra = [params for _, _, params in batches.batches[0] if params["metric"] == ["profile_activity"]]
+    assert extra == [{"metric": ["profile_activity"], "breakdown": "action_type"}]
+
+
+def test_batch_media_insights_requests_a_shared_metric_set_once(monkeypatch):
+    # reels have no extra params, both calls of get_params give the reels metrics
+    batches = FakeBatches(monkeypatch)
+    insights = reader()._batch_media_insights([FakeMedia("reel", "VIDEO", "REELS")])
+    assert [key[0] for key, _, _ in batches.batches[0]] == ["reel"]
+    # the result is still used for both, like the two calls of the single mode
+    assert [item["name"] for item in insights["reel"]] == ["reach", "plays", "likes", "comments", "shares", "saved"] * 2
+
+
+def test_batch_media_insights_groups_the_requests_by_metric_set(monkeypatch):
+    batches = FakeBatches(monkeypatch)
+    medias = [
+        FakeMedia("image0"),
+        FakeMedia("album", "CAROUSEL_ALBUM"),
+        FakeMedia("image1"),
+        FakeMedia("reel", "VIDEO", "REELS"),
+    ]
+    reader(batch_size=2, insights_workers=1)._batch_media_insights(medias)
+    metric_sets = [{tuple(params["metric"]) for _, _, params in batch} for batch in batches.batches]
+    # the album and the reel need one request each, the images two
+    assert [len(batch) for batch in batches.batches] == [2, 2, 2]
+    assert metric_sets == [
+        {("profile_activity",)},
+        {("impressions", "reach", "likes", "comments", "shares", "saved")},
+        {("impressions", "reach", "saved"), ("reach", "plays", "likes", "comments", "shares", "saved")},
+    ]
+
+
+def test_batch_media_insights_records_the_failed_requests(monkeypatch):
+    FakeBatches(monkeypatch, failing={"m1"})
+    engagements = reader()
+    insights = engagements._batch_media_insights([FakeMedia("m0"), FakeMedia("m1")])
+    assert insights["m1"] == []
+    assert len(engagements.error_handler.error_list) == 2
+    assert engagements.error_handler.error_list[0].startswith("media_id: m1")
+
+
+class FakePage(dict):
+    def __init__(self, page_id):
+        super().__init__(id=page_id, access_token=f"token {page_id}")
+
+    def get_id(self):
+        return self["id"]
+
+
+class FakeAccounts:
+    """patches the traversal of an account, yielding `media` payloads per page"""
+
+    def __init__(self, monkeypatch, media=3, seconds=0.0, failing=()):
+        self.media = media
+        self.seconds = seconds
+        self.failing = set(failing)
+        self.started = []
+        self.limiters = {}
+        monkeypatch.setattr(MediaEngagements, "_get_ig_insights", self.get_ig_insights)
+
+    def get_ig_insights(self, page, fields, api=None, limiter="meta_graph"):
+        self.started.append(page.get_id())
+        self.limiters[page.get_id()] = limiter
+        for number in range(self.media):
+            if page.get_id() in self.failing:
+                raise ValueError("token expired")
+            time.sleep(self.seconds)
+            yield {"media_id": f"{page.get_id()}-{number}"}
+
+
+PAGES = [FakePage(f"p{number}") for number in range(5)]
+
+
+def test_parallel_insights_yields_every_account(monkeypatch):
+    accounts = FakeAccounts(monkeypatch)
+    payloads = list(reader()._parallel_insights(PAGES, ["id"], workers=3))
+    assert sorted(payload["media_id"] for payload in payloads) == [
+        f"p{page}-{number}" for page in range(5) for number in range(3)
+    ]
+    assert accounts.limiters == {f"p{number}": f"meta_graph:p{number}" for number in range(5)}
+
+
+def test_parallel_insights_keeps_going_after_a_failed_account(monkeypatch):
+    FakeAccounts(monkeypatch, failing={"p1"})
+    engagements = reader()
+    payloads = list(engagements._parallel_insights(PAGES, ["id"], workers=2))
+    assert len(payloads) == 12
+    assert engagements.error_handler.error_list == ["page_id: p1 \n token expired"]
+
+
+def test_parallel_insights_stops_the_accounts_when_the_consumer_stops(monkeypatch):
+    accounts = FakeAccounts(monkeypatch, media=20, seconds=0.01)
+    payloads = reader()._parallel_insights(PAGES, ["id"], workers=1)
+    assert next(payloads)["media_id"] == "p0-0"
+    start = time.monotonic()
+    payloads.close()
+    assert time.monotonic() - start < 1
+    # the accounts not started yet are dropped
+    assert accounts.started == ["p0"]
+
+
+def test_parallel_insights_does_not_hang_on_a_full_queue(monkeypatch):
+    # one worker keeps a queue of 100 payloads, the account has far more
+    FakeAccounts(monkeypatch, media=1000)
+    payloads = reader()._parallel_insights(PAGES[:1], ["id"], workers=1)
+    next(payloads)
+    time.sleep(0.1)
+    start = time.monotonic()
+    payloads.close()
+    assert time.monotonic() - start < 3
+
+
+def test_api_handler_takes_the_token_of_the_page_limiter(monkeypatch):
+    acquired = []
+    monkeypatch.setattr(
+        quota_handler, "get_rate_limiter", lambda name: SimpleNamespace(acquire=lambda: acquired.append(name))
+    )
+
+    @quota_handler.api_handler(limiter="meta_graph")
+    def call(limiter="meta_graph"):
+        return limiter
+
+    assert call() == "meta_graph"
+    assert call(limiter="meta_graph:p0") == "meta_graph:p0"
+    assert acquired == ["meta_graph", "meta_graph:p0"]
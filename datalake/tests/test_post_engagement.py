@@ -0,0 +1,130 @@
+"""TESTS FOR THE FACEBOOK POST INSIGHTS MODES"""
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("facebook_business")
+
+from utils.watermark import LocalWatermarkStore
+from GE_meta_engagement import post_engagement
+from GE_meta_engagement.post_engagement import PostEngagements
+
+METRICS = ["post_impressions", "post_clicks"]
+CONFIGS = {"fields": ["id", "created_time"], "metric": METRICS, "insights_mode": "batch"}
+
+
+class FakePost(dict):
+    """a PagePost of the posts listing"""
+
+    def __init__(self, post_id, insights=None):
+        super().__init__(id=post_id, created_time="2024-06-01T10:00:00+0000")
+        self._json = dict(self)
+        if insights is not None:
+            self._json["insights"] = {"data": insights}
+
+
+class FakeAccount(dict):
+    def get_id(self):
+        return self["id"]
+
+
+ACCOUNT = FakeAccount(id="page", name="page name", access_token="token")
+
+
+def insight(name):
+    return {"name": name, "values": [{"value": 1}]}
+
+
+class FakeGraph:
+    """patches the posts listing, the accounts of the user and the batch calls"""
+
+    def __init__(self, monkeypatch, posts, failing=()):
+        self.posts = posts
+        self.failing = set(failing)
+        self.listings = []
+        self.batches = []
+        monkeypatch.setattr(post_engagement.FacebookAdsApi, "init", lambda **kwargs: None)
+        monkeypatch.setattr(post_engagement, "Page", lambda page_id: SimpleNamespace(get_posts=self.get_posts))
+        monkeypatch.setattr(post_engagement, "User", lambda user_id: SimpleNamespace(get_accounts=lambda **kwargs: [ACCOUNT]))
+        monkeypatch.setattr(post_engagement, "batch_get", self.batch_get)
+
+    def get_posts(self, fields, params):
+        self.listings.append((fields, params))
+        return iter(self.posts)
+
+    def batch_get(self, requests, batch_size=50):
+        self.batches.append([key for key, _, _ in requests])
+        results = {
+            key: {"data": [insight(metric) for metric in params["metric"]]}
+            for key, _, params in requests
+            if key not in self.failing
+        }
+        errors = {key: {"message": "service"} for key, _, _ in requests if key in self.failing}
+        return results, errors
+
+
+def reader(configs, watermarks=None):
+    return PostEngagements(SimpleNamespace(creds={"user_id": "user"}), configs, watermarks=watermarks)
+
+
+def test_batch_mode_fetches_the_insights_per_batch(monkeypatch):
+    graph = FakeGraph(monkeypatch, [FakePost(f"p{number}") for number in range(5)])
+    payloads = list(reader(dict(CONFIGS, batch_size=2)).get_insights(ACCOUNT, dict(CONFIGS, batch_size=2)))
+    assert graph.batches == [["p0", "p1"], ["p2", "p3"], ["p4"]]
+    assert [payload["post_id"] for payload in payloads] == ["p0", "p1", "p2", "p3", "p4"]
+    assert [item["name"] for item in payloads[0]["data"]["insights"]] == METRICS
+
+
+def test_batch_mode_skips_the_posts_whose_insights_failed(monkeypatch):
+    FakeGraph(monkeypatch, [FakePost("p0"), FakePost("p1"), FakePost("p2")], failing={"p1"})
+    payloads = list(reader(CONFIGS).get_insights(ACCOUNT, CONFIGS))
+    assert [payload["post_id"] for payload in payloads] == ["p0", "p2"]
+
+
+def test_failed_posts_stay_due_for_the_next_run(monkeypatch, tmp_path):
+    watermarks = LocalWatermarkStore("tests", path=tmp_path)
+    configs = dict(CONFIGS, refresh=True)
+    FakeGraph(monkeypatch, [FakePost("p0"), FakePost("p1")], failing={"p1"})
+    posts = reader(configs, watermarks)
+    assert [payload["post_id"] for payload in posts.get_data()] == ["p0"]
+    watermarks.commit()
+    assert watermarks.get("p0", "post") is not None
+    assert watermarks.get("p1", "post") is None
+
+
+INLINE = dict(CONFIGS, insights_mode="inline", since="2024-06-01", inline_limit=25)
+
+
+def test_inline_insights_field_expands_the_metrics_and_dates():
+    assert reader(INLINE).inline_insights_field(INLINE) == (
+        "insights.metric(post_impressions,post_clicks).since(2024-06-01)"
+    )
+
+
+def test_inline_mode_requests_the_insights_with_the_posts(monkeypatch):
+    complete = [insight(metric) for metric in METRICS]
+    graph = FakeGraph(monkeypatch, [FakePost("p0", complete), FakePost("p1", complete)])
+    payloads = list(reader(INLINE).get_insights(ACCOUNT, INLINE))
+    assert graph.listings == [
+        (
+            ["id", "created_time", "insights.metric(post_impressions,post_clicks).since(2024-06-01)"],
+            {"limit": 25},
+        )
+    ]
+    assert graph.batches == []
+    assert payloads[1]["data"]["insights"] == complete
+
+
+def test_inline_mode_fetches_incomplete_insights_again(monkeypatch):
+    complete = [insight(metric) for metric in METRICS]
+    posts = [
+        FakePost("p0", complete),
+        FakePost("p1", [insight("post_impressions")]),
+        FakePost("p2"),
+        FakePost("p3", []),
+    ]
+    graph = FakeGraph(monkeypatch, posts, failing={"p3"})
+    payloads = list(reader(INLINE).get_insights(ACCOUNT, INLINE))
+    assert graph.batches == [["p1", "p2", "p3"]]
+    assert [payload["post_id"] for payload in payloads] == ["p0", "p1", "p2"]
+    assert [item["name"] for item in payloads[1]["data"]["insights"]] == METRICS
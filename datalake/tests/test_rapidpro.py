@@ -0,0 +1,409 @@
+"""TESTS FOR THE RAPIDPRO EXTRACTORS AGAINST FAKE TEMBA CLIENTS"""
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import types
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+
+try:
+    import temba_client.v2  # noqa: F401
+except ImportError:
+    # the extractors only get TembaClient from it, the tests pass fake clients
+    sys.modules["temba_client"] = types.ModuleType("temba_client")
+    sys.modules["temba_client.v2"] = types.ModuleType("temba_client.v2")
+    sys.modules["temba_client.v2"].TembaClient = None
+
+from GE_rapidpro import retrieve_rapidpro as rapidpro
+
+CHATBOT = {"name": "bot", "token": "token", "start_flow": "start"}
+CREATED = datetime(2024, 1, 1, 8, 30)
+
+
+class FakeQuery:
+    """a temba_client query, its pages are given up front"""
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.fetched = 0
+
+    def iterfetches(self, retry_on_rate_exceed=False):
+        for page in self.pages:
+            self.fetched += 1
+            yield page
+
+
+class FakeClient:
+    def __init__(self, contacts=(), runs=()):
+        self.contacts = FakeQuery(list(contacts))
+        self.runs = FakeQuery(list(runs))
+        self.calls = []
+
+    def get_contacts(self, **params):
+        self.calls.append(("contacts", params))
+        return self.contacts
+
+    def get_runs(self, **params):
+        self.calls.append(("runs", params))
+        return self.runs
+
+
+def contact(number, urn="whatsapp:27000"):
+    return SimpleNamespace(
+        uuid=f"c{number}", created_on=CREATED, modified_on=CREATED, last_seen_on=CREATED, urns=[urn]
+    )
+
+
+def contact_pages(pages, size):
+    return [[contact(page * size + number) for number in range(size)] for page in range(pages)]
+
+
+def test_save_csv_batches_appends_every_page(tmp_path):
+    filename = tmp_path / "rows.csv"
+    batches = [[{"a": 1, "b": "x"}], [], [{"a": 2, "b": "y"}, {"a": 3, "b": "z"}]]
+    assert rapidpro.save_csv_batches(str(filename), iter(batches)) == 3
+    assert pd.read_csv(filename).to_dict("records") == [
+        {"a": 1, "b": "x"},
+        {"a": 2, "b": "y"},
+        {"a": 3, "b": "z"},
+    ]
+    assert not (tmp_path / "rows.csv.part").exists()
+
+
+def test_save_csv_batches_does_not_create_a_file_without_rows(tmp_path):
+    filename = tmp_path / "rows.csv"
+    assert rapidpro.save_csv_batches(str(filename), iter([[], pd.DataFrame()])) == 0
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_save_csv_batches_keeps_the_previous_file_when_a_page_fails(tmp_path):
+    filename = tmp_path / "rows.csv"
+    filename.write_text("a\n0\n")
+
+    def failing():
+        yield [{"a": 1}]
+        raise ConnectionError("page 2")
+
+    with pytest.raises(ConnectionError):
+        rapidpro.save_csv_batches(str(filename), failing())
+    assert filename.read_text() == "a\n0\n"
+
+
+def test_iter_rows_converts_one_page_at_a_time():
+    query = FakeQuery(contact_pages(3, 2))
+    batches = rapidpro.iter_rows(rapidpro.fetch_batches(query), rapidpro.contact_row)
+    assert [row["uuid"] for row in next(batches)] == ["c0", "c1"]
+    assert query.fetched == 1
+    assert len(list(batches)) == 2
+
+
+def test_contacts_csv_is_written_page_by_page(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    pages = contact_pages(2, 2)
+    pages[1][0].urns = ["telegram:1"]
+    client = FakeClient(contacts=pages)
+    rapidpro.num_conversations_initiated_and_returning_users(client, CHATBOT, after=date(2024, 1, 1))
+    assert client.calls == [("contacts", {"before": date(2024, 1, 2), "after": date(2024, 1, 1)})]
+    df = pd.read_csv(tmp_path / "2024-01-01-bot-contacts.csv")
+    assert df["uuid"].tolist() == ["c0", "c1", "c2", "c3"]
+    assert df["platform"].tolist() == ["whatsapp", "whatsapp", "telegram", "whatsapp"]
+    assert df["created_on"][0] == "2024-01-01T08:30:00Z"
+
+
+def test_contacts_csv_is_not_written_without_contacts(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rapidpro.num_conversations_initiated_and_returning_users(FakeClient(), CHATBOT, after=date(2024, 1, 1))
+    assert list(tmp_path.iterdir()) == []
+
+
+def concat_then_save(filename, batches):
+    """the extractors before streaming: every page appended to one DataFrame"""
+    df = pd.DataFrame()
+    for rows in batches:
+        df = pd.concat([df, pd.DataFrame(rows)])
+    df.to_csv(filename, index=False, date_format=rapidpro.ISO_8601_DateTime_format)
+
+
+def measure(save, filename, pages):
+    """seconds taken, then peak memory in a second run traced by tracemalloc"""
+    start = time.perf_counter()
+    save(str(filename), rapidpro.iter_rows(rapidpro.fetch_batches(FakeQuery(pages)), rapidpro.contact_row))
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    save(str(filename), rapidpro.iter_rows(rapidpro.fetch_batches(FakeQuery(pages)), rapidpro.contact_row))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak
+
+
+@pytest.mark.benchmark
+def test_benchmark_streamed_csv_memory(tmp_path):
+    # 100 pages of 250 contacts, the RapidPro page size
+    pages = contact_pages(100, 250)
+    streamed_seconds, streamed_peak = measure(rapidpro.save_csv_batches, tmp_path / "streamed.csv", pages)
+    concat_seconds, concat_peak = measure(concat_then_save, tmp_path / "concat.csv", pages)
+    print(
+        f"25k contacts: streamed {streamed_seconds:.2f}s {streamed_peak / 2**20:.1f}MB peak, "
+        f"concat {concat_seconds:.2f}s {concat_peak / 2**20:.1f}MB peak"
+    )
+    assert (tmp_path / "streamed.csv").read_bytes() == (tmp_path / "concat.csv").read_bytes()
+    assert streamed_peak < concat_peak / 4
+
+
+class TaskRecorder:
+    """stands in for the extractors, records how many tasks use a token at once"""
+
+    def __init__(self, seconds=0.02, fail=()):
+        self.seconds = seconds
+        self.fail = fail
+        self.lock = threading.Lock()
+        self.running = {}
+        self.most_running = {}
+        self.calls = []
+
+    def extractor(self, name):
+        def extract(client, chatbot, *window):
+            token = chatbot["token"]
+            with self.lock:
+                self.calls.append((name, chatbot["name"], window))
+                self.running[token] = self.running.get(token, 0) + 1
+                self.most_running[token] = max(self.most_running.get(token, 0), self.running[token])
+            time.sleep(self.seconds)
+            with self.lock:
+                self.running[token] -= 1
+            if (name, chatbot["name"]) in self.fail:
+                raise ValueError(f"{name} failed")
+
+        extract.__name__ = name
+        return extract
+
+
+EXTRACTORS = [
+    "num_conversations_initiated_and_returning_users",
+    "num_onboarding_started",
+    "get_uncaught_messages",
+    "get_quizzes",
+    "most_popular_flows",
+]
+
+
+@pytest.fixture
+def recorder(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    recorder = TaskRecorder()
+    monkeypatch.setattr(rapidpro, "TembaClient", lambda host, token: SimpleNamespace(token=token))
+    for name in EXTRACTORS:
+        monkeypatch.setattr(rapidpro, name, recorder.extractor(name))
+    return recorder
+
+
+def write_chatbots(chatbots):
+    with open("auth.json", "w") as f:
+        json.dump({chatbot["name"]: chatbot for chatbot in chatbots}, f)
+
+
+def test_run_task_times_the_extractor(recorder):
+    calls = []
+    slots = threading.BoundedSemaphore(1)
+    seconds = rapidpro.run_task(lambda client, chatbot: calls.append(chatbot), CHATBOT, slots, ())
+    assert calls == [CHATBOT]
+    assert seconds >= 0
+    # the slot is given back
+    assert slots.acquire(blocking=False)
+
+
+def test_main_caps_the_tasks_of_each_token(recorder, capsys):
+    write_chatbots(
+        [
+            {"name": "a", "token": "shared"},
+            {"name": "b", "token": "shared"},
+            {"name": "c", "token": "own", "max_concurrency": 1},
+        ]
+    )
+    rapidpro.main(max_workers=8)
+    assert len(recorder.calls) == 15
+    assert recorder.most_running["shared"] <= rapidpro.TOKEN_CONCURRENCY
+    assert recorder.most_running["own"] == 1
+    output = capsys.readouterr().out
+    assert "a - most_popular_flows:" in output
+    assert "Ran 15 tasks in" in output
+
+
+def test_main_runs_the_other_tasks_before_raising(recorder):
+    recorder.fail = {("num_onboarding_started", "a")}
+    write_chatbots([{"name": "a", "token": "a"}, {"name": "b", "token": "b"}])
+    with pytest.raises(RuntimeError, match="1 RapidPro tasks failed"):
+        rapidpro.main(max_workers=2)
+    assert len(recorder.calls) == 10
+
+
+@pytest.mark.benchmark
+def test_benchmark_concurrent_chatbots(recorder):
+    # 4 chatbots with their own token, 5 extractors of 20ms each: ~0.4s serially
+    write_chatbots([{"name": f"bot{number}", "token": f"token{number}"} for number in range(4)])
+    start = time.perf_counter()
+    rapidpro.main(max_workers=1)
+    serial = time.perf_counter() - start
+
+    start = time.perf_counter()
+    rapidpro.main(max_workers=8)
+    concurrent = time.perf_counter() - start
+    print(f"20 tasks: serial {serial:.2f}s, 8 workers {concurrent:.2f}s")
+    assert concurrent < serial / 2
+
+
+def run(number, flow):
+    return SimpleNamespace(
+        uuid=f"r{number}",
+        flow=SimpleNamespace(uuid=flow, name=f"flow {flow}"),
+        contact=SimpleNamespace(uuid=f"c{number}"),
+        created_on=CREATED,
+        modified_on=CREATED,
+    )
+
+
+RUNS = [[run(0, "start"), run(1, "other")], [run(2, "lookup"), run(3, "start")]]
+FLOWS_CHATBOT = dict(CHATBOT, lookup_flow="lookup", quiz_flows=["quiz"])
+
+
+def test_runs_cache_fetches_the_window_once_and_routes_by_flow():
+    cache = rapidpro.RunsCache()
+    client = FakeClient(runs=RUNS)
+    runs = cache.get(client, FLOWS_CHATBOT, before="2024-01-02", after="2024-01-01")
+    assert cache.get(client, FLOWS_CHATBOT, before="2024-01-02", after="2024-01-01") is runs
+    assert client.calls == [("runs", {"before": "2024-01-02", "after": "2024-01-01"})]
+    assert {flow: [o.uuid for o in flow_runs] for flow, flow_runs in runs.items()} == {
+        "start": ["r0", "r3"],
+        "lookup": ["r2"],
+        "quiz": [],
+    }
+
+
+def test_runs_cache_threads_wait_for_the_first_fetch():
+    cache = rapidpro.RunsCache()
+    client = FakeClient(runs=RUNS)
+    client.get_runs = lambda **params: (client.calls.append(params), time.sleep(0.05), client.runs)[-1]
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda _: cache.get(client, FLOWS_CHATBOT, "b", "a"), range(4)))
+    assert len(client.calls) == 1
+    assert all(result is results[0] for result in results)
+
+
+def test_runs_cache_keys_by_the_configured_flows():
+    cache = rapidpro.RunsCache()
+    client = FakeClient(runs=RUNS)
+    # same token, another chatbot configuring another flow
+    other = dict(CHATBOT, start_flow="other")
+    assert [o.uuid for o in cache.get(client, CHATBOT, "b", "a")["start"]] == ["r0", "r3"]
+    assert [o.uuid for o in cache.get(client, other, "b", "a")["other"]] == ["r1"]
+    assert len(client.calls) == 2
+
+
+def test_runs_cache_keeps_the_last_windows():
+    cache = rapidpro.RunsCache(max_entries=2)
+    client = FakeClient(runs=RUNS)
+    for day in ["01", "02", "03"]:
+        cache.get(client, CHATBOT, before=f"2024-02-{day}", after=f"2024-01-{day}")
+    assert [key[3] for key in cache.entries] == ["2024-01-02", "2024-01-03"]
+    cache.get(client, CHATBOT, before="2024-02-01", after="2024-01-01")
+    assert len(client.calls) == 4
+
+
+def test_run_batches_per_flow_queries_the_flow(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(rapidpro, "RUNS_CACHE", rapidpro.RunsCache())
+    client = FakeClient(runs=[[run(0, "start")]])
+    rapidpro.num_onboarding_started(client, dict(CHATBOT, runs_fetch="per_flow"), after=date(2024, 1, 1))
+    assert client.calls == [("runs", {"flow": "start", "before": date(2024, 1, 2), "after": date(2024, 1, 1)})]
+    assert pd.read_csv(tmp_path / "2024-01-01-bot-runs-onboarding.csv")["id"].tolist() == ["r0"]
+
+
+def test_extractors_of_a_chatbot_share_the_runs(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(rapidpro, "RUNS_CACHE", rapidpro.RunsCache())
+    lookup = run(2, "lookup")
+    lookup.values = {"uncaught_message": SimpleNamespace(value="hello")}
+    client = FakeClient(runs=[[run(0, "start"), run(1, "other")], [lookup, run(3, "start")]])
+    rapidpro.num_onboarding_started(client, FLOWS_CHATBOT, after=date(2024, 1, 1))
+    rapidpro.get_uncaught_messages(client, FLOWS_CHATBOT, after=date(2024, 1, 1))
+    assert len(client.calls) == 1
+    assert pd.read_csv(tmp_path / "2024-01-01-bot-runs-onboarding.csv")["id"].tolist() == ["r0", "r3"]
+    uncaught = pd.read_csv(tmp_path / "2024-01-01-bot-runs-uncaught_messages.csv")
+    assert uncaught["uncaught_message"].tolist() == ["hello"]
+
+
+def platform_list(platforms):
+    return [None if pd.isna(platform) else platform for platform in platforms]
+
+
+def test_get_platforms_matches_get_platform():
+    urns = pd.Series(["ext:1", "facebook:2", "whatsapp:3", "telegram:4", "tel:+275", "mailto:6", "tel", "", None, "whatsapp:"])
+    platforms = rapidpro.get_platforms(urns)
+    assert platforms.dtype == "category"
+    assert platform_list(platforms) == [
+        rapidpro.get_platform(urn) if isinstance(urn, str) else None for urn in urns
+    ]
+
+
+def test_get_platforms_uses_the_chatbot_schemes():
+    platforms = {**rapidpro.URN_PLATFORMS, "tel": "sms", "viber": "viber"}
+    urns = pd.Series(["tel:1", "viber:2", "ext:3"], index=[5, 6, 7])
+    result = rapidpro.get_platforms(urns, platforms)
+    assert result.tolist() == ["sms", "viber", "website"]
+    assert result.index.tolist() == [5, 6, 7]
+
+
+@pytest.mark.benchmark
+def test_benchmark_vectorized_platforms():
+    size = int(os.getenv("RAPIDPRO_BENCHMARK_URNS", 5_000_000))
+    schemes = ["ext", "facebook", "whatsapp", "telegram", "tel", "mailto"]
+    urns = pd.Series([f"{schemes[number % 6]}:{number}" for number in range(size)])
+
+    start = time.perf_counter()
+    per_row = urns.map(rapidpro.get_platform)
+    per_row_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    vectorized = rapidpro.get_platforms(urns)
+    vectorized_seconds = time.perf_counter() - start
+    print(f"{size} urns: per row {per_row_seconds:.2f}s, vectorized {vectorized_seconds:.2f}s")
+    assert platform_list(vectorized) == platform_list(per_row)
+    assert vectorized_seconds < per_row_seconds
+
+
+def test_get_windows_has_one_window_per_day():
+    assert rapidpro.get_windows("2024-02-28", "2024-03-01") == [
+        (date(2024, 2, 28), date(2024, 2, 29)),
+        (date(2024, 2, 29), date(2024, 3, 1)),
+        (date(2024, 3, 1), date(2024, 3, 2)),
+    ]
+    assert rapidpro.get_windows("2024-01-01", "2024-01-01") == [(date(2024, 1, 1), date(2024, 1, 2))]
+
+
+def test_main_backfills_every_day_without_the_flows_snapshot(recorder):
+    write_chatbots([{"name": "a", "token": "a"}])
+    rapidpro.main(start_date="2024-01-01", end_date="2024-01-03")
+    assert len(recorder.calls) == 12
+    assert "most_popular_flows" not in {name for name, _, _ in recorder.calls}
+    assert sorted({window for _, _, window in recorder.calls}) == rapidpro.get_windows("2024-01-01", "2024-01-03")
+
+
+def test_main_backfills_one_day_without_an_end_date(recorder):
+    write_chatbots([{"name": "a", "token": "a"}])
+    rapidpro.main(start_date="2024-01-01")
+    assert {window for _, _, window in recorder.calls} == {(date(2024, 1, 1), date(2024, 1, 2))}
+
+
+def test_backfill_window_names_the_files_by_day(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    client = FakeClient(contacts=contact_pages(1, 1))
+    rapidpro.num_conversations_initiated_and_returning_users(client, CHATBOT, date(2023, 4, 16), date(2023, 4, 17))
+    assert client.calls == [("contacts", {"before": date(2023, 4, 17), "after": date(2023, 4, 16)})]
+    assert (tmp_path / "2023-04-16-bot-contacts.csv").exists()
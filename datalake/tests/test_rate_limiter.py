@@ -0,0 +1,140 @@
+"""TESTS FOR THE SHARED RATE LIMITERS"""
+import json
+import time
+from collections import deque
+
+import pytest
+
+from utils.rate_limiter import AdaptiveRateLimiter, TokenBucket, get_rate_limiter
+
+
+def test_token_bucket_rejects_non_positive_rates():
+    with pytest.raises(ValueError):
+        TokenBucket(rate=0)
+
+
+def test_token_bucket_allows_a_burst_of_its_capacity():
+    bucket = TokenBucket(rate=1, capacity=5)
+    start = time.monotonic()
+    waited = sum(bucket.acquire() for _ in range(5))
+    assert waited == 0
+    assert time.monotonic() - start < 0.1
+
+
+def test_token_bucket_waits_for_tokens_beyond_the_burst():
+    bucket = TokenBucket(rate=50, capacity=1)
+    bucket.acquire()
+    start = time.monotonic()
+    _ = [bucket.acquire() for _ in range(5)]
+    assert time.monotonic() - start >= 0.08
+
+
+def test_token_bucket_clamps_one_acquire_to_its_capacity():
+    # a single call never waits for more than the capacity, callers needing more
+    # tokens (e.g one per batch sub-request) have to acquire them one by one
+    bucket = TokenBucket(rate=100, capacity=10)
+    start = time.monotonic()
+    bucket.acquire(tokens=50)
+    assert time.monotonic() - start < 0.05
+
+
+def test_update_from_headers_slows_down_above_the_threshold():
+    limiter = AdaptiveRateLimiter(rate=10, threshold=75, recovery=0.05)
+    limiter.update_from_headers({"X-App-Usage": json.dumps({"call_count": 90})})
+    assert limiter.rate == pytest.approx(10 * (100 - 90) / 25)
+
+    # back under the threshold the rate doubles back once per recovery period
+    limiter.update_from_headers({"x-app-usage": {"call_count": 10, "total_time": 20}})
+    assert limiter.rate == pytest.approx(4)
+    time.sleep(0.06)
+    limiter.update_from_headers({"x-app-usage": {"call_count": 10}})
+    assert limiter.rate == pytest.approx(8)
+    time.sleep(0.06)
+    limiter.update_from_headers({"x-app-usage": {"call_count": 10}})
+    assert limiter.rate == 10
+
+
+def test_lower_usage_above_the_threshold_does_not_undo_a_penalty():
+    limiter = AdaptiveRateLimiter(rate=10, threshold=75)
+    limiter.penalize(retry_after=0)
+    limiter.penalize(retry_after=0)
+    limiter.update_from_headers({"x-app-usage": {"call_count": 80}})
+    assert limiter.rate == 2.5
+
+
+def test_update_from_headers_reads_business_usage_and_pauses():
+    limiter = AdaptiveRateLimiter(rate=10)
+    business = {
+        "123": [{"call_count": 100, "estimated_time_to_regain_access": 2}],
+    }
+    limiter.update_from_headers({"x-business-use-case-usage": json.dumps(business)})
+    assert limiter.rate == limiter.min_rate
+    assert limiter.paused_until - time.monotonic() > 100
+
+
+def test_update_from_headers_ignores_missing_headers():
+    limiter = AdaptiveRateLimiter(rate=10)
+    limiter.update_from_headers(None)
+    limiter.update_from_headers({})
+    assert limiter.rate == 10 and limiter.paused_until == 0
+
+
+def test_headers_without_usage_keep_the_penalty():
+    limiter = AdaptiveRateLimiter(rate=10)
+    limiter.penalize(retry_after=0)
+    limiter.penalize(retry_after=0)
+    limiter.update_from_headers({"Content-Type": "application/json", "ETag": "abc"})
+    assert limiter.rate == 2.5
+
+
+def test_penalize_halves_the_rate_down_to_the_minimum():
+    limiter = AdaptiveRateLimiter(rate=1, min_rate=0.4)
+    limiter.penalize(retry_after=0)
+    assert limiter.rate == 0.5
+    limiter.penalize(retry_after=0)
+    assert limiter.rate == 0.4
+
+
+def test_get_rate_limiter_shares_and_reconfigures_limiters():
+    limiter = get_rate_limiter("tests_shared", rate=3)
+    assert get_rate_limiter("tests_shared") is limiter
+    get_rate_limiter("tests_shared", rate=6)
+    assert limiter.max_rate == 6
+
+
+class MockQuotaServer:
+    """api allowing `quota` calls per `window` seconds and reporting its usage in
+    Meta's x-app-usage header, calls over the quota are rejected"""
+
+    def __init__(self, quota: int, window: float):
+        self.quota = quota
+        self.window = window
+        self.calls: deque = deque()
+        self.rejected = 0
+
+    def call(self) -> dict:
+        now = time.monotonic()
+        while self.calls and now - self.calls[0] > self.window:
+            self.calls.popleft()
+        if len(self.calls) >= self.quota:
+            self.rejected += 1
+        self.calls.append(now)
+        usage = 100 * len(self.calls) / self.quota
+        return {"x-app-usage": json.dumps({"call_count": usage})}
+
+
+def test_adaptive_limiter_keeps_a_mock_server_under_its_quota():
+    server = MockQuotaServer(quota=40, window=0.5)
+    limiter = AdaptiveRateLimiter(
+        rate=400, capacity=5, threshold=60, min_rate=20, recovery=0.1
+    )
+    deadline = time.monotonic() + 1.5
+    calls = 0
+    while time.monotonic() < deadline:
+        limiter.acquire()
+        limiter.update_from_headers(server.call())
+        calls += 1
+
+    # unthrottled, 400 calls per second would be rejected about 9 times out of 10
+    assert calls > 40
+    assert server.rejected <= calls * 0.1
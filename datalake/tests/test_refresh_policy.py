@@ -0,0 +1,51 @@
+"""TESTS FOR THE AGE AWARE REFRESH POLICY"""
+from datetime import date
+
+from utils.watermark import LocalWatermarkStore
+from GE_meta_engagement.refresh_policy import RefreshPolicy, get_refresh_policy
+
+TODAY = date(2024, 6, 30)
+
+
+def test_interval_depends_on_the_age():
+    policy = RefreshPolicy(None, "post", today=TODAY)
+    assert policy.interval("2024-06-28T10:00:00+0000") == 1
+    assert policy.interval("2024-05-01T10:00:00+0000") == 7
+    assert policy.interval("2023-01-01T10:00:00+0000") == 30
+    assert policy.interval(None) == 1
+
+
+def test_is_due_compares_the_last_snapshot_with_the_interval(tmp_path):
+    watermarks = LocalWatermarkStore("tests", path=tmp_path)
+    watermarks.set("new", "post", "2024-06-29")
+    watermarks.set("old", "post", "2024-06-25")
+    policy = RefreshPolicy(watermarks, "post", today=TODAY)
+
+    assert policy.is_due("never_fetched", "2023-01-01")
+    assert policy.is_due("new", "2024-06-28")
+    assert not policy.is_due("old", "2023-01-01")
+    assert policy.skipped == 1
+
+
+def test_mark_is_staged_until_the_commit(tmp_path):
+    watermarks = LocalWatermarkStore("tests", path=tmp_path)
+    policy = RefreshPolicy(watermarks, "media", today=TODAY)
+    policy.mark("media_id")
+    assert LocalWatermarkStore("tests", path=tmp_path).get("media_id", "media") is None
+    watermarks.commit()
+    assert LocalWatermarkStore("tests", path=tmp_path).get("media_id", "media") == "2024-06-30"
+
+
+def test_get_refresh_policy_needs_configs_and_watermarks(tmp_path):
+    watermarks = LocalWatermarkStore("tests", path=tmp_path)
+    schedule = [{"every_days": 3}]
+    assert get_refresh_policy(None, "post", {"refresh": True}) is None
+    assert get_refresh_policy(watermarks, "post", {}) is None
+    assert get_refresh_policy(watermarks, "post", {"refresh": {"schedule": schedule}}).schedule == schedule
+
+
+def test_interval_past_every_rule_uses_the_last_one():
+    schedule = [{"max_age_days": 7, "every_days": 1}, {"max_age_days": 30, "every_days": 5}]
+    policy = RefreshPolicy(None, "post", schedule=schedule, today=TODAY)
+    assert policy.interval("2024-06-20") == 5
+    assert policy.interval("2020-01-01") == 5
@@ -0,0 +1,71 @@
+"""TESTS FOR THE WATERMARK STORE"""
+import pytest
+
+from utils.watermark import LocalWatermarkStore, WatermarkConflict, get_watermark_store
+
+
+def test_watermarks_only_move_forward(tmp_path):
+    store = LocalWatermarkStore("tests", path=tmp_path)
+    store.set("channel", "video_stats", "2024-01-10")
+    store.set("channel", "video_stats", "2024-01-05")
+    assert store.get("channel", "video_stats") == "2024-01-10"
+    assert LocalWatermarkStore("tests", path=tmp_path).get("channel", "video_stats") == "2024-01-10"
+
+
+def test_start_date_resumes_after_the_watermark(tmp_path):
+    store = LocalWatermarkStore("tests", path=tmp_path)
+    assert store.start_date("view", "report", "2021-11-24") == "2021-11-24"
+    store.set("view", "report", "2024-01-10")
+    assert store.start_date("view", "report", "2021-11-24") == "2024-01-11"
+    assert store.start_date("view", "report", "2021-11-24", lookback_days=1) == "2024-01-10"
+    assert store.is_done("view", "report", "2024-01-10")
+    assert not store.is_done("view", "report", "2024-01-11")
+
+
+def test_staged_watermarks_are_saved_on_commit(tmp_path):
+    store = LocalWatermarkStore("tests", path=tmp_path)
+    store.set("page", "post", "2024-01-10", commit=False)
+    assert LocalWatermarkStore("tests", path=tmp_path).get("page", "post") is None
+    store.commit()
+    assert LocalWatermarkStore("tests", path=tmp_path).get("page", "post") == "2024-01-10"
+
+
+def test_commit_reloads_and_retries_on_conflict(tmp_path):
+    class ConflictingStore(LocalWatermarkStore):
+        conflicts = 1
+
+        def save(self, marks):
+            if self.conflicts:
+                self.conflicts -= 1
+                # another run committed in between
+                LocalWatermarkStore("tests", path=tmp_path).set("other", "post", "2024-02-01")
+                raise WatermarkConflict("changed")
+            super().save(marks)
+
+    store = ConflictingStore("tests", path=tmp_path)
+    store.set("page", "post", "2024-01-10")
+    saved = LocalWatermarkStore("tests", path=tmp_path)
+    assert saved.get("page", "post") == "2024-01-10"
+    assert saved.get("other", "post") == "2024-02-01"
+
+
+def test_get_watermark_store_rejects_unknown_backends():
+    with pytest.raises(KeyError):
+        get_watermark_store("tests", {"backend": "s3"})
+
+
+def test_is_done_leaves_the_lookback_days_open(tmp_path):
+    store = LocalWatermarkStore("tests", path=tmp_path)
+    store.set("account", "ads", "2024-06-10")
+    assert store.is_done("account", "ads", "2024-06-03", lookback_days=7)
+    assert not store.is_done("account", "ads", "2024-06-04", lookback_days=7)
+    assert not store.is_done("account", "ads", "2024-06-10", lookback_days=7)
+    assert store.start_date("account", "ads", "2023-04-01", lookback_days=7) == "2024-06-04"
+
+
+def test_lookback_never_moves_a_watermark_back(tmp_path):
+    store = LocalWatermarkStore("tests", path=tmp_path)
+    store.set("account", "ads", "2024-06-10")
+    start = store.start_date("account", "ads", "2023-04-01", lookback_days=3)
+    store.set("account", "ads", start)
+    assert store.get("account", "ads") == "2024-06-10"
@@ -0,0 +1,233 @@
+"""TESTS FOR THE YOUTUBE READER AGAINST A FAKE ANALYTICS ENDPOINT"""
+import threading
+import time
+from datetime import date, timedelta
+
+import pytest
+
+pytest.importorskip("googleapiclient")
+pytest.importorskip("google_auth_httplib2")
+
+from utils.rate_limiter import get_rate_limiter
+from GE_YT.reader import YouTubeReader
+
+CHANNEL = {"channel_name": "channel", "channel_id": "UC1", "channel_playlistid": "UU1"}
+CONFIGS = {
+    "start_date": "2024-01-01",
+    "end_date": "2024-01-01",
+    "interval": "1_day",
+    "metrics": ["views"],
+    "dimensions": ["day"],
+}
+
+
+class FakeAnalytics:
+    """youtubeAnalytics reports().query endpoint answering every call after `latency`
+    seconds with one row per video and day, paged by startIndex/maxResults"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.queries = []
+        self.lock = threading.Lock()
+
+    def reports(self):
+        return self
+
+    def query(self, **params):
+        with self.lock:
+            self.queries.append(params)
+        return FakeRequest(self, params)
+
+    def answer(self, params):
+        time.sleep(self.latency)
+        videos = params.get("filters", "video==").split("==", 1)[1].split(",")
+        start = date.fromisoformat(params["startDate"])
+        days = [
+            (start + timedelta(days)).isoformat()
+            for days in range((date.fromisoformat(params["endDate"]) - start).days + 1)
+        ]
+        dimensions = params["dimensions"].split(",")
+        values = {"video": videos, "day": days, "insightTrafficSourceType": ["YT_SEARCH"]}
+        rows = [[]]
+        for dimension in dimensions:
+            rows = [row + [value] for row in rows for value in values[dimension]]
+        rows = [row + [len(row[-1])] for row in rows]
+        first = int(params.get("startIndex", 1)) - 1
+        size = int(params.get("maxResults", len(rows) or 1))
+        return {
+            "kind": "youtubeAnalytics#resultTable",
+            "columnHeaders": [{"name": name} for name in dimensions + ["views"]],
+            "rows": rows[first : first + size],
+        }
+
+
+class FakeRequest:
+    def __init__(self, analytics, params):
+        self.analytics = analytics
+        self.params = params
+
+    def execute(self, http=None):
+        return self.analytics.answer(self.params)
+
+
+class FakeAuthenticator:
+    """stands in for YouTubeAPIAuthenticator, without credentials"""
+
+    def __init__(self, latency: float = 0.0):
+        self.youtube_analytics = FakeAnalytics(latency)
+
+    def get_http(self):
+        return None
+
+
+def fake_reader(videos: int, latency: float = 0.0) -> YouTubeReader:
+    reader = YouTubeReader(FakeAuthenticator(latency))
+    reader.channels = [CHANNEL]
+    reader.channel_videos = {
+        "channel": [
+            {
+                "snippet": {
+                    "resourceId": {"videoId": f"v{number:03d}"},
+                    "title": f"video {number}",
+                    "publishedAt": "2023-01-01T00:00:00Z",
+                }
+            }
+            for number in range(videos)
+        ]
+    }
+    return reader
+
+
+@pytest.fixture(autouse=True)
+def fast_limiter():
+    get_rate_limiter("youtube_analytics", rate=10000)
+
+
+def test_get_videos_keeps_the_serial_order_with_workers():
+    serial = list(fake_reader(20).get_videos(dict(CONFIGS), "video_stats"))
+    concurrent = list(
+        fake_reader(20, latency=0.005).get_videos(dict(CONFIGS, workers=4), "video_stats")
+    )
+    assert [payload["file_suffix"] for payload in concurrent] == [
+        f"-v{number:03d}" for number in range(20)
+    ]
+    assert [payload["data"] for payload in concurrent] == [
+        payload["data"] for payload in serial
+    ]
+
+
+def test_get_videos_does_not_change_the_endpoint_configs():
+    configs = dict(CONFIGS, workers=2)
+    list(fake_reader(3).get_videos(configs, "video_stats"))
+    assert "filters" not in configs
+
+
+@pytest.mark.benchmark
+def test_benchmark_concurrent_video_stats():
+    # 40 videos on an endpoint answering in 20ms: ~0.8s serially
+    start = time.perf_counter()
+    list(fake_reader(40, latency=0.02).get_videos(dict(CONFIGS), "video_stats"))
+    serial = time.perf_counter() - start
+
+    start = time.perf_counter()
+    list(fake_reader(40, latency=0.02).get_videos(dict(CONFIGS, workers=8), "video_stats"))
+    concurrent = time.perf_counter() - start
+    print(f"40 videos: serial {serial:.2f}s, 8 workers {concurrent:.2f}s")
+    assert concurrent < serial / 3
+
+
+RESULT = {
+    "kind": "youtubeAnalytics#resultTable",
+    "columnHeaders": [{"name": "day"}, {"name": "video"}, {"name": "views"}],
+    "rows": [["2024-01-01", "a", 3], ["2024-01-01", "b", 1], ["2024-01-03", "a", 2]],
+}
+
+
+def test_split_rows_by_a_dimension():
+    parts = YouTubeReader.split_rows(RESULT, "video")
+    assert list(parts) == ["a", "b"]
+    assert parts["a"]["columnHeaders"] == [{"name": "day"}, {"name": "views"}]
+    assert parts["a"]["rows"] == [["2024-01-01", 3], ["2024-01-03", 2]]
+    assert parts["a"]["kind"] == RESULT["kind"]
+
+
+def test_split_rows_keeps_the_column_and_empty_values():
+    parts = YouTubeReader.split_rows(RESULT, "video", values=["c"], drop=False)
+    assert parts["c"]["rows"] == []
+    assert parts["b"]["rows"] == [["2024-01-01", "b", 1]]
+
+
+def test_fetch_video_batch_follows_the_pages():
+    reader = fake_reader(4)
+    videos = [{"video_id": f"v{number:03d}"} for number in range(5)]
+    configs = dict(CONFIGS, maxResults=3)
+    payloads = reader.fetch_video_batch(
+        CHANNEL, videos, "video_stats", "2024-01-01", "2024-01-02", configs
+    )
+    queries = reader.authenticator.youtube_analytics.queries
+    # 10 rows in pages of 3
+    assert [query["startIndex"] for query in queries] == [1, 4, 7, 10]
+    assert queries[0]["dimensions"] == "video,day"
+    assert [payload["file_suffix"] for payload in payloads] == [
+        f"-v{number:03d}" for number in range(5)
+    ]
+    assert payloads[0]["data"]["rows"] == [["2024-01-01", 10], ["2024-01-02", 10]]
+    assert payloads[0]["data"]["columnHeaders"] == [{"name": "day"}, {"name": "views"}]
+    assert payloads[4]["data"]["videoId"] == "v004"
+
+
+def test_fetch_video_batch_stops_on_a_short_page():
+    reader = fake_reader(2)
+    videos = [{"video_id": "v000"}, {"video_id": "v001"}]
+    reader.fetch_video_batch(
+        CHANNEL, videos, "video_stats", "2024-01-01", "2024-01-01", dict(CONFIGS)
+    )
+    assert len(reader.authenticator.youtube_analytics.queries) == 1
+
+
+def test_batched_get_videos_matches_the_per_video_payloads():
+    single = list(fake_reader(7).get_videos(dict(CONFIGS), "video_stats"))
+    batched = list(
+        fake_reader(7).get_videos(dict(CONFIGS, batch_size=3), "video_stats")
+    )
+    assert [payload["data"]["rows"] for payload in batched] == [
+        payload["data"]["rows"] for payload in single
+    ]
+    assert [payload["file_suffix"] for payload in batched] == [
+        payload["file_suffix"] for payload in single
+    ]
+
+
+def test_split_days_dates_every_payload():
+    reader = fake_reader(0)
+    payload = {"channel_id": "channel", "data": RESULT, "date": "2024-01-01"}
+    days = ["2024-01-01", "2024-01-02", "2024-01-03"]
+    payloads = reader.split_days(payload, days)
+    assert [part["date"] for part in payloads] == days
+    assert payloads[1]["data"]["rows"] == []
+    assert payloads[2]["data"]["rows"] == [["a", 2]]
+    assert payloads[0]["channel_id"] == "channel"
+
+
+def test_range_fetch_queries_once_and_splits_per_day():
+    configs = dict(CONFIGS, end_date="2024-01-03", dimensions=["insightTrafficSourceType"])
+    daily = fake_reader(2)
+    daily_payloads = list(daily.get_videos(dict(configs), "video_stats"))
+
+    ranged = fake_reader(2)
+    payloads = list(ranged.get_videos(dict(configs, range_fetch=True), "video_stats"))
+    assert len(ranged.authenticator.youtube_analytics.queries) == 2
+    assert len(daily.authenticator.youtube_analytics.queries) == 6
+    assert [(payload["date"], payload["file_suffix"]) for payload in payloads] == [
+        (day, f"-{video}")
+        for video in ["v000", "v001"]
+        for day in ["2024-01-01", "2024-01-02", "2024-01-03"]
+    ]
+    # the day column only added for the split is dropped again
+    assert payloads[0]["data"]["columnHeaders"] == [
+        {"name": "insightTrafficSourceType"},
+        {"name": "views"},
+    ]
+    assert sorted(payload["date"] for payload in daily_payloads) == sorted(
+        payload["date"] for payload in payloads
+    )
@@ -0,0 +1,39 @@
+"""CONCURRENCY HELPERS"""
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Generator, Iterable, Tuple
+
+
+def ordered_map(
+    function: Callable[..., Any],
+    tasks: Iterable[Tuple[Any, ...]],
+    workers: int = 1,
+    prefetch: int = 2,
+) -> Generator[Any, None, None]:
+    """Run function over tasks on a thread pool and yield results in task order
+
+    Args:
+        function (Callable[..., Any]): function called as function(*task)
+        tasks (Iterable[Tuple[Any, ...]]): argument tuples, consumed lazily
+        workers (int, optional): number of worker threads, 1 runs serially. Defaults to 1.
+        prefetch (int, optional): calls kept in flight per worker. Defaults to 2.
+    Yields:
+        Generator[Any, None, None]: results in the same order as tasks
+    """
+    if workers <= 1:
+        for task in tasks:
+            yield function(*task)
+        return
+
+    pending: Deque[Future] = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for task in tasks:
+                pending.append(executor.submit(function, *task))
+                if len(pending) >= workers * prefetch:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            _ = [future.cancel() for future in pending]
@@ -9,6 +9,7 @@ from functools import wraps
 from typing import Union
 
 from utils.notification_handler import slack_helper
+from utils.rate_limiter import get_rate_limiter
 
 
 def retry_handler(
@@ -76,12 +77,21 @@ def retry_handler(
     return retry_decorator
 
 
-def api_handler(wait: Union[float, int] = 0, backoff_factor: Union[float, int] = 0.01):
+def api_handler(
+    wait: Union[float, int] = 0,
+    backoff_factor: Union[float, int] = 0.01,
+    limiter: Union[str, None] = None,
+):
     """Decorator - managing API failures
 
     Args:
-        wait (Union[float, int], optional): _description_. Defaults to 0.
+        wait (Union[float, int], optional): fixed seconds to sleep before each call when
+            no limiter is given. Defaults to 0.
         backoff_factor (Union[float, int], optional): _description_. Defaults to 0.01.
+        limiter (Union[str, None], optional): name of the shared rate limiter to take a
+            token from before each call, see utils.rate_limiter. A `limiter` keyword
+            argument of the call overrides it e.g one limiter per access token.
+            Defaults to None.
     Return:
         wrapped function's response
     """
@@ -91,6 +101,11 @@ def api_handler(wait: Union[float, int] = 0, backoff_factor: Union[float, int] =
         def func_with_retries(*args, **kwargs):
             """wrapper function to decorate function with retry functionality"""
 
+            name = kwargs.get("limiter") or limiter
+            if name:
+                get_rate_limiter(name).acquire()
+                return function(*args, **kwargs)
+
             print(f"waiting {wait} seconds before attempt")
             time.sleep(wait)
             return function(*args, **kwargs)
@@ -0,0 +1,197 @@
+"""RATE LIMITER"""
+
+import json
+import time
+import threading
+from typing import Any, Dict, List, Union
+
+
+class TokenBucket:
+    """Thread safe token bucket shared by concurrent api callers
+
+    Args:
+        rate (float): number of tokens added to the bucket per second
+        capacity (Union[float, None], optional): maximum burst size. Defaults to rate.
+    """
+
+    def __init__(self, rate: float, capacity: Union[float, None] = None):
+        if rate <= 0:
+            raise ValueError(f"rate should be greater than 0 but got: {rate}")
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity else max(self.rate, 1.0)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self) -> None:
+        """method to add the tokens accumulated since the last refill"""
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    def acquire(self, tokens: float = 1) -> float:
+        """method to block until the requested tokens are available
+
+        Args:
+            tokens (float, optional): tokens needed by the call. Defaults to 1.
+        Returns:
+            float: seconds spent waiting for the tokens
+        """
+        waited: float = 0.0
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return waited
+                delay = (tokens - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class AdaptiveRateLimiter(TokenBucket):
+    """Token bucket that only slows down when the api reports the quota is running out
+
+    Args:
+        rate (float): requests per second allowed while the quota is healthy
+        capacity (Union[float, None], optional): maximum burst size. Defaults to rate.
+        threshold (float, optional): usage percentage from which the rate is reduced.
+        min_rate (float, optional): lowest rate the limiter will throttle down to.
+        recovery (float, optional): seconds without a penalty before the rate doubles back.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        capacity: Union[float, None] = None,
+        threshold: float = 75.0,
+        min_rate: float = 0.1,
+        recovery: float = 60.0,
+    ):
+        super().__init__(rate=rate, capacity=capacity)
+        self.max_rate = self.rate
+        self.threshold = threshold
+        self.min_rate = min_rate
+        self.recovery = recovery
+        self.paused_until = 0.0
+        self.penalized_at = 0.0
+
+    def configure(self, rate: float, capacity: Union[float, None] = None) -> None:
+        """method to change the healthy rate of an existing limiter"""
+        with self.lock:
+            self.max_rate = self.rate = float(rate)
+            self.capacity = float(capacity) if capacity else max(self.rate, 1.0)
+            self.tokens = min(self.tokens, self.capacity)
+
+    def pause(self, seconds: float) -> None:
+        """method to stop every caller of the limiter for the given seconds"""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def _recover(self) -> None:
+        """method to double the rate back up once the penalties stop"""
+        now = time.monotonic()
+        if self.rate < self.max_rate and now - self.penalized_at >= self.recovery:
+            self.rate = min(self.max_rate, self.rate * 2)
+            self.penalized_at = now
+
+    def acquire(self, tokens: float = 1) -> float:
+        waited: float = 0.0
+        while True:
+            with self.lock:
+                self._recover()
+                delay = self.paused_until - time.monotonic()
+            if delay <= 0:
+                break
+            print(f"quota nearly exhausted, waiting {delay:.1f} seconds")
+            time.sleep(delay)
+            waited += delay
+        return waited + super().acquire(tokens=tokens)
+
+    def set_usage(self, usage: float, regain_seconds: float = 0) -> None:
+        """method to scale the rate from the quota usage percentage reported by the api
+
+        Args:
+            usage (float): highest usage percentage (0-100) across the reported quotas
+            regain_seconds (float, optional): seconds until the api lifts a block.
+        """
+        with self.lock:
+            if usage < self.threshold:
+                # healthy again: doubles back every `recovery` seconds, see _recover
+                self._recover()
+            else:
+                scale = max(0.0, (100.0 - usage) / (100.0 - self.threshold))
+                self.rate = min(self.rate, max(self.min_rate, self.max_rate * scale))
+                self.penalized_at = time.monotonic()
+        if regain_seconds > 0:
+            self.pause(regain_seconds)
+
+    def penalize(self, retry_after: Union[float, str, None] = None) -> None:
+        """method to back off after the api rejected a call for exceeding the quota"""
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.penalized_at = time.monotonic()
+            delay = float(retry_after) if retry_after else 1 / self.rate
+        self.pause(delay)
+
+    def update_from_headers(self, headers: Union[Dict[str, Any], None]) -> None:
+        """method to feed the limiter with Meta's usage headers
+
+        Reads `x-app-usage`, `x-ad-account-usage` and `x-business-use-case-usage`
+        and throttles on the most used of call_count, total_cputime and total_time.
+        Responses without any of these headers leave the limiter unchanged.
+        """
+        if not headers:
+            return
+        headers = {str(key).lower(): value for key, value in dict(headers).items()}
+        usages: List[Dict[str, Any]] = []
+        for header in ["x-app-usage", "x-ad-account-usage"]:
+            if value := headers.get(header):
+                usages.append(json.loads(value) if isinstance(value, str) else value)
+        if value := headers.get("x-business-use-case-usage"):
+            business_usage = json.loads(value) if isinstance(value, str) else value
+            for business in business_usage.values():
+                usages.extend(business)
+        if not usages:
+            # an ordinary response says nothing about the quota
+            return
+
+        usage, regain_minutes = 0.0, 0.0
+        for item in usages:
+            for key in ["call_count", "total_cputime", "total_time", "acc_id_util_pct"]:
+                usage = max(usage, float(item.get(key) or 0))
+            regain_minutes = max(
+                regain_minutes, float(item.get("estimated_time_to_regain_access") or 0)
+            )
+        self.set_usage(usage, regain_seconds=regain_minutes * 60)
+
+
+DEFAULT_RATE: float = 10.0
+_LIMITERS: Dict[str, AdaptiveRateLimiter] = {}
+_LIMITERS_LOCK = threading.Lock()
+
+
+def get_rate_limiter(
+    name: str, rate: Union[float, None] = None, capacity: Union[float, None] = None
+) -> AdaptiveRateLimiter:
+    """Get the limiter shared by every thread calling the same api/credential
+
+    Args:
+        name (str): api and credential key e.g youtube_analytics, meta_graph
+        rate (Union[float, None], optional): healthy requests per second, reconfigures
+            an existing limiter when provided. Defaults to DEFAULT_RATE for new limiters.
+        capacity (Union[float, None], optional): maximum burst size. Defaults to rate.
+    Returns:
+        AdaptiveRateLimiter: the shared limiter
+    """
+    with _LIMITERS_LOCK:
+        limiter = _LIMITERS.get(name)
+        if limiter is None:
+            limiter = AdaptiveRateLimiter(rate=rate or DEFAULT_RATE, capacity=capacity)
+            _LIMITERS[name] = limiter
+        elif rate:
+            limiter.configure(rate=rate, capacity=capacity)
+    return limiter
@@ -0,0 +1,227 @@
+"""WATERMARK STORE"""
+
+import os
+import sys
+import json
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Dict, Union
+
+
+class WatermarkConflict(Exception):
+    """Exception raised when the saved watermarks changed since they were loaded"""
+
+
+class WatermarkStore(ABC):
+    """Keeps the last fully fetched date per pipeline, scope and endpoint
+
+    The scope is the account, channel or view the data belongs to. Watermarks only
+    move forward. `set(..., commit=False)` stages a watermark in memory until
+    `commit`, so a pipeline can commit once its writer flushed the data it covers.
+
+    Args:
+        pipeline (str): name of the pipeline e.g youtube, meta_ads, ga_ua
+        retries (int, optional): times a conflicting commit is reloaded and retried.
+    """
+
+    def __init__(self, pipeline: str, retries: int = 5):
+        self.pipeline = pipeline
+        self.retries = retries
+        self.lock = threading.RLock()
+        self.marks: Union[Dict[str, Dict[str, Any]], None] = None
+        self.staged: Dict[str, str] = {}
+
+    @abstractmethod
+    def load(self) -> Dict[str, Dict[str, Any]]:
+        """method to read the saved watermarks of the pipeline"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def save(self, marks: Dict[str, Dict[str, Any]]) -> None:
+        """method to atomically replace the saved watermarks of the pipeline"""
+        raise NotImplementedError
+
+    @staticmethod
+    def key(scope: str, endpoint: str) -> str:
+        """method to get the key of a scope and endpoint"""
+        return f"{scope}/{endpoint}"
+
+    def _saved(self, key: str) -> str:
+        if self.marks is None:
+            self.marks = self.load()
+        return (self.marks.get(key) or {}).get("value", "")
+
+    def get(self, scope: str, endpoint: str) -> Union[str, None]:
+        """method to get the saved watermark, None when nothing was fetched yet"""
+        with self.lock:
+            return self._saved(self.key(scope, endpoint)) or None
+
+    def is_done(
+        self, scope: str, endpoint: str, value: Any, lookback_days: int = 0
+    ) -> bool:
+        """method to check if value (e.g a date) is covered by the saved watermark,
+        the last `lookback_days` dates of the watermark are never done"""
+        mark = self.get(scope, endpoint)
+        if mark and lookback_days:
+            mark = (
+                datetime.strptime(mark[:10], "%Y-%m-%d") - timedelta(days=lookback_days)
+            ).strftime("%Y-%m-%d")
+        return bool(mark) and str(value) <= mark
+
+    def start_date(
+        self, scope: str, endpoint: str, default: str, lookback_days: int = 0
+    ) -> str:
+        """Get the first date to fetch
+
+        Args:
+            scope (str): account, channel or view
+            endpoint (str): endpoint or report name
+            default (str): start date used when there is no watermark yet
+            lookback_days (int, optional): days before the watermark to fetch again,
+                for apis revising recent data. Defaults to 0.
+        Returns:
+            str: the day after the watermark (%Y-%m-%d) or default
+        """
+        mark = self.get(scope, endpoint)
+        if not mark:
+            return default
+        start = datetime.strptime(mark[:10], "%Y-%m-%d")
+        return (start + timedelta(days=1 - lookback_days)).strftime("%Y-%m-%d")
+
+    def set(self, scope: str, endpoint: str, value: Any, commit: bool = True) -> None:
+        """method to move a watermark forward, saved right away unless commit is False"""
+        key = self.key(scope, endpoint)
+        with self.lock:
+            if str(value) > max(self.staged.get(key, ""), self._saved(key)):
+                self.staged[key] = str(value)
+        if commit:
+            self.commit()
+
+    def commit(self) -> None:
+        """method to save the staged watermarks"""
+        with self.lock:
+            if not self.staged:
+                return
+            for attempt in range(self.retries + 1):
+                marks = self.load()
+                updated_at = datetime.now().isoformat(timespec="seconds")
+                for key, value in self.staged.items():
+                    if value > (marks.get(key) or {}).get("value", ""):
+                        marks[key] = {"value": value, "updated_at": updated_at}
+                try:
+                    self.save(marks)
+                    break
+                except WatermarkConflict:
+                    if attempt == self.retries:
+                        raise
+                    print(f"watermarks of {self.pipeline} changed, retrying commit")
+            self.marks, self.staged = marks, {}
+
+
+class LocalWatermarkStore(WatermarkStore):
+    """Watermarks kept in a local json file per pipeline
+
+    Args:
+        pipeline (str): name of the pipeline
+        path (str, optional): folder of the watermark files. Defaults to .watermarks.
+    """
+
+    def __init__(self, pipeline: str, path: str = ".watermarks", **kwargs):
+        super().__init__(pipeline, **kwargs)
+        self.file_path = Path(path) / f"{pipeline}.json"
+
+    def load(self) -> Dict[str, Dict[str, Any]]:
+        if not self.file_path.is_file():
+            return {}
+        with open(self.file_path, mode="r", encoding="utf8") as marks_file:
+            return json.load(marks_file)
+
+    def save(self, marks: Dict[str, Dict[str, Any]]) -> None:
+        self.file_path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            mode="w", encoding="utf8", dir=self.file_path.parent, delete=False
+        ) as temp_file:
+            json.dump(marks, temp_file, indent=4, sort_keys=True)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_file.name, self.file_path)
+
+
+class BlobWatermarkStore(WatermarkStore):
+    """Watermarks kept in a json blob per pipeline
+
+    Commits only replace the blob if nobody changed it since it was loaded.
+
+    Args:
+        pipeline (str): name of the pipeline
+        container_client (ContainerClient): client of the container holding the blob
+        path (str, optional): folder of the watermark blobs. Defaults to watermarks.
+    """
+
+    def __init__(self, pipeline: str, container_client, path: str = "watermarks", **kwargs):
+        super().__init__(pipeline, **kwargs)
+        self.blob_client = container_client.get_blob_client(f"{path}/{pipeline}.json")
+        self.etag: Union[str, None] = None
+
+    def load(self) -> Dict[str, Dict[str, Any]]:
+        from azure.core.exceptions import ResourceNotFoundError  # pylint: disable=import-outside-toplevel
+
+        try:
+            downloader = self.blob_client.download_blob()
+        except ResourceNotFoundError:
+            self.etag = None
+            return {}
+        self.etag = downloader.properties.etag
+        return json.loads(downloader.readall())
+
+    def save(self, marks: Dict[str, Dict[str, Any]]) -> None:
+        # pylint: disable=import-outside-toplevel
+        from azure.core import MatchConditions
+        from azure.core.exceptions import ResourceExistsError, ResourceModifiedError
+
+        body = json.dumps(marks, indent=4, sort_keys=True)
+        try:
+            if self.etag:
+                self.blob_client.upload_blob(
+                    body,
+                    overwrite=True,
+                    etag=self.etag,
+                    match_condition=MatchConditions.IfNotModified,
+                )
+            else:
+                self.blob_client.upload_blob(body, overwrite=False)
+        except (ResourceExistsError, ResourceModifiedError) as err:
+            raise WatermarkConflict(err) from err
+
+
+def get_watermark_store(
+    pipeline: str, configs: Union[Dict[str, Any], None] = None
+) -> WatermarkStore:
+    """Get the watermark store of a pipeline
+
+    Args:
+        pipeline (str): name of the pipeline e.g youtube, meta_ads, ga_ua
+        configs (Union[Dict[str, Any], None], optional): `backend` local (default) or
+            azure, `path` folder of the watermarks. The azure backend also needs
+            `container` and the same auth configs as the azure writers.
+    Returns:
+        WatermarkStore: the store
+    """
+    configs = dict(configs or {})
+    backend = configs.pop("backend", "local")
+    if backend == "local":
+        return LocalWatermarkStore(pipeline, path=configs.get("path", ".watermarks"))
+    if backend == "azure":
+        sys.path.append(str(Path(__file__).resolve().parents[1]))
+        from base_writers import AzureAuthenticator  # pylint: disable=import-outside-toplevel
+
+        service_client = AzureAuthenticator().authenticate(configs=configs)
+        return BlobWatermarkStore(
+            pipeline,
+            container_client=service_client.get_container_client(configs["container"]),
+            path=configs.get("path", "watermarks"),
+        )
+    raise KeyError(f"unknown watermark backend: {backend}, expecting local| azure")